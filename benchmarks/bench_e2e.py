@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""End-to-end overhead of ktransw, per phase, against a stored baseline.
+
+Generates a workspace (see workspace.py) and takes every program in it
+through the phases of a compile: make_classes, write_manifest, the -M
+dependency output, the --deps-only scan and the ktrans runs. For each
+phase it reports the wall time, the number of subprocesses started and
+the bytes written.
+
+gpp is the one on the PATH (or given with --gpp), or else stubs/gpp,
+which runs pygpp as a process of its own. ktrans is always stubs/ktrans,
+which only records its inputs, so only ktransw's own overhead is
+measured. The stubs are scripts, so this needs a POSIX system.
+
+--save-baseline stores the results in the baseline file, under a key made
+of the workspace and engine settings. Later runs with the same settings
+compare against it and exit with 1 if a phase got slower, or wrote more,
+by more than --threshold, or started more subprocesses. Wall times only
+compare meaningfully on the machine the baseline was made on.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(BENCH_DIR, '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import yaml
+
+import ktransw
+import workspace
+from ktransw import (FILE_MANIFEST, CompilationContext, build_parser, make_classes,
+    marker_dependencies, output_dependencies, scan_dependencies, translate_all,
+    write_manifest)
+
+STUB_GPP = os.path.join(BENCH_DIR, 'stubs', 'gpp')
+STUB_KTRANS = os.path.join(BENCH_DIR, 'stubs', 'ktrans')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+PHASES = ('make_classes', 'write_manifest', 'dependencies', 'deps_only', 'ktrans')
+
+
+class Counters(object):
+    """counts the subprocesses started while installed"""
+
+    def __init__(self):
+        self.subprocesses = 0
+
+    def __enter__(self):
+        real_popen = self._real_popen = subprocess.Popen
+        counters = self
+
+        class CountingPopen(real_popen):
+            def __init__(self, *args, **kwargs):
+                counters.subprocesses += 1
+                real_popen.__init__(self, *args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen = self._real_popen
+        return False
+
+
+def tree_size(path):
+    total = 0
+    for (dirpath, _, files) in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+    return total
+
+
+def measure(fn, out_dir):
+    """run 'fn', which writes into 'out_dir' only"""
+    before = tree_size(out_dir)
+    with Counters() as counters:
+        start = time.perf_counter()
+        fn()
+        wall = time.perf_counter() - start
+    return {'wall': wall, 'subprocesses': counters.subprocesses,
+            'bytes': tree_size(out_dir) - before}
+
+
+def cold_start():
+    """forget everything an earlier run left in the process wide caches"""
+    for cache in (ktransw._include_indexes, ktransw._header_cache, ktransw._class_cache,
+                  ktransw._symbol_cache, ktransw._digest_cache):
+        cache.clear()
+
+
+def run_once(sources, include_dirs, opts, root):
+    logger = logging.getLogger('bench')
+    out = {}
+    for phase in PHASES:
+        out[phase] = os.path.join(root, phase)
+        os.makedirs(out[phase])
+    argv = ['-q', '--engine', opts.engine, '--gpp', opts.gpp, '--ktrans', STUB_KTRANS]
+    for d in include_dirs:
+        argv.extend(['-I', d])
+    if opts.pipe:
+        argv.append('--pipe')
+    args = build_parser().parse_args(argv)
+
+    cold_start()
+    outputs = {}
+
+    def preprocess():
+        for src in sources:
+            folder = os.path.join(out['make_classes'], os.path.basename(src))
+            os.makedirs(folder)
+            ctx = CompilationContext(args, logger, folder)
+            make_classes(ctx, src, os.path.join(folder, os.path.basename(src)))
+            outputs[src] = ctx.kl_files
+
+    def manifest():
+        with open(os.path.join(out['write_manifest'], FILE_MANIFEST), 'w') as f:
+            yaml.dump({'karel': {}}, f)
+        for src in sources:
+            write_manifest(FILE_MANIFEST, [os.path.basename(f) for f in outputs[src]],
+                os.path.basename(src))
+
+    def dependencies(scan):
+        def run():
+            for src in sources:
+                args.dep_fname = os.path.join(out['deps_only' if scan else 'dependencies'],
+                    os.path.basename(src) + '.d')
+                if scan:
+                    headers = scan_dependencies(src, args)
+                else:
+                    headers = marker_dependencies(outputs[src][-1], args.include_dirs, logger)
+                if output_dependencies(src, headers, args, logger) != 0:
+                    sys.exit("dependency output failed for {0}".format(src))
+        return run
+
+    def translate():
+        for src in sources:
+            args.ktrans_args = [src]
+            if translate_all(outputs[src], args, logger) != 0:
+                sys.exit("ktrans failed for {0}".format(src))
+
+    results = {}
+    cwd = os.getcwd()
+    try:
+        results['make_classes'] = measure(preprocess, out['make_classes'])
+        os.chdir(out['write_manifest'])
+        results['write_manifest'] = measure(manifest, out['write_manifest'])
+        results['dependencies'] = measure(dependencies(False), out['dependencies'])
+        results['deps_only'] = measure(dependencies(True), out['deps_only'])
+        os.chdir(out['ktrans'])
+        results['ktrans'] = measure(translate, out['ktrans'])
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def best_of(results):
+    """the fastest wall time of each phase, with the counts of the last run"""
+    best = dict((phase, dict(results[-1][phase])) for phase in PHASES)
+    for phase in PHASES:
+        best[phase]['wall'] = min(r[phase]['wall'] for r in results)
+    return best
+
+
+def regressions(result, baseline, threshold):
+    found = []
+    for phase in PHASES:
+        (new, old) = (result[phase], baseline.get(phase))
+        if old is None:
+            continue
+        if new['wall'] > old['wall'] * (1 + threshold):
+            found.append('{0}: wall time {1:.1f} ms, was {2:.1f} ms'.format(
+                phase, new['wall'] * 1000, old['wall'] * 1000))
+        if new['bytes'] > old['bytes'] * (1 + threshold):
+            found.append('{0}: wrote {1} bytes, was {2}'.format(phase, new['bytes'], old['bytes']))
+        if new['subprocesses'] > old['subprocesses']:
+            found.append('{0}: started {1} subprocesses, was {2}'.format(
+                phase, new['subprocesses'], old['subprocesses']))
+    return found
+
+
+def scenario_key(params, opts, gpp_label):
+    settings = ['{0}={1}'.format(name, params[name]) for (name, _, _) in workspace.PARAMS]
+    settings.extend(['engine=' + opts.engine, 'gpp=' + gpp_label, 'pipe={0}'.format(opts.pipe)])
+    return ','.join(settings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    workspace.add_arguments(parser)
+    parser.add_argument('--engine', choices=('gpp', 'builtin'), default='gpp')
+    parser.add_argument('--pipe', action='store_true')
+    parser.add_argument('--gpp', help='gpp executable (default: gpp on the PATH, '
+        'else stubs/gpp)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='store the results as the baseline for these settings')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='relative increase that counts as a regression (default: %(default)s)')
+    opts = parser.parse_args()
+
+    gpp = opts.gpp or shutil.which('gpp')
+    gpp_label = 'gpp' if gpp else 'stub'
+    opts.gpp = os.path.abspath(gpp) if gpp else STUB_GPP
+    params = dict((name, getattr(opts, name)) for (name, _, _) in workspace.PARAMS)
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='ktransw-bench-') as root:
+        (sources, include_dirs) = workspace.generate(os.path.join(root, 'ws'), **params)
+        runs = []
+        for i in range(opts.repeat):
+            runs.append(run_once(sources, include_dirs, opts, os.path.join(root, 'run{0}'.format(i))))
+    result = best_of(runs)
+
+    key = scenario_key(params, opts, gpp_label)
+    baselines = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(key, {})
+
+    print(key)
+    print("{0:<16} {1:>10} {2:>8} {3:>12} {4:>10}".format(
+        'phase', 'wall ms', 'procs', 'bytes', 'vs base'))
+    for phase in PHASES:
+        r = result[phase]
+        delta = ''
+        if phase in baseline and baseline[phase]['wall'] > 0:
+            delta = '{0:+.0%}'.format(r['wall'] / baseline[phase]['wall'] - 1)
+        print("{0:<16} {1:10.1f} {2:8d} {3:12d} {4:>10}".format(
+            phase, r['wall'] * 1000, r['subprocesses'], r['bytes'], delta))
+
+    if opts.save_baseline:
+        baselines[key] = result
+        with open(opts.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("baseline saved to {0}".format(opts.baseline))
+        return 0
+
+    found = regressions(result, baseline, opts.threshold)
+    for line in found:
+        print("REGRESSION " + line)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
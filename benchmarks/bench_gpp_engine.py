@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Preprocessing throughput of the builtin engine vs. a gpp subprocess.
+
+Generates a workspace of programs sharing a set of headers, then
+preprocesses every program with both engines and reports files/s. When no
+gpp is found on the PATH (or given with --gpp), the subprocess side runs
+pygpp.py as a script instead, which still measures the process start-up
+cost the builtin engine avoids.
+"""
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import pygpp
+from ktransw import setup_gpp_cline
+
+
+HEADER = """%ifndef hdr{n}_h
+%define hdr{n}_h
+%define hdr{n}_scale(x) ((x) * {n})
+%define hdr{n}_limit {n}0
+ROUTINE hdr{n}__run(a : INTEGER) : INTEGER FROM hdr{n}
+%endif
+"""
+
+
+def make_workspace(root, programs, headers, lines):
+    inc = os.path.join(root, 'include')
+    os.makedirs(inc)
+    for n in range(headers):
+        with open(os.path.join(inc, 'hdr{0}.klh'.format(n)), 'w') as f:
+            f.write(HEADER.format(n=n))
+
+    sources = []
+    for p in range(programs):
+        body = ['PROGRAM prog{0}'.format(p)]
+        body.extend('%include hdr{0}.klh'.format(n) for n in range(headers))
+        body.append('VAR\n  i : INTEGER\nBEGIN')
+        for l in range(lines):
+            n = l % headers
+            body.append('  i = hdr{0}_scale(i + {1}) + hdr{0}_limit'.format(n, l))
+        body.append('END prog{0}\n'.format(p))
+        path = os.path.join(root, 'prog{0}.kl'.format(p))
+        with open(path, 'w') as f:
+            f.write('\n'.join(body))
+        sources.append(path)
+    return sources, [inc]
+
+
+def run_builtin(sources, include_dirs, out_dir):
+    for src in sources:
+        pygpp.preprocess(src, os.path.join(out_dir, os.path.basename(src)),
+            include_dirs, [])
+
+
+def run_subprocess(gpp_cmd, sources, include_dirs, out_dir):
+    for src in sources:
+        cline = setup_gpp_cline('gpp', src, os.path.join(out_dir, os.path.basename(src)),
+            include_dirs, [])
+        subprocess.check_call(gpp_cmd + shlex.split(' '.join(cline))[1:])
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--programs', type=int, default=50)
+    parser.add_argument('--headers', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=200)
+    parser.add_argument('--gpp', help='gpp executable to compare against')
+    args = parser.parse_args()
+
+    gpp = args.gpp or shutil.which('gpp')
+    if gpp:
+        gpp_cmd = [gpp]
+        label = 'gpp'
+    else:
+        gpp_cmd = [sys.executable, os.path.join(BIN_DIR, 'pygpp.py')]
+        label = 'pygpp.py (no gpp found)'
+
+    with tempfile.TemporaryDirectory(prefix='ktransw-bench-') as root:
+        sources, include_dirs = make_workspace(root, args.programs, args.headers, args.lines)
+        out_dir = os.path.join(root, 'out')
+        os.makedirs(out_dir)
+
+        t_sub = timed(run_subprocess, gpp_cmd, sources, include_dirs, out_dir)
+        t_builtin = timed(run_builtin, sources, include_dirs, out_dir)
+
+    n = len(sources)
+    print("{0:<28} {1:8.3f} s {2:10.1f} files/s".format('subprocess ' + label, t_sub, n / t_sub))
+    print("{0:<28} {1:8.3f} s {2:10.1f} files/s".format('builtin', t_builtin, n / t_builtin))
+    print("speedup: {0:.1f}x".format(t_sub / t_builtin))
+
+
+if __name__ == '__main__':
+    main()
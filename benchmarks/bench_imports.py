@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""'%from .. %import' on large headers: one search per symbol vs. one per line.
+
+Builds a header declaring thousands of routines (5000 by default, some of
+them continued over several lines) and imports hundreds of them (300 by
+default). It then picks out their declarations three ways: the way ktransw
+0.2.3 did, with a findWholeWord() search per symbol on every line; with
+scan_declarations(), which searches each line once for all symbols; and
+with the HeaderSymbols index --cache-dir uses, parse included.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+from ktransw import NAMESPACE_DEFINES, HeaderSymbols, _declaration, scan_declarations
+
+
+def make_header(routines):
+    lines = ['%define prog_name big\n', '%define prog_name_alias bg\n']
+    for i in range(routines):
+        if i % 10 == 0:
+            lines.append('ROUTINE big__op{0}(a : INTEGER; &\n'.format(i))
+            lines.append('  b : INTEGER) : INTEGER FROM big\n')
+        else:
+            lines.append('ROUTINE big__op{0}(a : INTEGER) : INTEGER FROM big\n'.format(i))
+        if i % 50 == 0:
+            lines.append('-- op{0} and op{1} share their implementation\n'.format(i, i + 1))
+    return lines
+
+
+# -- the way ktransw 0.2.3 did it ------------------------------------------
+
+def findWholeWord(w):
+    return re.compile(r'(?:\b|_)({0})(?:\b)'.format(w), flags=re.IGNORECASE).search
+
+
+def legacy(lines, funcs):
+    insert_string = '%include namespace.m' + '\n'
+    for j in range(len(lines)):
+        if any(nspace in lines[j] for nspace in NAMESPACE_DEFINES):
+            insert_string += lines[j]
+        if any(findWholeWord(func)(lines[j]) for func in funcs):
+            insert_string += _declaration(lines, j)
+    return insert_string
+
+
+# --------------------------------------------------------------------------
+
+def indexed(lines, funcs):
+    return HeaderSymbols.parse(lines).declarations(funcs)
+
+
+def best_of(repeat, fn, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--routines', type=int, default=5000)
+    parser.add_argument('--symbols', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = make_header(args.routines)
+    funcs = ['op{0}'.format(i) for i in random.Random(0).sample(range(args.routines),
+        min(args.symbols, args.routines))]
+
+    t_legacy, expected = best_of(args.repeat, legacy, lines, funcs)
+    t_single, result = best_of(args.repeat, scan_declarations, lines, funcs)
+    if result != expected:
+        sys.exit("scan_declarations output differs")
+    t_index, result = best_of(args.repeat, indexed, lines, funcs)
+    if result != expected:
+        sys.exit("HeaderSymbols output differs")
+
+    print("{0} header lines, {1} routines, {2} symbols imported".format(
+        len(lines), args.routines, len(funcs)))
+    print("{0:<12} {1:10.1f} ms".format('per-symbol', t_legacy * 1000))
+    print("{0:<12} {1:10.1f} ms".format('single-pass', t_single * 1000))
+    print("{0:<12} {1:10.1f} ms".format('index', t_index * 1000))
+    print("speedup: {0:.1f}x".format(t_legacy / t_single))
+
+
+if __name__ == '__main__':
+    main()
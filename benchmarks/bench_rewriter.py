@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""The post-gpp fixups: fused rewriter vs. one file rewrite per fixup.
+
+Builds a preprocessed program (50k lines by default) with blank lines,
+leftover backticks, %class instantiations and %from imports. It then
+applies the fixups make_classes needs after the first gpp pass, twice:
+once with rewrite_lines(), and once the way ktransw 0.2.3 did it, where
+each fixup reopens and rewrites the file and every header marker scans
+all objects and rereads the header.
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import ktransw
+from ktransw import HeaderIndex, findWholeWord, rewrite_lines
+
+
+def make_program(lines, classes, imports):
+    body = ['PROGRAM big']
+    for c in range(classes):
+        body.append("%class obj{0}('stack.klc','stack.klh')".format(c))
+    for i in range(imports):
+        body.append('%from math.klh %import add, sub')
+    n = 0
+    while len(body) < lines:
+        body.append('  i = i + {0}'.format(n))
+        body.append('')
+        body.append('  `%define alias{0} func{0}`'.format(n))
+        n += 1
+    body.append('END big')
+    return '\n'.join(body) + '\n'
+
+
+def make_headers(root, classes):
+    with open(os.path.join(root, 'math.klh'), 'w') as f:
+        f.write('%define prog_name math\n')
+        for i in range(50):
+            f.write('ROUTINE math__op{0}(a : INTEGER) : INTEGER FROM math\n'.format(i))
+        f.write('ROUTINE math__add(a : INTEGER) : INTEGER FROM math\n')
+        f.write('ROUTINE math__sub(a : INTEGER) : INTEGER FROM math\n')
+    headers = []
+    for c in range(classes):
+        path = os.path.join(root, 'pre-obj{0}.klh'.format(c))
+        with open(path, 'w') as f:
+            f.write('ROUTINE obj{0}__push(v : INTEGER) FROM obj{0}\n'.format(c))
+        headers.append(path)
+    return headers
+
+
+def fused(text, root, headers):
+    classes = []
+    used = []
+    lines = rewrite_lines(text.splitlines(True), blank_lines=True, char='`',
+        classes=classes, include_dirs=[root], used_headers=used)
+    return rewrite_lines(lines, headers=HeaderIndex(headers, classes))
+
+
+# -- the way ktransw 0.2.3 applied them ------------------------------------
+
+def legacy_rewrite(fname, fn):
+    with open(fname, 'r+') as f:
+        lines = fn(f.readlines())
+        f.seek(0)
+        f.write(''.join(lines))
+        f.truncate()
+
+
+def legacy_classes(lines, objects):
+    pattern = r"(?:\%class\s*)(\w+)\s*\(\s*'(\w+.\w+)'(?:\s*,\s*'(\w+.\w+)')(?:\s*,\s*'(\w+.\w+)')*\s*\)"
+    k = 1
+    for i in range(len(lines)):
+        m = re.match(pattern, lines[i])
+        if m:
+            objects.append([k] + [m.group(j) for j in range(1, m.lastindex + 1)])
+            lines[i] = "-- INCLUDE_MARKER {0}:{1}:1\n".format(k, m.group(1))
+            k += 1
+    return lines
+
+
+def isLineCont(prog, idx, out_string):
+    line = prog[idx].rstrip()
+    if line[-1] == '&':
+        out_string += prog[idx+1]
+    return out_string
+
+
+def legacy_selective(lines, root):
+    pattern = r"(?:\%from\s*)([a-zA-Z_.0-9]*)(?:\s*\%import\s*)(\w+,?(\s*\w+,?)*)"
+    for i in range(len(lines)):
+        m = re.match(pattern, lines[i])
+        if m:
+            with open(os.path.join(root, m.group(1))) as h:
+                h_line = h.readlines()
+            insert_string = '%include namespace.m\n'
+            funcs = m.group(2).replace(" ", "").split(',')
+            for j in range(len(h_line)):
+                if any(n in h_line[j] for n in ['%define prog_name', '%define prog_name_alias']):
+                    insert_string += h_line[j]
+                if any(findWholeWord(func)(h_line[j]) for func in funcs):
+                    insert_string += h_line[j]
+                    insert_string = isLineCont(h_line, j, insert_string)
+            lines[i] = insert_string
+    return lines
+
+
+def legacy_headers(lines, headers, objects):
+    pattern = r"(?:--\s*INCLUDE_MARKER\s*(\d+)\:(\w+)\:1)"
+    for i in range(len(lines)):
+        m = re.match(pattern, lines[i])
+        if m:
+            for obj in objects:
+                if str(obj[0]) == m.group(1) and obj[1] == m.group(2):
+                    search = m.group(2) + '.klh'
+                    fle = [hdr for hdr in headers if search in os.path.basename(hdr)][0]
+                    with open(fle, "r") as h:
+                        lines[i] = h.read()
+                    break
+    return lines
+
+
+def legacy(text, root, headers):
+    fname = os.path.join(root, 'pre-big.kl')
+    with open(fname, 'w') as f:
+        f.write(text)
+    objects = []
+    legacy_rewrite(fname, lambda lines: [l for l in lines if l.strip() != ""])
+    legacy_rewrite(fname, lambda lines: ''.join(lines).replace('`', '').splitlines(True))
+    legacy_rewrite(fname, lambda lines: legacy_classes(lines, objects))
+    legacy_rewrite(fname, lambda lines: legacy_selective(lines, root))
+    legacy_rewrite(fname, lambda lines: legacy_headers(lines, headers, objects))
+    with open(fname) as f:
+        return f.readlines()
+
+
+def best_of(repeat, fn, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--imports', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='ktransw-bench-') as root:
+        text = make_program(args.lines, args.classes, args.imports)
+        headers = make_headers(root, args.classes)
+
+        t_legacy, expected = best_of(args.repeat, legacy, text, root, headers)
+        # start from a cold header cache, like a fresh ktransw process
+        ktransw._header_cache.clear()
+        t_fused, result = best_of(args.repeat, fused, text, root, headers)
+        if ''.join(result) != ''.join(expected):
+            sys.exit("outputs differ")
+
+    print("{0} lines, {1} classes, {2} imports".format(
+        len(text.splitlines()), args.classes, args.imports))
+    print("{0:<10} {1:8.1f} ms".format('per-file', t_legacy * 1000))
+    print("{0:<10} {1:8.1f} ms".format('fused', t_fused * 1000))
+    print("speedup: {0:.1f}x".format(t_legacy / t_fused))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Synthetic KAREL workspace for the benchmarks.
+
+Every program includes 'headers' header chains, each 'depth' headers
+deep, instantiates 'classes' objects of a templated class and pulls
+routines out of 'imports' libraries with '%from .. %import'. 'lines' and
+'decls' set the size of the programs and of each header.
+
+Run as a script to generate one into a directory.
+"""
+
+import argparse
+import os
+
+
+# (name, default, help), in the order of the command line
+PARAMS = (
+    ('programs', 10, 'number of programs'),
+    ('headers', 5, 'header chains every program includes'),
+    ('depth', 3, 'headers per chain, each including the next'),
+    ('classes', 3, '%%class objects every program instantiates'),
+    ('imports', 2, "libraries every program uses '%%from .. %%import' on"),
+    ('lines', 200, 'statements per program'),
+    ('decls', 20, 'routine declarations per header'),
+)
+
+CLASS_SOURCE = """PROGRAM class_name
+VAR
+  items : ARRAY[32] OF stack_type
+  top : INTEGER
+ROUTINE push(v : stack_type)
+BEGIN
+  top = top + 1
+  items[top] = v
+END push
+BEGIN
+END class_name
+"""
+
+CLASS_HEADER = """ROUTINE push(v : stack_type) FROM class_name
+"""
+
+
+def defaults():
+    return dict((name, default) for (name, default, _) in PARAMS)
+
+
+def add_arguments(parser):
+    for (name, default, help) in PARAMS:
+        parser.add_argument('--' + name, type=int, default=default,
+            help=help + ' (default: {0})'.format(default))
+
+
+def generate(root, programs=10, headers=5, depth=3, classes=3, imports=2,
+             lines=200, decls=20):
+    """write a workspace into 'root', returning (sources, include_dirs)"""
+    inc = os.path.join(root, 'include')
+    os.makedirs(inc)
+
+    def write(name, text):
+        with open(os.path.join(inc, name), 'w') as f:
+            f.write(text)
+
+    write('namespace.m', '%define namespace_m\n')
+    for h in range(headers):
+        for d in range(depth):
+            body = ['%ifndef chain{0}_{1}_h'.format(h, d),
+                    '%define chain{0}_{1}_h'.format(h, d)]
+            if d + 1 < depth:
+                body.append('%include chain{0}_{1}.klh'.format(h, d + 1))
+            body.append('%define chain{0}_{1}_limit {2}'.format(h, d, d + 1))
+            body.extend('ROUTINE chain{0}_{1}__op{2}(a : INTEGER) : INTEGER FROM chain{0}_{1}'
+                .format(h, d, n) for n in range(decls))
+            body.append('%endif')
+            write('chain{0}_{1}.klh'.format(h, d), '\n'.join(body) + '\n')
+
+    for i in range(imports):
+        body = ['%define prog_name lib{0}'.format(i)]
+        body.extend('ROUTINE lib{0}__op{1}(a : INTEGER; &\n  b : INTEGER) : INTEGER FROM lib{0}'
+            .format(i, n) for n in range(decls))
+        write('lib{0}.klh'.format(i), '\n'.join(body) + '\n')
+
+    write('stack.klc', CLASS_SOURCE)
+    write('stack.klh', CLASS_HEADER)
+    write('int.klt', '%define stack_type INTEGER\n')
+
+    sources = []
+    for p in range(programs):
+        body = ['PROGRAM prog{0}'.format(p)]
+        body.extend('%include chain{0}_0.klh'.format(h) for h in range(headers))
+        body.extend("%class stk{0}('stack.klc','stack.klh','int.klt')".format(c)
+            for c in range(classes))
+        body.extend('%from lib{0}.klh %import op0, op{1}'.format(i, decls - 1)
+            for i in range(imports))
+        body.append('VAR\n  i : INTEGER\nBEGIN')
+        for n in range(lines):
+            body.append('  i = i + {0}'.format(n))
+            if n % 10 == 0:
+                body.append('')
+        body.append('END prog{0}\n'.format(p))
+        path = os.path.join(root, 'prog{0}.kl'.format(p))
+        with open(path, 'w') as f:
+            f.write('\n'.join(body))
+        sources.append(path)
+    return sources, [inc]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='directory to create')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    root = args.pop('root')
+    (sources, _) = generate(root, **args)
+    print("{0} programs in {1}".format(len(sources), root))
+
+
+if __name__ == '__main__':
+    main()
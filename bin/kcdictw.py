@@ -21,7 +21,8 @@ import subprocess
 import shutil
 import logging
 import re
-import yaml
+
+from ktransw import ManifestStore, TemporaryDirectory, available_cpus, jobserver
 
 KCDICTW_VERSION='0.0.1'
 KCDICT_BIN_NAME='kcdict.exe'
@@ -41,21 +42,19 @@ EXT_MAP = {
       '.utx' : {'conversion' : '.tx'}
     }
 
-#store files to run through kcdict
-dict_files = []
-#list to store header injections
-header_injections = []
-
-def main():
+def main(argv=None):
   """Shell wrapper for compressing .utx of .ftx files in a rossum environment
   """
+  if argv is None:
+    argv = sys.argv[1:]
 
   description=("Version {0}\n\n"
         "A wrapper around FANUC's kcdict compressor ({1})\n"
             .format(KCDICTW_VERSION, KCDICT_BIN_NAME))
 
   epilog=("Usage example:\n\n"
-        "  kcdict <name>.utx <output_name>.tx /IC:\\baz\\include /config robot.ini")
+        "  kcdict <name>.utx <output_name>.tx /IC:\\baz\\include /config robot.ini\n\n"
+        "Multiple .utx/.ftx files are compressed in parallel.")
 
   parser = argparse.ArgumentParser(prog='kcdictw', description=description,
         epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -76,92 +75,158 @@ def main():
           "Windows PATH)")
   parser.add_argument('-I', action='append', type=str, dest='include_dirs',
         metavar='PATH', default=[], help='Include paths (multiple allowed)')
+  parser.add_argument('-j', '--jobs', type=int, dest='jobs', metavar='N',
+        default=available_cpus(), help="Number of files to compress in parallel "
+            "when given more than one, unless make or ninja provides a "
+            "jobserver (default: number of CPUs)")
   parser.add_argument('kcdict_args', type=str, nargs='*', metavar='ARG',
         help="Arguments to pass on to kcdict. Use normal (forward-slash) "
         "notation here")
-  
+
   # support forward-slash arg notation for include dirs
-  for i in range(1, len(sys.argv)):
-      if sys.argv[i].startswith('/I'):
-          sys.argv[i] = sys.argv[i].replace('/I', '-I', 1)
-  args = parser.parse_args()
-
-  # we expect ktrans to be on the path. If it's not, user should have
-  # provided an alternative location
-  kcdict_path = os.path.abspath(args.kcdict_path) if args.kcdict_path else KCDICT_BIN_NAME
-
-  # we expect gpp to be on the path. If it's not, user should have
-  # provided an alternative location
-  gpp_path = os.path.abspath(args.gpp_path) if args.gpp_path else GPP_BIN_NAME
-
-  # extract args which refer to KAREL sources: we can just search for
-  # arguments with '.kl' in it, as ktrans only considers files with that
-  # extension.
+  argv = list(argv)
+  for i in range(0, len(argv)):
+      if argv[i].startswith('/I'):
+          argv[i] = argv[i].replace('/I', '-I', 1)
+  args = parser.parse_args(argv)
+
+  # extract args which refer to dictionary and form sources
   pre_gpp_files = []
   for arg in args.kcdict_args:
     if arg.endswith(FORM_SUFFIX) or arg.endswith(DICT_SUFFIX):
       pre_gpp_files.append(arg)
-  
-  # assume there's only one input source file (or: we ignore all others)
-  kl_file = pre_gpp_files[0]
 
+  if not pre_gpp_files:
+    sys.stderr.write("kcdictw: fatal error: no {0} or {1} file given\n".format(
+      DICT_SUFFIX, FORM_SUFFIX))
+    sys.exit(_OS_EX_DATAERR)
+
+  if len(pre_gpp_files) == 1:
+    (ret_code, entry) = compile_dictionary(pre_gpp_files[0], args)
+    entries = [entry]
+  else:
+    if [arg for arg in args.kcdict_args if arg.endswith(COMPRESSED_SUFFIX)]:
+      sys.stderr.write("kcdictw: fatal error: can't name the {0} file when "
+        "compressing multiple files\n".format(COMPRESSED_SUFFIX))
+      sys.exit(_OS_EX_DATAERR)
+    (ret_code, entries) = compile_batch(pre_gpp_files, args)
+
+  #store dict files and vr definitions of all inputs in manifest, at once
+  for entry in entries:
+    if entry:
+      write_manifest(FILE_MANIFEST, entry[1], entry[0], export=False)
+  ManifestStore(FILE_MANIFEST).export()
+
+  sys.exit(ret_code)
+
+
+def compile_batch(sources, args):
+  """compile_dictionary() every one of 'sources' on a pool of worker
+     processes, each taking a job slot first. Returns the first non-zero
+     exit code (if any) and the manifest entries
+  """
+  from concurrent.futures import ProcessPoolExecutor
+
+  slots = jobserver(args)
+  with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    futures = []
+    for dict_file in sources:
+      token = slots.acquire()
+      future = pool.submit(_compile_batch_source, dict_file, args)
+      future.add_done_callback(lambda _, token=token: slots.release(token))
+      futures.append(future)
+
+    rets = []
+    entries = []
+    for future in futures:
+      # relay output of every file as a whole
+      (ret, entry, out, err) = future.result()
+      sys.stdout.write(out)
+      sys.stderr.write(err)
+      rets.append(ret)
+      entries.append(entry)
+
+  failed = [ret for ret in rets if ret != 0]
+  return (failed[0] if failed else 0, entries)
+
+
+def _compile_batch_source(dict_file, args):
+  """compile_dictionary() for one file of a batch, inside a pool worker"""
+  import copy
+  import io
+  import traceback
+  from contextlib import redirect_stderr, redirect_stdout
+
+  args = copy.copy(args)
+  # kcdict gets to see this file only
+  args.kcdict_args = [a for a in args.kcdict_args
+    if not (a.endswith(FORM_SUFFIX) or a.endswith(DICT_SUFFIX)) or a == dict_file]
+
+  (out, err) = (io.StringIO(), io.StringIO())
+  entry = None
+  with redirect_stdout(out), redirect_stderr(err):
+    try:
+      (ret, entry) = compile_dictionary(dict_file, args)
+    except SystemExit as e:
+      ret = e.code if isinstance(e.code, int) else 1
+    except Exception:
+      traceback.print_exc()
+      ret = 1
+  return (ret, entry, out.getvalue(), err.getvalue())
+
+
+def compile_dictionary(dict_file, args):
+  """preprocess and compress a single dictionary or form, copying the
+     results into place. Returns the exit code of kcdict and the manifest
+     entry of 'dict_file' as (parent, files), or None if there is none
+  """
   # create temporary directory to store preprocessed file in. We
   # avoid problems with temporary files (via NamedTemporaryFile fi) being
   # not readable by other processes in this way.
   with TemporaryDirectory(prefix='kcdictw-', suffix='-buildd', do_clean=(not args.keep_buildd)) as dname:
-    fname = os.path.join(dname, os.path.basename(kl_file))
+    fname = os.path.join(dname, os.path.basename(dict_file))
 
-    pre_file = os.path.join(dname, 'pre-' + os.path.basename(kl_file))
-    run_gpp(kl_file, pre_file, args)
+    pre_file = os.path.join(dname, 'pre-' + os.path.basename(dict_file))
+    run_gpp(dict_file, pre_file, args)
     remove_blank_lines(pre_file)
     #do final gpp pass
     run_gpp(pre_file, fname, args)
 
-    #append processed file to ktrans list
-    dict_files.append(fname)
-
-    # target name we use is 'base source file name + .pc', OR the name
-    # provided as a command line arg
-    base_source_name = os.path.basename(os.path.splitext(kl_file)[0])
-    target = dname + '\\' + base_source_name + COMPRESSED_SUFFIX
+    # target name we use is 'base source file name + .tx'
+    base_source_name = os.path.basename(os.path.splitext(dict_file)[0])
+    target = os.path.join(dname, base_source_name + COMPRESSED_SUFFIX)
     # get include folder of local repository to plave .kl files in.
     # These are needed for the karel programs that accompany the .ftx file
     kl_dir = ''
     for inc in args.include_dirs:
-      if os.path.abspath(os.path.join(inc, os.pardir)) in os.path.abspath(kl_file):
+      if os.path.abspath(os.path.join(inc, os.pardir)) in os.path.abspath(dict_file):
         kl_dir = inc
-    
+
     if not kl_dir:
       sys.stdout.write('No parent include directory detected. Add include folder.')
-      sys.exit(0)
+      return (0, None)
 
     # output only pre-processed source if user asked for that
     if args.output_ppd_source:
         with open(fname, 'r') as inf:
             sys.stdout.write(inf.read())
-        sys.exit(0)
+        return (0, None)
 
-    for i in range(0, len(dict_files)):
-      ret_code = run_kcdict(dict_files[i], args, dname)
+    ret_code = run_kcdict(fname, args, dname)
 
-    file_list = [os.path.split(f)[-1] for f in dict_files]
-    # copy .tx file, .vr file to cwd
+    file_list = [os.path.basename(fname)]
+    # copy .tx file, .vr file to cwd and all kl files to the include
+    # folder, in a single pass over the build dir
     shutil.copy(target, os.getcwd())
-    for file in os.listdir(dname):
-      if file.endswith(".vr"):
-        shutil.copy(dname + '\\' + file, os.getcwd())
+    for entry in os.scandir(dname):
+      if entry.name.endswith(".vr"):
+        shutil.copy(entry.path, os.getcwd())
         # add to file manifest
-        file_list.append(file)
-    
-    #copy all kl files to first include folder
-    for file in os.listdir(dname):
-      if file.lower().endswith(".kl"):
-        shutil.copy(dname + '\\' + file, kl_dir)
-    
-    #store dict files and vr definitions in manifest
-    write_manifest(FILE_MANIFEST, file_list, os.path.split(kl_file)[-1])
-    
-    sys.exit(ret_code)
+        file_list.append(entry.name)
+      elif entry.name.lower().endswith(".kl"):
+        shutil.copy(entry.path, kl_dir)
+
+    return (ret_code, (os.path.basename(dict_file), file_list))
 
 
 GPP_OP_ENTER='1'
@@ -200,6 +265,10 @@ def run_gpp(inpt, outpt, args):
     # TODO: why do we need to do this ourselves? gpp doesn't run
     #       correctly if we don't, but it shouldn't matter?
     gpp_cmdline = ' '.join(gpp_cmdline)
+    if os.name != 'nt':
+        # no CreateProcess to split the command line for us
+        import shlex
+        gpp_cmdline = shlex.split(gpp_cmdline)
 
     # invoke gpp and save output
     gpp_proc = subprocess.Popen(gpp_cmdline, stdout=subprocess.PIPE,
@@ -237,6 +306,9 @@ def run_kcdict(inpt, args, temp_dir):
     ktrans_cmdline = ['"{0}"'.format(ktrans_path)]
     ktrans_cmdline.extend(ktrans_args)
     ktrans_cmdline = ' '.join(ktrans_cmdline)
+    if os.name != 'nt':
+        import shlex
+        ktrans_cmdline = shlex.split(ktrans_cmdline)
 
     # NOTE: we remap stderr to stdout as ktrans doesn't use those
     # consistently (ie: uses stderr when it should use stdout and
@@ -254,9 +326,7 @@ def run_kcdict(inpt, args, temp_dir):
 
     return ktrans_proc.returncode
 
-def write_manifest(manifest, files, parent):
-
-    file_list = dict()
+def write_manifest(manifest, files, parent, export=True):
 
     #remove parent from files
     children = [f for f in files if f not in parent]
@@ -270,31 +340,12 @@ def write_manifest(manifest, files, parent):
     if os.path.splitext(parent)[-1] in EXT_MAP.keys():
       parent = os.path.splitext(parent)[0] + EXT_MAP[os.path.splitext(parent)[-1]]['conversion']
     
-    if os.path.exists(manifest):
-      with open(manifest) as man:
-        file_list = yaml.load(man, Loader=yaml.FullLoader)
-    
-    vals = {}
-    found = False
-    for key in file_list.keys():
-      if (key in DATA_TYPES) and isinstance(file_list[key], dict):
-        sub_dict = file_list[key]
-        if parent in sub_dict.keys():
-          #retrieve list
-          vals = set(sub_dict[parent])
-          vals.update(set(children))
-          file_list[key][parent] = list(vals)
-          found = True
-
-    #insert into dictionary if parent not in manifest
-    if found == False:
-      file_list['forms'] = {}
-      vals = set(children)
-      file_list['forms'][parent] = list(vals)
-
-    #save back to yaml file
-    with open(manifest, 'w') as man:
-      yaml.dump(file_list, man)
+    #journal the update and merge it into the manifest, unless the
+    #caller exports once it's done with all of its updates
+    store = ManifestStore(manifest)
+    store.record(parent, children, DATA_TYPES)
+    if export:
+      store.export()
 
 
 def find_hdr_in_incdirs(header, include_dirs):
@@ -371,71 +422,6 @@ def setup_gpp_cline(gpp_exe, src_file, dest_file, include_dirs):
     return gpp_cmdline
 
 
-class TemporaryDirectory(object):
-    # http://stackoverflow.com/a/19299884
-    def __init__(self, suffix="", prefix="tmp", dir=None, do_clean=True):
-        from tempfile import mkdtemp
-        self._closed = False
-        self._do_clean = do_clean
-        self.name = None
-        self.name = mkdtemp(suffix, prefix, dir)
-
-    def __repr__(self):
-        return "<{} {!r}>".format(self.__class__.__name__, self.name)
-
-    def __enter__(self):
-        return self.name
-
-    def cleanup(self, _warn=False):
-        if self.name and not self._closed and self._do_clean:
-            try:
-                self._rmtree(self.name)
-            except (TypeError, AttributeError) as ex:
-                if "None" not in str(ex):
-                    raise
-                print("ERROR: {!r} while cleaning up {!r}".format(ex, self,),
-                      file=_sys.stderr)
-                return
-            self._closed = True
-            if _warn:
-                self._warn("Implicitly cleaning up {!r}".format(self),
-                           ResourceWarning)
-
-    def __exit__(self, exc, value, tb):
-        self.cleanup()
-
-    def __del__(self):
-        self.cleanup(_warn=True)
-
-    _listdir = staticmethod(os.listdir)
-    _path_join = staticmethod(os.path.join)
-    _isdir = staticmethod(os.path.isdir)
-    _islink = staticmethod(os.path.islink)
-    _remove = staticmethod(os.remove)
-    _rmdir = staticmethod(os.rmdir)
-    import warnings as _warnings
-    _warn = _warnings.warn
-
-    def _rmtree(self, path):
-        for name in self._listdir(path):
-            fullname = self._path_join(path, name)
-            try:
-                isdir = self._isdir(fullname) and not self._islink(fullname)
-            except OSError:
-                isdir = False
-            if isdir:
-                self._rmtree(fullname)
-            else:
-                try:
-                    self._remove(fullname)
-                except OSError:
-                    pass
-        try:
-            self._rmdir(path)
-        except OSError:
-            pass
-
-
 if __name__ == '__main__':
     main()
 
@@ -14,4 +14,9 @@ REM WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 REM See the License for the specific language governing permissions and
 REM limitations under the License.
 REM
-python "%~dp0\ktransw.py" %*
+REM the zipapp make_zipapp.py builds starts faster, if there is one
+if exist "%~dp0\ktransw.pyz" (
+  python "%~dp0\ktransw.pyz" %*
+) else (
+  python "%~dp0\ktransw.py" %*
+)
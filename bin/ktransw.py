@@ -18,13 +18,15 @@ from __future__ import print_function
 
 import os
 import sys
-import time
 import argparse
-import subprocess
 import logging
 import re
-import yaml
-from shutil import copyfile
+import json
+import threading
+import time
+# yaml, subprocess, hashlib and shutil are imported where they're used:
+# a ktrans passthrough or a dry run shouldn't pay for them. See
+# tests/test_startup.py
 
 KTRANSW_VERSION='0.2.3'
 KTRANS_BIN_NAME='ktrans.exe'
@@ -34,6 +36,22 @@ KL_SUFFIX = '.kl'
 PCODE_SUFFIX = '.pc'
 
 FILE_MANIFEST = '.man_log'
+# a pygpp.MacroSnapshot, written by --precompile
+SNAPSHOT_SUFFIX = '.kpm'
+# where KtransStamp records what a .pc was translated from, next to the .pc
+STAMP_DIR = '.ktransw_stamps'
+# the --build-dir made by --ram-build-dir, in $KTRANSW_RAM_DIR (or /dev/shm)
+RAM_BUILD_DIR = 'ktransw-build'
+# temporary build dirs are renamed to this on exit, see discard_dir()
+TRASH_SUFFIX = '.trash'
+# what processes that didn't get to delete theirs left behind is swept from
+# the temp dir at most this often (seconds), see _sweep_trash()
+TRASH_SWEEP_INTERVAL = 3600
+TRASH_SWEEP_STAMP = 'ktransw-trash.sweep'
+# where 'ktransw build' records how long every program took, see BuildHistory
+HISTORY_FILE = '.ktransw_history.json'
+
+LOG_FMT='%(levelname)-8s | %(message)s'
 
 DATA_TYPES = ('karel', 'src', 'test', 'interface')
 EXT_MAP = {
@@ -43,14 +61,37 @@ EXT_MAP = {
       '.utx' : {'conversion' : '.tx'}
     }
 
-#store files to run through ktrans
-kl_files = []
-#list to hold class injection points
-class_injections = []
-#list to store header injections
-header_injections = []
-
-def main():
+# warm caches. These live for the lifetime of the process, which for a
+# normal invocation is a single compile, but in '--server' mode spans
+# every request a worker handles.
+#
+#   include_dirs -> IncludeIndex
+_include_indexes = {}
+#   path -> (stat signature, lines)
+_header_cache = {}
+#   class object key -> _ClassExpansion
+_class_cache = {}
+#   header digest -> HeaderSymbols
+_symbol_cache = {}
+
+#   path -> (stat signature, sha1 of contents)
+_digest_cache = {}
+#   --pch file -> (stat signature, MacroSnapshot or None)
+_snapshot_files = {}
+
+# file the server publishes its address and auth token in
+SERVER_STATE_FILE = os.path.join(os.path.expanduser('~'), '.ktransw', 'server.json')
+
+_parser = None
+# the Tracer of a '--trace' compile, see start_trace()
+_tracer = None
+# the Jobserver of this process, see jobserver()
+_jobserver = None
+
+def build_parser():
+    global _parser
+    if _parser is not None:
+        return _parser
 
     description=("Version {0}\n\n"
         "A wrapper around Fanuc Robotics' command-line Karel translator ({1})\n"
@@ -60,7 +101,12 @@ def main():
 
     epilog=("Example invocation:\n\n  ktransw /IC:\\foo\\bar\\include "
         "/IC:\\baz\\include C:\\my_prog.kl /config robot.ini\n\nAll arguments "
-        "using forward-slash notation (except '/I') are passed on\nto ktrans.")
+        "using forward-slash notation (except '/I') are passed on\nto ktrans. "
+        "Arguments can also be read from a response file: @FILE\n(one per line). "
+        "Multiple sources are compiled in parallel.\n\n"
+        "  ktransw build [options] [DIR|SOURCE ...] [/config robot.ini]\n\n"
+        "compiles every KAREL program in the DIRs (default: the current dir),\n"
+        "those that took longest last time first.")
 
     parser = argparse.ArgumentParser(prog='ktransw', description=description,
         epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -91,37 +137,166 @@ def main():
         help="Add a phony target for each dependency to support renaming "
             "dependencies without having to update the Makefile to match")
 
+    parser.add_argument('--deps-only', action='store_true', dest='deps_only',
+        help="Only output the dependency rule (like '-M'), from a scan of the "
+            "%%include, %%class and %%from directives instead of preprocessing")
+
     parser.add_argument('-k', '--keep-build-dir', action='store_true',
         dest='keep_buildd', help="Don't delete the temporary build directory "
             "on exit")
+    parser.add_argument('--build-dir', type=str, dest='build_dir', metavar='DIR',
+        default=os.environ.get('KTRANSW_BUILD_DIR'), help="Keep the "
+            "intermediate files of each target in a subdirectory of DIR that "
+            "later builds reuse, instead of in a new temporary directory "
+            "(default: $KTRANSW_BUILD_DIR)")
+    parser.add_argument('--ram-build-dir', action='store_true',
+        dest='ram_build_dir', default=bool(os.environ.get('KTRANSW_RAM_BUILD_DIR')),
+        help="Without --build-dir, use one on a RAM disk: $KTRANSW_RAM_DIR, "
+            "or /dev/shm if there is one (default: $KTRANSW_RAM_BUILD_DIR)")
     parser.add_argument('--ktrans', type=str, dest='ktrans_path', metavar='PATH',
         help="Location of ktrans (by default ktransw assumes it's on the "
             "Windows PATH)")
     parser.add_argument('--gpp', type=str, dest='gpp_path', metavar='PATH',
         help="Location of gpp (by default ktransw assumes it's on the "
             "Windows PATH)")
+    parser.add_argument('--engine', choices=('gpp', 'builtin'), dest='engine',
+        default='gpp', help="Preprocessor to use: the external gpp (default) "
+            "or the builtin engine, which falls back to gpp for anything it "
+            "doesn't support")
+    parser.add_argument('--precompile', type=str, dest='precompile',
+        metavar='HEADER', help="Snapshot the macros HEADER (found like "
+            "'%%include HEADER' would be) defines into the {0} file named by "
+            "-o, for --pch. With any other -o, write them as a define file "
+            "for gpp instead".format(SNAPSHOT_SUFFIX))
+    parser.add_argument('-o', type=str, dest='precompile_output', metavar='FILE',
+        help="Output of --precompile, and only used with it (default: "
+            "HEADER's name, with {0})".format(SNAPSHOT_SUFFIX))
+    parser.add_argument('--pch', action='append', type=str, dest='pch_files',
+        metavar='FILE', default=[], help="Let the builtin engine take the "
+            "effects of including a header from a --precompile snapshot, "
+            "wherever that gives the same result (multiple allowed)")
+    parser.add_argument('--pipe', action='store_true', dest='pipe',
+        help="Stream the gpp passes through pipes instead of temporary files "
+            "(these are only written with -k)")
     parser.add_argument('-I', action='append', type=str, dest='include_dirs',
         metavar='PATH', default=[], help='Include paths (multiple allowed)')
     parser.add_argument('-D', action='append', type=str, dest='user_macros',
         metavar='PATH', default=[], help='Define user macros from cmd')
+    parser.add_argument('--server', action='store_true', dest='server',
+        help="Run as a long-lived compile server for ktranswc clients")
+    parser.add_argument('--address', type=str, dest='server_address',
+        metavar='HOST:PORT', default='127.0.0.1:0', help="Address the "
+            "compile server listens on (default: a free port on localhost)")
+    parser.add_argument('--workers', type=int, dest='server_workers',
+        metavar='N', default=None, help="Number of compile workers the "
+            "server keeps warm (default: number of CPUs)")
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir', metavar='DIR',
+        default=os.environ.get('KTRANSW_CACHE_DIR'), help="Cache preprocessed "
+            "sources in DIR and reuse them while none of their inputs change "
+            "(default: $KTRANSW_CACHE_DIR, caching is off if unset)")
+    parser.add_argument('--cache-stats', action='store_true', dest='cache_stats',
+        help="Print hit/miss counters and size of the cache and exit")
+    parser.add_argument('--cache-evict', type=str, dest='cache_evict',
+        metavar='SIZE', help="Evict least recently used cache entries until "
+            "the cache is smaller than SIZE (ie: 500M, 2G) and exit")
+    parser.add_argument('--defer-manifest', action='store_true',
+        dest='defer_manifest', default=bool(os.environ.get('KTRANSW_DEFER_MANIFEST')),
+        help="Only journal manifest updates, leave writing {0} to a later "
+            "--export-manifest (default: $KTRANSW_DEFER_MANIFEST)".format(FILE_MANIFEST))
+    parser.add_argument('--export-manifest', action='store_true',
+        dest='export_manifest', help="Merge journaled manifest updates into "
+            "{0} and exit".format(FILE_MANIFEST))
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', metavar='N',
+        default=available_cpus(), help="Number of sources to compile (or class "
+            "objects to expand, or ktrans runs to start) in parallel, unless "
+            "make or ninja provides a jobserver (default: number of CPUs)")
+    parser.add_argument('--batch-report', type=str, dest='batch_report',
+        metavar='FILE', help="When compiling multiple sources, write the exit "
+            "status of each of them to FILE (JSON)")
+    parser.add_argument('--history', type=str, dest='history', metavar='FILE',
+        default=os.environ.get('KTRANSW_HISTORY', HISTORY_FILE), help="Where "
+            "'ktransw build' records how long each program took to compile "
+            "(default: $KTRANSW_HISTORY, or %(default)s)")
+    parser.add_argument('--trace', type=str, dest='trace', metavar='FILE',
+        help="Write a Chrome trace-event file of where the time (and memory) "
+            "went to FILE. Slows down the compile")
     parser.add_argument('ktrans_args', type=str, nargs='*', metavar='ARG',
         help="Arguments to pass on to ktrans. Use normal (forward-slash) "
         "notation here")
 
+    # only compile_karel() translates into anything but the current dir,
+    # and only 'ktransw build' builds
+    parser.set_defaults(output_dir=None, build=False)
+
+    _parser = parser
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    argv = expand_response_files(argv)
+    build = argv[:1] == ['build']
+    if build:
+        argv = argv[1:]
+
     # support forward-slash arg notation for include dirs
-    for i in range(1, len(sys.argv)):
-        if sys.argv[i].startswith('/I'):
-            sys.argv[i] = sys.argv[i].replace('/I', '-I', 1)
-        if sys.argv[i].startswith('/D'):
-            sys.argv[i] = sys.argv[i].replace('/D', '-D', 1)
-    args = parser.parse_args()
+    for i in range(0, len(argv)):
+        if argv[i].startswith('/I'):
+            argv[i] = argv[i].replace('/I', '-I', 1)
+        if argv[i].startswith('/D'):
+            argv[i] = argv[i].replace('/D', '-D', 1)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.precompile_output and not args.precompile:
+        # ktrans names its outputs itself
+        parser.error("-o FILE is only used with --precompile")
+    args.build = build
 
     # configure the logger
-    FMT='%(levelname)-8s | %(message)s'
-    logging.basicConfig(format=FMT, level=logging.INFO)
+    logging.basicConfig(format=LOG_FMT, level=logging.INFO)
     logger = logging.getLogger('ktransw')
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    start_trace(args.trace)
+    try:
+        _main(args, logger)
+    finally:
+        finish_trace()
+
+
+def _main(args, logger):
+    if args.server:
+        sys.exit(serve(args.server_address, args.server_workers, logger))
+
+    if args.cache_stats or args.cache_evict:
+        if not args.cache_dir:
+            sys.stderr.write("ktransw: fatal error: no cache directory configured\n")
+            sys.exit(_OS_EX_DATAERR)
+        cache = BuildCache(args.cache_dir)
+        if args.cache_evict:
+            try:
+                max_size = parse_size(args.cache_evict)
+            except ValueError:
+                sys.stderr.write("ktransw: fatal error: invalid size '{0}'\n".format(args.cache_evict))
+                sys.exit(_OS_EX_DATAERR)
+            removed = cache.evict(max_size)
+            logger.info("Evicted {0} cache entries".format(removed))
+        if args.cache_stats:
+            stats = cache.stats()
+            sys.stdout.write("cache directory: {0}\n".format(args.cache_dir))
+            for key in ('hits', 'misses', 'entries', 'size'):
+                sys.stdout.write("{0}: {1}\n".format(key, stats[key]))
+        sys.exit(0)
+
+    if args.export_manifest:
+        updated = ManifestStore(FILE_MANIFEST).export()
+        logger.debug("Exported {0} manifest entries".format(updated))
+        sys.exit(0)
+
+    if args.precompile:
+        sys.exit(precompile(args, logger))
 
 
     logger.debug("Ktrans Wrapper v{0}".format(KTRANSW_VERSION))
@@ -158,6 +333,8 @@ def main():
         else:
             logger.debug("  {0}: {1}".format(key, val))
 
+    if args.build:
+        sys.exit(build_workspace(args, logger))
 
     # extract args which refer to KAREL sources: we can just search for
     # arguments with '.kl' in it, as ktrans only considers files with that
@@ -178,24 +355,224 @@ def main():
 
         sys.stdout.write("KTRANSW V{}, Copyright (C) 2016 G.A. vd. Hoorn\n"
             .format(KTRANSW_VERSION))
-        ktrans_ret = subprocess.call(ktrans_cmdline)
+        import subprocess
+        if isinstance(sys.stdout, _Capture):
+            # a server request: relay through our own streams, so output
+            # reaches the ktranswc client. ktrans output is not UTF-8
+            ktrans_proc = subprocess.Popen(ktrans_cmdline, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            (pstdout, pstderr) = ktrans_proc.communicate()
+            sys.stdout.write(pstdout.decode('latin-1'))
+            sys.stderr.write(pstderr.decode('latin-1'))
+            ktrans_ret = ktrans_proc.returncode
+        else:
+            sys.stdout.flush()
+            ktrans_ret = subprocess.call(ktrans_cmdline)
 
         logger.debug("End of ktrans, ret: {0}".format(ktrans_ret))
         sys.exit(ktrans_ret)
 
-    # assume there's only one input source file (or: we ignore all others)
-    kl_file = pre_gpp_files[0]
-
     # checks done, can now proceed to actual pre-processing / translation ..
     # .. but only if not requested to do a dry-run
     if args.dry_run:
         logger.debug("Not calling ktrans or gpp: dry run requested")
         sys.exit(0)
 
+    if args.deps_only:
+        sys.exit(compile_deps(pre_gpp_files, args, logger))
+
+    if len(pre_gpp_files) > 1:
+        sys.exit(compile_batch(pre_gpp_files, args, logger))
+
+    sys.exit(compile_source(pre_gpp_files[0], args, logger))
+
+
+def expand_response_files(argv):
+    """replace '@FILE' arguments by the contents of FILE, one argument per line"""
+    expanded = []
+    for arg in argv:
+        if arg.startswith('@') and os.path.isfile(arg[1:]):
+            with open(arg[1:], 'r') as f:
+                expanded.extend([line.strip() for line in f if line.strip()])
+        else:
+            expanded.append(arg)
+    return expanded
+
+
+def compile_karel(source, include_dirs=(), macros=(), ktrans_args=(), ktrans=None,
+                  gpp=None, engine='gpp', output_dir=None, cache_dir=None,
+                  manifest=None, preprocess_only=False, keep_build_dir=False,
+                  pipe=False, pch=(), logger=None):
+    """compile a KAREL source from Python, as 'ktransw' would from the command
+       line, and return a CompileResult.
+
+       'ktrans_args' are the other arguments for ktrans (eg: ['/config',
+       'robot.ini']). The .pc files (or with 'preprocess_only', the
+       preprocessed sources) are written to 'output_dir', by default the
+       current directory. A 'manifest' is only updated if given.
+
+       This never writes to stdout or stderr and never exits: ktrans output
+       and errors (including a gpp or ktrans that can't be started) end up
+       in the result. Unlike the command line, it ignores the KTRANSW_*
+       environment variables. Every compile keeps its state in a
+       CompilationContext of its own, so a driver can compile any number of
+       programs in one process, from as many threads as it likes.
+    """
+    args = build_parser().parse_args([])
+    # not the defaults the KTRANSW_* variables set for the command line: a
+    # driver gets the same compile whatever its environment
+    args.build_dir = None
+    args.ram_build_dir = False
+    args.defer_manifest = False
+    args.history = HISTORY_FILE
+    args.include_dirs = list(include_dirs)
+    args.user_macros = list(macros)
+    args.ktrans_path = ktrans
+    args.gpp_path = gpp
+    args.engine = engine
+    args.cache_dir = cache_dir
+    args.keep_buildd = keep_build_dir
+    args.output_ppd_source = preprocess_only
+    args.pipe = pipe
+    args.pch_files = list(pch)
+    args.output_dir = output_dir
+    # ktrans gets to see the source first, and absolute paths only (as main() does)
+    args.ktrans_args = [os.path.abspath(source)] + [a if a[:1] in ('/', 'V', 'v')
+        else os.path.abspath(a) for a in ktrans_args]
+    logger = logger or logging.getLogger('ktransw')
+
+    start = time.perf_counter()
+    output = []
+    try:
+        result = _compile_source(args.ktrans_args[0], args, logger, manifest,
+            report=output.append, dependencies=True)
+    except KtranswError as e:
+        result = CompileResult(args.ktrans_args[0])
+        result.returncode = e.returncode
+        result.diagnostics.append(str(e))
+    except OSError as e:
+        # gpp or ktrans could not be started (or a file not be written)
+        result = CompileResult(args.ktrans_args[0])
+        result.returncode = 1
+        result.diagnostics.append("ktransw: fatal error: {0}\n".format(e))
+    result.diagnostics.extend(output)
+    result.timings['total'] = time.perf_counter() - start
+    return result
+
+
+class CompileResult(object):
+    """what compile_karel() did for a source:
+
+         source        the (absolute) path of the source
+         returncode    0, or the exit code ktransw would have exited with
+         files         the .pc files produced (or the preprocessed sources)
+         dependencies  the headers that went into the program
+         classes       the class objects it instantiated, each as (index,
+                       object_name, class_file, header_file[, type_name,
+                       type_file])
+         diagnostics   what ktrans printed, and any errors
+         timings       seconds spent, per phase ('preprocess', 'ktrans'
+                       and 'total')
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.returncode = 0
+        self.files = []
+        self.dependencies = []
+        self.classes = []
+        self.diagnostics = []
+        self.timings = {}
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return '<CompileResult {0} ret={1}>'.format(os.path.basename(self.source), self.returncode)
+
+
+class KtranswError(Exception):
+    """a compile can't continue. 'returncode' is what ktransw exits with"""
+
+    def __init__(self, message, returncode=1):
+        Exception.__init__(self, message)
+        self.returncode = returncode
+
+
+class CompilationContext(object):
+    """everything a single compile works with and turns up: its options
+       ('args'), logger and build dir ('folder'), the caches it uses and
+       the lists expanding its class objects appends to:
+
+         kl_files            the preprocessed sources to translate
+         class_injections    the class objects instantiated (see
+                             CompileResult.classes)
+         header_injections   the headers created for them
+         selective_includes  the headers '%from .. %import' read
+
+       Nothing of it is kept anywhere else, so compiles in different
+       threads don't see each other, and all of it goes once the compile
+       is done. Only the class cache is shared: by default it's the
+       process wide '_class_cache'.
+    """
+
+    def __init__(self, args, logger, folder, class_cache=None):
+        self.args = args
+        self.logger = logger
+        self.folder = folder
+        self.class_cache = _class_cache if class_cache is None else class_cache
+        self.build_cache = BuildCache(args.cache_dir) if args.cache_dir else None
+        self.kl_files = []
+        self.class_injections = []
+        self.header_injections = []
+        self.selective_includes = []
+
+    def child(self):
+        """a context for part of this compile, with the same options, build
+           dir and caches but lists of its own, to merge() back later
+        """
+        return CompilationContext(self.args, self.logger, self.folder, self.class_cache)
+
+    def merge(self, child):
+        self.kl_files.extend(child.kl_files)
+        self.class_injections.extend(child.class_injections)
+        self.header_injections.extend(child.header_injections)
+        self.selective_includes.extend(child.selective_includes)
+
+    def __repr__(self):
+        return '<CompilationContext {0!r}>'.format(self.folder)
+
+
+def compile_source(kl_file, args, logger):
+    """preprocess and translate a single KAREL source, returning the exit
+       code of ktrans (or of whatever failed first)
+    """
+    try:
+        return _compile_source(kl_file, args, logger, FILE_MANIFEST).returncode
+    except KtranswError as e:
+        sys.stderr.write(str(e))
+        return e.returncode
+
+
+def _compile_source(kl_file, args, logger, manifest, report=None, dependencies=False):
+    """compile_source() and compile_karel(), returning a CompileResult.
+       Dependencies are collected for -M and -MM (which write them out as
+       well), or when asked for. Failures to preprocess raise KtranswError.
+    """
+    result = CompileResult(kl_file)
+    start = time.perf_counter()
+
     # create temporary directory to store preprocessed file in. We
     # avoid problems with temporary files (via NamedTemporaryFile fi) being
-    # not readable by other processes in this way.
-    with TemporaryDirectory(prefix='ktransw-', suffix='-buildd', do_clean=(not args.keep_buildd)) as dname:
+    # not readable by other processes in this way. With --build-dir the
+    # target gets a directory of its own there instead, reused every build
+    build_dir = target_build_dir(kl_file, args)
+    if build_dir:
+        build_dir = BuildDirectory(build_dir)
+    else:
+        build_dir = TemporaryDirectory(prefix='ktransw-', suffix='-buildd', do_clean=(not args.keep_buildd))
+    with build_dir as dname:
         # unfortunately we need to create a temporary file to store the
         # preprocessed KAREL source in, as ktrans doesn't support reading
         # from stdin.
@@ -203,318 +580,1810 @@ def main():
         # TODO: see if ktrans will read from a named pipe ('\\.\pipe\temp.kl')
 
 
+        ctx = CompilationContext(args, logger, dname)
+
         #final pass through filename
         fname = os.path.join(dname, os.path.basename(kl_file))
 
-        #process files and class objects through recursive gpp process
-        make_classes(kl_file, fname, dname, args, logger)
+        # pick up headers added or removed since a previous compile
+        include_index(args.include_dirs).refresh()
+
+        #process files and class objects through recursive gpp process,
+        #unless a previous run already did so for identical inputs
+        cache = ctx.build_cache
+        cache_key = None
+        entry = None
+        if cache:
+            cache_key = cache.input_key(kl_file, args)
+            entry = cache.lookup(cache_key)
+        if entry:
+            logger.debug("Cache hit for {0}".format(kl_file))
+            entry.restore(ctx)
+        else:
+            make_classes(ctx, kl_file, fname)
+            if cache:
+                cache.store(cache_key,
+                    collect_dependencies(ctx.kl_files, ctx.selective_includes, dname, args.include_dirs),
+                    ctx.kl_files, {'kl_files': [os.path.basename(f) for f in ctx.kl_files],
+                        'classes': ctx.class_injections})
 
         # pre-processing done
+        result.classes = [list(obj) for obj in ctx.class_injections]
+        result.timings['preprocess'] = time.perf_counter() - start
 
-        base_source_name = ''
-        target = ''
         # see if we need to output dependency info
-        if (args.dep_output or args.ignore_syshdrs):
+        if (args.dep_output or args.ignore_syshdrs or dependencies):
             # use original filename for logging
             logger.debug("Dependency output for {0}".format(kl_file))
 
             # but scan the GPP output for include markers
-            incs = get_includes_from_file(fname)
-            logger.debug("Found {0} includes".format(len(incs)))
-
-            # target name we use is 'base source file name + .pc', OR the name
-            # provided as a command line arg
-            base_source_name = os.path.basename(os.path.splitext(kl_file)[0])
-            target = args.dep_target or (base_source_name + PCODE_SUFFIX)
-
-            # resolve all relative includes to their respective include directories
-            deps = []
-            for hdr in incs:
-                if args.ignore_syshdrs and is_system_header(hdr):
-                    logger.debug("Ignoring system header '{0}'".format(hdr))
-                    continue
-
-                # all non-absolute paths are headers we need to find first
-                hdr_path = hdr
-                if not os.path.isabs(hdr_path):
-                    try:
-                        hdr_dir = find_hdr_in_incdirs(hdr_path, args.include_dirs)
-
-                        # make relative header absolute by prefixing it with the
-                        # location we found it in
-                        hdr_path = os.path.join(hdr_dir, hdr_path)
-                        logger.debug("Found {0} in '{1}'".format(hdr, hdr_dir))
-
-                    except ValueError as e:
-                        if not args.ignore_missing_hdrs:
-                            # we were not asked to ignore this, so exit with an error
-                            sys.stderr.write("ktransw: fatal error: {0}: No such file or directory\n".format(hdr))
-                            sys.exit(_OS_EX_DATAERR)
-
-                logger.debug("Adding {0} to dependencies".format(hdr_path))
-                deps.append(hdr_path)
-
-            # escape spaces as ninja does not like those
-            for i in range(0, len(deps)):
-                deps[i] = deps[i].replace(' ', '\\ ')
-            target = target.replace(' ', '\\ ')
-
-            # write out dependency rules
-            dep_lines = '{0}: {1}\n'.format(target, ' '.join(['{}'.format(dep) for dep in deps]))
-
-            # and some phony targets if user requested that
-            if args.add_phony_tgt_for_deps:
-                dep_lines += '\n'.join([dep + ':' for dep in deps]) + '\n'
-
-            # write out dependency file
-            if args.dep_fname:
-                with open(args.dep_fname, 'w') as outf:
-                    outf.write(dep_lines)
-            # or to stdout
-            else:
-                sys.stdout.write(dep_lines)
+            headers = marker_dependencies(fname, args.include_dirs, logger)
+            result.dependencies = [path or hdr for (hdr, path) in headers]
+            if (args.dep_output or args.ignore_syshdrs):
+                result.returncode = output_dependencies(kl_file, headers, args, logger)
+                if result.returncode != 0:
+                    return result
 
         #store files and classes in manifest
-        write_manifest(FILE_MANIFEST, [os.path.split(f)[-1] for f in kl_files], os.path.split(kl_file)[-1])
+        if manifest:
+            write_manifest(manifest, [os.path.split(f)[-1] for f in ctx.kl_files],
+                os.path.split(kl_file)[-1], export=not args.defer_manifest)
 
         # output only pre-processed source if user asked for that
         if args.output_ppd_source:
-            for i in range(0, len(kl_files)):
-                copyfile(dname + '\\' + os.path.basename(kl_files[i]), os.path.basename(kl_files[i]))
-            sys.exit(0)
+            from shutil import copyfile
+            for i in range(0, len(ctx.kl_files)):
+                copy = os.path.join(args.output_dir or '', os.path.basename(ctx.kl_files[i]))
+                copyfile(ctx.kl_files[i], copy)
+                result.files.append(os.path.abspath(copy))
+            return result
+
+        start = time.perf_counter()
+        result.returncode = translate_all(ctx.kl_files, args, logger, report)
+        result.timings['ktrans'] = time.perf_counter() - start
+        if result.returncode == 0:
+            result.files = [pcode_output(f, args) for f in ctx.kl_files]
+        return result
+
+
+def precompile(args, logger):
+    """--precompile: write the MacroSnapshot of including a header with the
+       '-D' macros, or (for an -o without SNAPSHOT_SUFFIX) the macros it
+       defines as a define file for gpp. Returns the exit code.
+    """
+    import pygpp
+    index = include_index(args.include_dirs)
+    engine = pygpp.Engine(index.dirs, args.user_macros, locate=index.locate)
+    path = engine.find_include(args.precompile)
+    if path is None:
+        sys.stderr.write("ktransw: fatal error: can't find header '{0}'\n".format(args.precompile))
+        return _OS_EX_DATAERR
+    output = args.precompile_output or \
+        os.path.splitext(os.path.basename(path))[0] + SNAPSHOT_SUFFIX
+
+    try:
+        snapshot = engine.snapshot(path)
+        if output.endswith(SNAPSHOT_SUFFIX):
+            BuildCache._write_json(os.path.abspath(output), snapshot.to_json())
+        else:
+            pygpp.write_output(output, snapshot.flatten())
+    except (pygpp.GppError, OSError) as e:
+        sys.stderr.write("ktransw: fatal error: {0}\n".format(e))
+        return _OS_EX_DATAERR
+    logger.debug("Precompiled {0} into {1}: {2} macros, depends on {3}".format(
+        path, output, len(snapshot.writes), len(snapshot.reads)))
+    return 0
+
+
+def macro_snapshots(pch_files, logger):
+    """the MacroSnapshots in 'pch_files', loaded once while unchanged.
+       Snapshots that can't be read, or were taken by another version of
+       the engine, are skipped.
+    """
+    import pygpp
+    snapshots = []
+    for fname in pch_files:
+        sig = _stat_sig(fname)
+        cached = _snapshot_files.get(fname)
+        if cached is None or cached[0] != sig:
+            snapshot = None
+            try:
+                with open(fname, 'r') as f:
+                    snapshot = pygpp.MacroSnapshot.from_json(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                logger.debug("Can't load {0} ({1})".format(fname, e))
+            if snapshot is None:
+                logger.debug("Ignoring snapshot {0}".format(fname))
+            cached = _snapshot_files[fname] = (sig, snapshot)
+        if cached[1] is not None:
+            snapshots.append(cached[1])
+    return snapshots
+
+
+def marker_dependencies(fname, include_dirs, logger):
+    """the headers gpp entered while producing 'fname', as (header, path)
+       pairs for output_dependencies()
+    """
+    incs = get_includes_from_file(fname)
+    logger.debug("Found {0} includes".format(len(incs)))
+
+    # resolve all relative includes to their respective include directories
+    headers = []
+    for hdr in incs:
+        hdr_path = hdr
+        # all non-absolute paths are headers we need to find first
+        if not os.path.isabs(hdr_path):
+            try:
+                hdr_dir = find_hdr_in_incdirs(hdr_path, include_dirs)
 
-        for i in range(0, len(kl_files)):
-          ret_code = run_ktrans(kl_files[i], args, logger)
-        
-        sys.exit(ret_code)
+                # make relative header absolute by prefixing it with the
+                # location we found it in
+                hdr_path = os.path.join(hdr_dir, hdr_path)
+                logger.debug("Found {0} in '{1}'".format(hdr, hdr_dir))
+
+            except ValueError as e:
+                hdr_path = None
+        headers.append((hdr, hdr_path))
+    return headers
+
+
+def output_dependencies(kl_file, headers, args, logger):
+    """write the GCC style dependency rule of 'kl_file' to the depfile (or
+       stdout). 'headers' are (header, path) pairs, with path None for
+       headers that couldn't be found. Returns an exit code.
+    """
+    # target name we use is 'base source file name + .pc', OR the name
+    # provided as a command line arg
+    base_source_name = os.path.basename(os.path.splitext(kl_file)[0])
+    target = args.dep_target or (base_source_name + PCODE_SUFFIX)
+
+    deps = []
+    for (hdr, hdr_path) in headers:
+        if args.ignore_syshdrs and is_system_header(hdr):
+            logger.debug("Ignoring system header '{0}'".format(hdr))
+            continue
+
+        if hdr_path is None:
+            if not args.ignore_missing_hdrs:
+                # we were not asked to ignore this, so exit with an error
+                sys.stderr.write("ktransw: fatal error: {0}: No such file or directory\n".format(hdr))
+                return _OS_EX_DATAERR
+            hdr_path = hdr
+
+        logger.debug("Adding {0} to dependencies".format(hdr_path))
+        deps.append(hdr_path)
+
+    # escape spaces as ninja does not like those
+    for i in range(0, len(deps)):
+        deps[i] = deps[i].replace(' ', '\\ ')
+    target = target.replace(' ', '\\ ')
+
+    # write out dependency rules
+    dep_lines = '{0}: {1}\n'.format(target, ' '.join(['{}'.format(dep) for dep in deps]))
+
+    # and some phony targets if user requested that
+    if args.add_phony_tgt_for_deps:
+        dep_lines += '\n'.join([dep + ':' for dep in deps]) + '\n'
+
+    # write out dependency file
+    if args.dep_fname:
+        with open(args.dep_fname, 'w') as outf:
+            outf.write(dep_lines)
+    # or to stdout
+    else:
+        sys.stdout.write(dep_lines)
+    return 0
+
+
+def compile_deps(sources, args, logger):
+    """write the dependency rules of 'sources' from a scan of their
+       directives (see scan_dependencies), without running gpp
+    """
+    for (opt, val) in (('-MF', args.dep_fname), ('-MT', args.dep_target)):
+        if len(sources) > 1 and val and '{name}' not in val:
+            sys.stderr.write("ktransw: fatal error: {0} must contain '{{name}}' "
+                "when scanning multiple sources\n".format(opt))
+            return _OS_EX_DATAERR
+
+    import copy
+    for kl_file in sources:
+        name = os.path.basename(os.path.splitext(kl_file)[0])
+        src_args = copy.copy(args)
+        if args.dep_fname:
+            src_args.dep_fname = args.dep_fname.replace('{name}', name)
+        if args.dep_target:
+            src_args.dep_target = args.dep_target.replace('{name}', name)
+
+        logger.debug("Scanning {0} for dependencies".format(kl_file))
+        ret = output_dependencies(kl_file, scan_dependencies(kl_file, args), src_args, logger)
+        if ret != 0:
+            return ret
+    return 0
+
+
+def compile_batch(sources, args, logger, stats=None):
+    """preprocess and translate several KAREL sources on a pool of worker
+       processes, started in the order of 'sources'.
+
+       Every worker handles many sources over its lifetime, so its include
+       lookups and class expansions (and, with a cache dir, the workspace
+       wide store) are shared between them. Output of a source is relayed
+       as a whole once it is done, and every source gets its own depfile,
+       manifest entry and exit status. With a dict for 'stats', that gets
+       a SourceStats per source.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    for (opt, val) in (('-MF', args.dep_fname), ('-MT', args.dep_target)):
+        if val and '{name}' not in val:
+            sys.stderr.write("ktransw: fatal error: {0} must contain '{{name}}' "
+                "when compiling multiple sources\n".format(opt))
+            return _OS_EX_DATAERR
+
+    measure = stats is not None
+    if multiprocessing.current_process().daemon:
+        # a --server worker may not start processes of its own: compile the
+        # sources one after another in it instead
+        logger.debug("Compiling {0} sources in-process".format(len(sources)))
+        results = _collect_batch((_compile_batch_source(kl_file, args, measure,
+            in_process=True) for kl_file in sources), stats)
+    else:
+        # every worker busy with a source holds a job slot
+        slots = jobserver(args)
+        logger.debug("Compiling {0} sources on {1} workers ({2})".format(
+            len(sources), args.jobs, slots))
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = []
+            for kl_file in sources:
+                token = slots.acquire()
+                future = pool.submit(_compile_batch_source, kl_file, args, measure)
+                future.add_done_callback(lambda _, token=token: slots.release(token))
+                futures.append(future)
+            results = _collect_batch((future.result() for future in futures), stats)
+
+    # the workers only journaled their manifest updates
+    if not args.defer_manifest:
+        ManifestStore(FILE_MANIFEST).export()
+
+    if args.batch_report:
+        with open(args.batch_report, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [ret for ret in (results[kl_file] for kl_file in sources) if ret != 0]
+    return failed[0] if failed else 0
+
+
+def _collect_batch(outcomes, stats):
+    """relay the output of the batch sources in 'outcomes', in order, and
+       return their exit statuses
+    """
+    results = {}
+    for (kl_file, ret, chunks, events, source_stats) in outcomes:
+        if stats is not None:
+            stats[kl_file] = source_stats
+        if _tracer is not None:
+            _tracer.events.extend(events)
+        for (stream, data) in chunks:
+            (sys.stdout if stream == 'out' else sys.stderr).write(data)
+        if ret != 0:
+            sys.stderr.write("ktransw: {0}: failed (ret: {1})\n".format(
+                os.path.basename(kl_file), ret))
+        results[kl_file] = ret
+    return results
+
+
+def _compile_batch_source(kl_file, args, measure=False, in_process=False):
+    """compile_source for one source of a batch, inside a pool worker. With
+       'measure', a SourceStats of the compile is returned as well. With
+       'in_process', the logging and tracing of the caller are used as they
+       are
+    """
+    import copy
+    import traceback
+
+    name = os.path.basename(os.path.splitext(kl_file)[0])
+    args = copy.copy(args)
+    # ktrans gets to see this source only
+    args.ktrans_args = [a for a in args.ktrans_args
+        if not a.endswith(KL_SUFFIX) or a == kl_file]
+    if args.dep_output or args.ignore_syshdrs:
+        args.dep_fname = (args.dep_fname or '{name}.d').replace('{name}', name)
+    if args.dep_target:
+        args.dep_target = args.dep_target.replace('{name}', name)
+    # compile_batch exports the manifest once all sources are done
+    args.defer_manifest = True
+    # and took the job slot this source runs in. Without a jobserver to
+    # ask for more, its ktrans runs take turns in that one
+    args.jobs = 1
+
+    if not in_process:
+        # a forked worker inherits the handler of its parent, which writes
+        # to the real stderr rather than to the _Capture of the source
+        logging.basicConfig(format=LOG_FMT, level=logging.INFO, stream=_StderrRelay(),
+            force=True)
+    logger = logging.getLogger('ktransw')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    chunks = []
+    saved_streams = (sys.stdout, sys.stderr)
+    sys.stdout = _Capture(chunks, 'out')
+    sys.stderr = _Capture(chunks, 'err')
+    # spans go back to compile_batch, which writes the trace
+    if args.trace and not in_process:
+        start_trace(None, process_name='ktransw worker')
+    stats = SourceStats(time.time(), os.getpid()) if measure else None
+    start = time.perf_counter()
+    try:
+        if measure:
+            try:
+                result = _compile_source(kl_file, args, logger, FILE_MANIFEST, dependencies=True)
+                stats.includes = result.dependencies
+                stats.classes = [obj[1:3] for obj in result.classes]
+                ret = result.returncode
+            except KtranswError as e:
+                sys.stderr.write(str(e))
+                ret = e.returncode
+        else:
+            ret = compile_source(kl_file, args, logger)
+    except SystemExit as e:
+        ret = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        ret = 1
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+        events = finish_trace() if not in_process else []
+    if stats is not None:
+        stats.duration = time.perf_counter() - start
+    return (kl_file, ret, chunks, events, stats)
+
+
+def build_workspace(args, logger):
+    """'ktransw build': compile every program in the workspace on a pool of
+       '--jobs' worker processes, those expected to take longest first.
+
+       Sources are the .kl files given and the programs found in the
+       directories given (see discover_sources()). How long each takes is
+       estimated by the BuildHistory, from earlier builds or from the size
+       of its include and %class graph. Starting the long ones first keeps
+       programs with many class objects from finishing alone at the end,
+       with the other workers idle. Afterwards the history is updated and
+       the parallel efficiency and the critical path are reported.
+    """
+    paths = [a for a in args.ktrans_args if a.endswith(KL_SUFFIX) or os.path.isdir(a)]
+    exclude = args.include_dirs + ([args.build_dir] if args.build_dir else [])
+    sources = discover_sources(paths or [os.getcwd()], exclude)
+    if not sources:
+        sys.stderr.write("ktransw: fatal error: no KAREL programs found\n")
+        return _OS_EX_DATAERR
+
+    history = BuildHistory(args.history)
+    estimates = history.estimates(sources, args)
+    order = sorted(sources, key=lambda kl_file: (-estimates[kl_file], kl_file))
+    if args.dry_run:
+        for kl_file in order:
+            sys.stdout.write("{0:8.2f} s  {1}\n".format(estimates[kl_file],
+                os.path.relpath(kl_file)))
+        return 0
+
+    # ktrans gets to see the sources as if they were given one by one
+    args.ktrans_args = [a for a in args.ktrans_args if a not in paths] + order
+    stats = {}
+    start = time.time()
+    ret = compile_batch(order, args, logger, stats)
+    wall = time.time() - start
+
+    for (kl_file, source_stats) in stats.items():
+        history.record(kl_file, source_stats)
+    history.save()
+    if not args.quiet:
+        sys.stdout.write(build_report(stats, start, wall, min(args.jobs, len(order))))
+    return ret
+
+
+def available_cpus():
+    """the number of CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# a line starting a KAREL program, rather than something to %include
+_PROGRAM_RE = re.compile(r'^[ \t]*PROGRAM[ \t]+\w+', re.IGNORECASE | re.MULTILINE)
+
+def discover_sources(paths, exclude=()):
+    """the KAREL programs in 'paths': any .kl file given, and every .kl file
+       starting a PROGRAM in the directories given, walked recursively
+       except for hidden directories and those in 'exclude' (include dirs,
+       a build dir)
+    """
+    skip = set(os.path.normcase(os.path.abspath(d)) for d in exclude)
+    sources = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sources.append(os.path.abspath(path))
+            continue
+        for (root, dirs, files) in os.walk(os.path.abspath(path)):
+            if os.path.normcase(root) in skip:
+                dirs[:] = []
+                continue
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not name.endswith(KL_SUFFIX):
+                    continue
+                fname = os.path.join(root, name)
+                with open(fname, 'r', encoding='latin-1') as f:
+                    if _PROGRAM_RE.search(f.read()):
+                        sources.append(fname)
+    return list(dict.fromkeys(sources))
+
+
+class SourceStats(object):
+    """how compiling a source of a batch went: when it started (wall clock)
+       and how many seconds it took, the worker process that ran it and
+       the headers and class objects (as (name, class file)) its include
+       markers showed
+    """
+
+    def __init__(self, start, worker):
+        self.start = start
+        self.worker = worker
+        self.duration = 0.0
+        self.includes = []
+        self.classes = []
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+
+class BuildHistory(object):
+    """what 'ktransw build' knows about the programs it built before, in
+       the --history file: per program, how long compiling it took (a
+       moving average over builds) and the headers and class objects that
+       went into it, taken from its include markers.
+
+       Programs without a recorded duration are estimated from the size of
+       their include and %class graph, at the seconds per unit of size the
+       recorded ones took.
+    """
+
+    VERSION = 1
+    # weight of the latest build in the moving average
+    SMOOTHING = 0.5
+    # a class object goes through all gpp passes (and ktrans) of its own,
+    # which makes it weigh about as much as a handful of headers
+    CLASS_WEIGHT = 4
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        data = BuildCache._read_json(self.path) or {}
+        self.programs = data.get('programs', {}) if data.get('version') == self.VERSION else {}
+
+    def graph(self, kl_file, args):
+        """(includes, classes) of 'kl_file': as its include markers showed
+           last time, or from a scan of its directives if it wasn't built
+           before. A scan only sees class files, so those stand in for the
+           class objects then
+        """
+        known = self.programs.get(kl_file)
+        if known:
+            return (known['includes'], known['classes'])
+        includes = [path or hdr for (hdr, path) in scan_dependencies(kl_file, args)]
+        return (includes, [[None, f] for f in includes if f.endswith('.klc')])
+
+    def weight(self, includes, classes):
+        return 1 + len(includes) + self.CLASS_WEIGHT * len(classes)
+
+    def estimates(self, sources, args):
+        """seconds each of 'sources' is expected to take"""
+        known = list(self.programs.values())
+        total_weight = sum(self.weight(p['includes'], p['classes']) for p in known)
+        rate = sum(p['duration'] for p in known) / total_weight if known else 1.0
+        estimates = {}
+        for kl_file in sources:
+            if kl_file in self.programs:
+                estimates[kl_file] = self.programs[kl_file]['duration']
+            else:
+                estimates[kl_file] = self.weight(*self.graph(kl_file, args)) * rate
+        return estimates
+
+    def record(self, kl_file, stats):
+        duration = stats.duration
+        previous = self.programs.get(kl_file)
+        if previous:
+            duration = (self.SMOOTHING * duration
+                + (1 - self.SMOOTHING) * previous['duration'])
+        self.programs[kl_file] = {'duration': duration, 'includes': stats.includes,
+            'classes': stats.classes}
+
+    def save(self):
+        BuildCache._write_json(self.path, {'version': self.VERSION, 'programs': self.programs})
+
+
+def build_report(stats, start, wall, workers):
+    """what 'ktransw build' says at the end: the parallel efficiency (the
+       part of 'wall' seconds times 'workers' spent compiling) and the
+       critical path: the programs the worker that finished last compiled,
+       which nothing but starting those sooner or splitting them up would
+       have made any shorter
+    """
+    busy = sum(s.duration for s in stats.values())
+    lines = ["ktransw: built {0} programs in {1:.2f} s on {2} workers".format(
+        len(stats), wall, workers)]
+    if not stats:
+        return lines[0] + '\n'
+    lines.append("ktransw: parallel efficiency {0:.0%} ({1:.2f} s compiling)".format(
+        busy / (wall * workers) if wall > 0 else 1.0, busy))
+
+    last = max(stats.values(), key=lambda s: s.end)
+    path = sorted([(s.start, kl_file, s) for (kl_file, s) in stats.items()
+        if s.worker == last.worker])
+    steps = []
+    for (_, kl_file, s) in path:
+        step = "{0} ({1:.2f} s".format(os.path.basename(kl_file), s.duration)
+        if s.classes:
+            step += ", {0} class objects".format(len(s.classes))
+        steps.append(step + ')')
+    lines.append("ktransw: critical path {0:.2f} s: {1}".format(
+        last.end - start, ' -> '.join(steps)))
+    return '\n'.join(lines) + '\n'
+
+
+def jobserver(args):
+    """the Jobserver of this process: the one of the make or ninja running
+       us, if it passed one on in MAKEFLAGS, otherwise one handing out
+       '--jobs' slots
+    """
+    global _jobserver
+    # forked batch workers start out with a copy of their parent's
+    if _jobserver is None or _jobserver.pid != os.getpid():
+        _jobserver = Jobserver.from_makeflags(os.environ.get('MAKEFLAGS', ''), args.jobs)
+    return _jobserver
+
+
+class Jobserver(object):
+    """client side of the GNU make jobserver protocol.
+
+       A process started by make may always run one job: its implicit
+       slot. Every job it runs next to that one needs a token, taken from
+       the jobserver before starting it and given back when it is done.
+       Tokens are single bytes read from and written back to a named fifo
+       ('--jobserver-auth=fifo:PATH', GNU make 4.4 and ninja 1.13) or a
+       pair of inherited pipe fds ('--jobserver-auth=R,W'), or a count on
+       a named semaphore ('--jobserver-auth=NAME', on Windows). Without a
+       jobserver, 'jobs' slots are handed out locally instead.
+
+       acquire() returns a token (None for the implicit slot), which must
+       go back through release(). Both are thread safe.
+    """
+
+    # how long to wait on the jobserver before checking whether our own
+    # implicit slot came free again in the meantime
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, jobs=1, read_fd=None, write_fd=None, semaphore=None, auth=None):
+        self.pid = os.getpid()
+        self.auth = auth
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        self._semaphore = semaphore
+        self._lock = threading.Lock()
+        self._implicit = True
+        self._local = None
+        if read_fd is None and semaphore is None:
+            self._local = threading.Semaphore(max(jobs or 1, 1) - 1)
+            self.jobs = max(jobs or 1, 1)
+
+    @classmethod
+    def from_makeflags(cls, makeflags, jobs):
+        auths = re.findall(r'--jobserver-(?:auth|fds)=(\S+)', makeflags)
+        if auths:
+            auth = auths[-1]
+            try:
+                if auth.startswith('fifo:'):
+                    # an open file description of our own, so it can be
+                    # non-blocking without affecting anybody else's
+                    fd = os.open(auth[len('fifo:'):], os.O_RDWR | os.O_NONBLOCK)
+                    return cls(read_fd=fd, write_fd=fd, auth=auth)
+                m = re.match(r'^(\d+),(\d+)$', auth)
+                if m:
+                    (read_fd, write_fd) = (int(m.group(1)), int(m.group(2)))
+                    # make closes these for commands it doesn't consider
+                    # to be sub-makes, after which they may be anything
+                    import stat
+                    if all(stat.S_ISFIFO(os.fstat(fd).st_mode) for fd in (read_fd, write_fd)):
+                        return cls(read_fd=read_fd, write_fd=write_fd, auth=auth)
+                elif os.name == 'nt':
+                    return cls(semaphore=_open_semaphore(auth), auth=auth)
+            except OSError:
+                pass
+        return cls(jobs)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self._implicit:
+                    self._implicit = False
+                    return None
+            token = self._take(self.POLL_INTERVAL)
+            if token is not None:
+                return token
+
+    def try_acquire(self):
+        """a token for one more job next to the running ones, or None if
+           there is none to spare right now. Never the implicit slot: that
+           is the job asking
+        """
+        return self._take(0)
+
+    def release(self, token):
+        if token is None:
+            with self._lock:
+                self._implicit = True
+        elif self._local is not None:
+            self._local.release()
+        elif self._semaphore is not None:
+            import ctypes
+            ctypes.windll.kernel32.ReleaseSemaphore(self._semaphore, 1, None)
+        else:
+            os.write(self._write_fd, token)
+
+    def slot(self):
+        """'with jobserver.slot():' runs the block in a job slot"""
+        import contextlib
+
+        @contextlib.contextmanager
+        def held():
+            token = self.acquire()
+            try:
+                yield
+            finally:
+                self.release(token)
+        return held()
+
+    def _take(self, timeout):
+        if self._local is not None:
+            return b'+' if self._local.acquire(timeout=timeout) else None
+        if self._semaphore is not None:
+            import ctypes
+            WAIT_OBJECT_0 = 0
+            res = ctypes.windll.kernel32.WaitForSingleObject(self._semaphore, int(timeout * 1000))
+            return b'+' if res == WAIT_OBJECT_0 else None
+        import select
+        (ready, _, _) = select.select([self._read_fd], [], [], timeout)
+        if not ready:
+            return None
+        try:
+            token = os.read(self._read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            # somebody else got it first
+            return None
+        if not token:
+            raise OSError("jobserver '{0}' was closed".format(self.auth))
+        return token
+
+    def __repr__(self):
+        if self._local is not None:
+            return 'Jobserver(jobs={0})'.format(self.jobs)
+        return 'Jobserver({0!r})'.format(self.auth)
+
+
+def _open_semaphore(name):
+    import ctypes
+    SYNCHRONIZE = 0x00100000
+    SEMAPHORE_MODIFY_STATE = 0x0002
+    handle = ctypes.windll.kernel32.OpenSemaphoreW(
+        SYNCHRONIZE | SEMAPHORE_MODIFY_STATE, False, name)
+    if not handle:
+        raise OSError("can't open jobserver semaphore '{0}'".format(name))
+    return handle
+
+
+# the meta macros scan_dependencies() follows
+# where the name of a '%define'd macro ends
+_MACRO_NAME_END_RE = re.compile(r'[\s(]')
+_DEP_DIRECTIVE_RE = re.compile(r'%(include|class|from|define|defeval|undef|ifdef|ifndef|ifeq|ifneq|else|endif)\b[ \t]*(.*)')
+
+
+def scan_dependencies(kl_file, args):
+    """the files compiling 'kl_file' would read, found by scanning for
+       %include, %class and %from directives instead of running gpp.
+       Returns (header, path) pairs in the order they're first seen, with
+       path None for headers that couldn't be found.
+
+       Macros from '-D' and %define are tracked to follow %ifdef/%ifndef;
+       both branches of %ifeq/%ifneq are taken, so the result may list
+       more dependencies than the gpp passes would, never fewer. Unlike
+       the include markers, it also lists the .klc files of instantiated
+       classes and the headers '%from .. %import' reads.
+    """
+    index = include_index(args.include_dirs)
+    defined = set(d.partition('=')[0].partition('(')[0] for d in args.user_macros)
+    found = []
+    seen = set()
+
+    def resolve(name):
+        if os.path.isabs(name) or os.path.exists(name):
+            return name
+        include_dir = index.locate(name)
+        return os.path.join(include_dir, name) if include_dir is not None else None
+
+    def depend(name, follow=True):
+        if name in seen:
+            return
+        seen.add(name)
+        path = resolve(name)
+        found.append((name, path))
+        if follow and path is not None:
+            scan(path)
+
+    def scan(path):
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        # stack of (taking this branch, condition known)
+        conds = []
+        for line in lines:
+            if not line.startswith('%'):
+                continue
+            m = _DEP_DIRECTIVE_RE.match(line)
+            if not m:
+                continue
+            (directive, rest) = (m.group(1), m.group(2).strip())
+            active = all(c[0] for c in conds)
+            if directive in ('ifdef', 'ifndef'):
+                taken = (rest.split()[0] in defined) if rest else False
+                conds.append([taken == (directive == 'ifdef'), True])
+            elif directive in ('ifeq', 'ifneq'):
+                conds.append([True, False])
+            elif directive == 'else':
+                if conds and conds[-1][1]:
+                    conds[-1][0] = not conds[-1][0]
+            elif directive == 'endif':
+                if conds:
+                    conds.pop()
+            elif not active:
+                continue
+            elif directive in ('define', 'defeval'):
+                if rest:
+                    defined.add(_MACRO_NAME_END_RE.split(rest, 1)[0])
+            elif directive == 'undef':
+                defined.discard(rest)
+            elif directive == 'include':
+                depend(rest)
+            elif directive == 'class':
+                m = _CLASS_RE.match(line)
+                if m:
+                    for name in m.groups()[1:]:
+                        if name:
+                            depend(name)
+            elif directive == 'from':
+                m = _FROM_RE.match(line)
+                if m:
+                    depend(m.group(1), follow=False)
+                    depend('namespace.m')
+
+    scan(kl_file)
+    return found
 
 
 def get_includes_from_file(fname):
-    with open(fname, 'rb') as fd:
-        source = fd.read()
-        return scan_for_inc_stmts(source)
+    return include_tree(fname).includes
 
 def remove_blank_lines(fname):
-    with open(fname, 'r+') as inf:
-      lines = inf.readlines()
-      lines = [line for line in lines if line.strip() != ""]
-          
-      inf.seek(0)
-      inf.write(''.join(lines))
-      inf.truncate()
-
-def run_gpp(inpt, outpt, args, logger):
+    _rewrite_file(fname, fname, blank_lines=True)
+
+def run_gpp(inpt, outpt, args, logger, text=None, stage=None):
+    """preprocess 'inpt' into 'outpt'. With 'text' given, that is fed to gpp
+       on stdin instead of reading 'inpt' (which then only names the source
+       in log messages), and with 'outpt' None the output is returned
+       instead of written. 'stage' names the pass in the --trace.
+    """
+    with trace('gpp ' + (stage or 'pass'), 'gpp', file=inpt, engine=args.engine) as span:
+        output = _run_gpp(inpt, outpt, args, logger, text)
+        if span.active:
+            span.set(bytes_in=len(text) if text is not None else _file_size(inpt),
+                bytes_out=len(output) if outpt is None else _file_size(outpt))
+        return output
+
+
+def _run_gpp(inpt, outpt, args, logger, text):
     gpp_path = os.path.abspath(args.gpp_path) if args.gpp_path else GPP_BIN_NAME
     # do actual pre-processing
     logger.debug("Starting pre-processing of {}".format(inpt))
 
+    if args.engine == 'builtin':
+        import pygpp
+        try:
+            index = include_index(args.include_dirs)
+            engine = pygpp.Engine(index.dirs, args.user_macros, locate=index.locate,
+                snapshots=macro_snapshots(args.pch_files, logger))
+            if text is None:
+                output = engine.process_file(inpt)
+            else:
+                # name the text after the file it would have been read from,
+                # so markers don't depend on --pipe
+                output = engine.process_text(text, inpt)
+            if outpt is None:
+                return output
+            pygpp.write_output(outpt, output)
+            return
+        except pygpp.Unsupported as e:
+            logger.debug("Builtin engine can't process {0} ({1}), falling back "
+                "to gpp".format(inpt, e))
+        except (pygpp.GppError, OSError) as e:
+            raise KtranswError(
+                "{}\n"
+                "Translation terminated\n".format(e), getattr(e, 'returncode', 1))
+
     # setup command line for gpp
-    gpp_cmdline = setup_gpp_cline(gpp_path, inpt, outpt, args.include_dirs, args.user_macros)
+    gpp_cmdline = setup_gpp_cline(gpp_path, inpt if text is None else None,
+        outpt, include_index(args.include_dirs).dirs, args.user_macros)
     # TODO: why do we need to do this ourselves? gpp doesn't run
     #       correctly if we don't, but it shouldn't matter?
     gpp_cmdline = ' '.join(gpp_cmdline)
+    if os.name != 'nt':
+        # no CreateProcess to split the command line for us
+        import shlex
+        gpp_cmdline = shlex.split(gpp_cmdline)
 
     # invoke gpp and save output
     logger.debug("Starting gpp as: '{0}'".format(gpp_cmdline))
+    import subprocess
     gpp_proc = subprocess.Popen(gpp_cmdline, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    (pstdout, pstderr) = gpp_proc.communicate()
+        stderr=subprocess.PIPE,
+        stdin=subprocess.PIPE if text is not None else None)
+    (pstdout, pstderr) = gpp_proc.communicate(
+        text.encode('latin-1') if text is not None else None)
 
     logger.debug("End of gpp, ret: {0}".format(gpp_proc.returncode))
 
     # make sure to relay errors in case there are any, even if we're quiet
     if (gpp_proc.returncode != 0):
-        sys.stderr.write(
-            "{}\n"
-            "Translation terminated\n".format(pstderr))
-
         # TODO: this is not very nice, as it essentially merges the set of
         # possible exit codes of gpp with those of ktrans (and gpp's are
         # positive, while ktrans' are negative ..)
-        sys.exit(gpp_proc.returncode)
-
-def run_ktrans(inpt, args, logger):
-    ktrans_path = os.path.abspath(args.ktrans_path) if args.ktrans_path else KTRANS_BIN_NAME
-    run_files = [arg for arg in args.ktrans_args if arg.endswith(KL_SUFFIX)]
-    # quote all paths as they may potentially contain spaces and ktrans
-    # (or the shell really) can't handle that
-    # ** hack arguments to insert the requested input file into the ktrans arguments
-    ktrans_args = []
-    for i in range(0, len(args.ktrans_args)):
-        if (args.ktrans_args[i] == run_files[0]):
-            ktrans_args.append('"{0}"'.format(inpt))
-        elif (args.ktrans_args[i][0] != '/') and (args.ktrans_args[i][0] != 'V') and (args.ktrans_args[i][0] != 'v'):
-            ktrans_args.append('"{0}"'.format(args.ktrans_args[i]))
-        else:
-            ktrans_args.append('{0}'.format(args.ktrans_args[i]))
-
-    # setup ktrans command line args
-    ktrans_cmdline = ['"{0}"'.format(ktrans_path)]
-    ktrans_cmdline.extend(ktrans_args)
-    ktrans_cmdline = ' '.join(ktrans_cmdline)
-
-    logger.debug("Starting ktrans as: '{}'".format(ktrans_cmdline))
-    # NOTE: we remap stderr to stdout as ktrans doesn't use those
-    # consistently (ie: uses stderr when it should use stdout and
-    # vice versa)
-    ktrans_proc = subprocess.Popen(ktrans_cmdline, stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
-    (pstdout, _) = ktrans_proc.communicate()
-
-    # let caller know how we did
-    logger.debug("End of ktrans, ret: {0}".format(ktrans_proc.returncode))
-
-    # print ktrans output only on error or if we're not quiet
-    if (ktrans_proc.returncode != 0) or (not args.quiet) or args.verbose:
-        # TODO: we loose stdout/stderr interleaving here
-        # TODO: the error messages refer to lines in the temporary,
-        # preprocessed KAREL source file, not the original one.
-        sys.stdout.write(pstdout.decode('utf-8').replace(os.path.dirname(inpt), os.path.dirname(run_files[0])) + '\n')
+        raise KtranswError(
+            "{}\n"
+            "Translation terminated\n".format(pstderr), gpp_proc.returncode)
 
-    return ktrans_proc.returncode
+    if outpt is None:
+        return pstdout.decode('latin-1').replace('\r\n', '\n')
 
+def run_ktrans(inpt, args, logger, report=None):
+    """translate 'inpt', passing what ktrans printed to 'report' (by
+       default: write it to stdout). Returns the exit code of ktrans.
+    """
+    with trace('ktrans ' + os.path.basename(inpt), 'ktrans', file=inpt) as span:
+        if span.active:
+            span.set(bytes=_file_size(inpt))
+        ktrans_path = os.path.abspath(args.ktrans_path) if args.ktrans_path else KTRANS_BIN_NAME
+        run_files = [arg for arg in args.ktrans_args if arg.endswith(KL_SUFFIX)]
+        # quote all paths as they may potentially contain spaces and ktrans
+        # (or the shell really) can't handle that
+        # ** hack arguments to insert the requested input file into the ktrans arguments
+        ktrans_args = []
+        for i in range(0, len(args.ktrans_args)):
+            if (args.ktrans_args[i] == run_files[0]):
+                ktrans_args.append('"{0}"'.format(inpt))
+            elif (args.ktrans_args[i][0] != '/') and (args.ktrans_args[i][0] != 'V') and (args.ktrans_args[i][0] != 'v'):
+                ktrans_args.append('"{0}"'.format(args.ktrans_args[i]))
+            else:
+                ktrans_args.append('{0}'.format(args.ktrans_args[i]))
+
+        # setup ktrans command line args
+        ktrans_cmdline = ['"{0}"'.format(ktrans_path)]
+        ktrans_cmdline.extend(ktrans_args)
+        ktrans_cmdline = ' '.join(ktrans_cmdline)
+        if os.name != 'nt':
+            # no CreateProcess to split the command line for us
+            import shlex
+            ktrans_cmdline = shlex.split(ktrans_cmdline)
+
+        logger.debug("Starting ktrans as: '{}'".format(ktrans_cmdline))
+        # NOTE: we remap stderr to stdout as ktrans doesn't use those
+        # consistently (ie: uses stderr when it should use stdout and
+        # vice versa)
+        import subprocess
+        ktrans_proc = subprocess.Popen(ktrans_cmdline, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, cwd=args.output_dir)
+        (pstdout, _) = ktrans_proc.communicate()
+
+        # let caller know how we did
+        logger.debug("End of ktrans, ret: {0}".format(ktrans_proc.returncode))
+
+        # print ktrans output only on error or if we're not quiet
+        if (ktrans_proc.returncode != 0) or (not args.quiet) or args.verbose:
+            # TODO: we loose stdout/stderr interleaving here
+            # TODO: the error messages refer to lines in the temporary,
+            # preprocessed KAREL source file, not the original one.
+            (report or sys.stdout.write)(pstdout.decode('utf-8').replace(os.path.dirname(inpt), os.path.dirname(run_files[0])) + '\n')
+
+        span.set(returncode=ktrans_proc.returncode)
+        return ktrans_proc.returncode
+
+
+def translate_all(files, args, logger, report=None):
+    """translate() every one of 'files', those of class objects side by side
+       with the program, each ktrans run holding a job slot. Returns the
+       first non-zero exit code, if any.
+    """
+    outputs = set(pcode_output(f, args) for f in files)
+    if len(files) == 1 or len(outputs) < len(files):
+        # ktrans args name the .pc: every run writes that same file
+        rets = [translate(f, args, logger, report) for f in files]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        slots = jobserver(args)
+
+        def run(inpt):
+            with slots.slot():
+                return translate(inpt, args, logger, report)
+
+        with ThreadPoolExecutor(max_workers=len(files)) as pool:
+            rets = list(pool.map(run, files))
+    failed = [ret for ret in rets if ret != 0]
+    return failed[0] if failed else 0
+
+
+def translate(inpt, args, logger, report=None):
+    """run_ktrans, unless the .pc it would write is still there and was
+       translated from identical input with identical args. Skipping leaves
+       the .pc, and so its timestamp, alone, which lets ninja's 'restat = 1'
+       prune everything downstream of it.
+    """
+    stamp = KtransStamp(inpt, args)
+    if stamp.is_current():
+        logger.debug("{0} is up to date, not running ktrans".format(stamp.output))
+        return 0
+    ret = run_ktrans(inpt, args, logger, report)
+    if ret == 0:
+        stamp.save()
+    return ret
+
+
+class KtransStamp(object):
+    """what the .pc for a preprocessed source was translated from.
+
+       The digest covers the preprocessed source, the ktrans args, the
+       contents of any file passed in them and the ktrans binary. The text
+       of the include markers is left out: it names files in (temporary)
+       build dirs, while to ktrans it is just a comment line. It is stored
+       as STAMP_DIR/<name>.pc.json next to the .pc, together with the stat
+       signature of the .pc it describes, so a .pc that was replaced or
+       removed since is translated again.
+    """
 
-def make_classes(fil, output_file, folder, args, logger):
-    #search for class instantiations
+    def __init__(self, inpt, args):
+        self.output = pcode_output(inpt, args)
+        self.path = os.path.join(os.path.dirname(self.output), STAMP_DIR,
+            os.path.basename(self.output) + '.json')
+        self.digest = self._digest(inpt, args)
+
+    def is_current(self):
+        recorded = BuildCache._read_json(self.path)
+        sig = _stat_sig(self.output)
+        return (recorded is not None and sig is not None
+            and recorded.get('digest') == self.digest
+            and recorded.get('output') == list(sig))
+
+    def save(self):
+        sig = _stat_sig(self.output)
+        if sig is not None:
+            BuildCache._write_json(self.path, {'digest': self.digest, 'output': list(sig)})
+
+    @staticmethod
+    def _digest(inpt, args):
+        import hashlib
+        from shutil import which
+        h = hashlib.sha1()
+        with open(inpt, 'rb') as f:
+            h.update(_MARKER_TEXT_RE.sub(b'', f.read()))
+        ktrans_path = os.path.abspath(args.ktrans_path) if args.ktrans_path else which(KTRANS_BIN_NAME)
+        material = [KTRANSW_VERSION, os.path.basename(inpt), ktrans_path,
+            _stat_sig(ktrans_path) if ktrans_path else None]
+        for arg in args.ktrans_args:
+            if arg.endswith(KL_SUFFIX):
+                continue
+            # eg: '/config robot.ini'
+            material.append([arg, file_digest(arg) if os.path.isfile(arg) else None])
+        h.update(json.dumps(material).encode('utf-8'))
+        return h.hexdigest()
+
+
+_MARKER_TEXT_RE = re.compile(br'(?<=^-- INCLUDE_MARKER).*$', re.MULTILINE)
+
+
+def pcode_output(inpt, args):
+    """the .pc ktrans writes for 'inpt': the one named in the ktrans args,
+       or one named after 'inpt' in the output dir (the current directory,
+       unless compile_karel() was given one)
+    """
+    named = [arg for arg in args.ktrans_args if arg.lower().endswith(PCODE_SUFFIX)]
+    if named:
+        return os.path.abspath(named[0])
+    name = os.path.splitext(os.path.basename(inpt))[0]
+    return os.path.abspath(os.path.join(args.output_dir or '', name + PCODE_SUFFIX))
+
+
+def target_build_dir(kl_file, args):
+    """the directory in the --build-dir that 'kl_file' is preprocessed in,
+       or None without one. Each target gets its own: named after the
+       source, with a hash of the source and the .pc it is translated into,
+       so the same source built into different places doesn't collide.
+    """
+    base = args.build_dir
+    if not base and args.ram_build_dir:
+        ram = os.environ.get('KTRANSW_RAM_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+        if not ram:
+            raise KtranswError("ktransw: fatal error: no RAM disk to put the "
+                "build dir on, set KTRANSW_RAM_DIR\n", _OS_EX_DATAERR)
+        base = os.path.join(ram, RAM_BUILD_DIR)
+    if not base:
+        return None
+    import hashlib
+    source = os.path.abspath(kl_file)
+    key = hashlib.sha1('{0}\0{1}'.format(source, pcode_output(kl_file, args)).encode('utf-8'))
+    name = os.path.splitext(os.path.basename(kl_file))[0]
+    return os.path.join(os.path.abspath(base), '{0}-{1}'.format(name, key.hexdigest()[:12]))
+
+
+def _write_atomic(fname, text):
+    """write 'text' to 'fname' through a temporary file next to it, so a
+       compile of the same target running alongside (or ktrans) never reads
+       half a file
+    """
+    tmp = _tmp_name(fname)
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, fname)
 
-    #classes_file = os.path.join(dname, 'obj-' + os.path.basename(kl_file))
-    #pre_file = os.path.join(dname, 'pre-' + os.path.basename(kl_file))
-    #pass2_file = os.path.join(dname, 'pass2-' + os.path.basename(kl_file))
-    #fname = os.path.join(dname, os.path.basename(kl_file))
 
-    #classes = search_for_classes(kl_file, classes_file)
+def _tmp_name(fname):
+    return '{0}.{1}-{2}.tmp'.format(fname, os.getpid(), threading.get_ident())
 
-    #run through 1st pass to reveal any %class directives
-    pre_file = os.path.join(folder, 'pre-' + os.path.basename(fil))
-    run_gpp(fil, pre_file, args, logger)
-    remove_blank_lines(pre_file)
 
-    #remove leftover "`" characters from kransw_macros
-    # *** see docstring for details
-    remove_char(pre_file, "`")
+def make_classes(ctx, fil, output_file, source=None):
+    """run 'fil' through the gpp passes in the build dir of the
+       CompilationContext 'ctx', expanding the class objects it
+       instantiates along the way. With --pipe, 'source' may hold the lines
+       of 'fil', which then doesn't need to exist.
+    """
+    (folder, args, logger) = (ctx.folder, ctx.args, ctx.logger)
+    with trace('make_classes ' + os.path.basename(fil), 'classes', file=fil) as span:
+        #run through 1st pass to reveal any %class directives
+        pre_file = os.path.join(folder, 'pre-' + os.path.basename(fil))
+        lines = _gpp_stage(fil, source, pre_file, args, logger, 'pre')
+
+        #remove blank lines and leftover "`" characters from kransw_macros
+        # (*** see remove_char docstring for details), collect the class
+        #instantiations and replace any selective include declarations
+        #with function declarations
+        classes = []
+        used_headers = []
+        lines = rewrite_lines(lines, blank_lines=True, char="`", classes=classes,
+            include_dirs=args.include_dirs, used_headers=used_headers,
+            cache_dir=args.cache_dir)
+        ctx.class_injections.extend(classes)
+        ctx.selective_includes.extend(used_headers)
+        _materialise(pre_file, lines, args)
+
+        if len(classes) > 0:
+          #if classes is found create object files. Their headers are
+          #injected after the first pass
+          expand_class_objects(ctx, classes)
+
+        # do first pass
+        pass1_file = os.path.join(folder, 'pass1-' + os.path.basename(fil))
+        logger.debug("Storing preprocessed KAREL source at: {}".format(pass1_file))
+
+        #insert header inclusions back into original karel file
+        lines = rewrite_lines(_gpp_stage(pre_file, lines, pass1_file, args, logger, 'pass1'),
+            blank_lines=True, headers=HeaderIndex(ctx.header_injections, ctx.class_injections))
+        _materialise(pass1_file, lines, args)
+
+        #evaluate injections
+        pass2_file = os.path.join(folder, 'pass2-' + os.path.basename(fil))
+
+        #remove leftover "`" characters from kransw_macros
+        # *** see remove_char docstring for details
+        lines = rewrite_lines(_gpp_stage(pass1_file, lines, pass2_file, args, logger, 'pass2'), char="`")
+        _materialise(pass2_file, lines, args)
+
+        #do final gpp pass. ktrans needs this one on disk, always
+        lines = rewrite_lines(_gpp_stage(pass2_file, lines, output_file, args, logger, 'final'),
+            blank_lines=True)
+        _write_atomic(output_file, ''.join(lines))
+
+        #append processed file to ktrans list
+        ctx.kl_files.append(output_file)
+        if span.active:
+            span.set(bytes=_file_size(output_file))
+
+
+def _gpp_stage(inpt, lines, outpt, args, logger, stage):
+    """one gpp pass of make_classes, returning its output as a list of lines.
+
+       Normally gpp reads 'inpt' and writes 'outpt'. With --pipe it reads
+       'lines' (or 'inpt' if there are none yet) from stdin and writes to
+       stdout, so nothing touches the disk in between passes.
+    """
+    if args.pipe:
+        text = ''.join(lines) if lines is not None else None
+        return run_gpp(inpt, None, args, logger, text, stage).splitlines(True)
+    tmp = _tmp_name(outpt)
+    run_gpp(inpt, tmp, args, logger, stage=stage)
+    with open(tmp, 'r') as f:
+        lines = f.readlines()
+    os.replace(tmp, outpt)
+    return lines
+
+
+def _materialise(fname, lines, args):
+    """write an intermediate stage into the build dir: always when the next
+       gpp pass is going to read it from there, with --pipe only for -k
+    """
+    if not args.pipe or args.keep_buildd:
+        _write_atomic(fname, ''.join(lines))
 
-    #add to list of class injections
-    classes = search_for_classes(pre_file, pre_file)
-    class_injections.extend(classes)
 
-    #find any selective include declarations and replace them
-    #with function declarations
-    search_for_selective_include(pre_file, args.include_dirs)
+def expand_class_objects(ctx, objects):
+    """expand_class_object() every one of 'objects'.
 
-    # do first pass
-    pass1_file = os.path.join(folder, 'pass1-' + os.path.basename(fil))
-    logger.debug("Storing preprocessed KAREL source at: {}".format(pass1_file))
+       Sibling objects don't depend on each other, so each one that can get
+       a job slot (see jobserver()) is expanded on a thread of its own, in
+       a child context. Those are merged into 'ctx' in the order of
+       'objects' afterwards, which is the order expanding them one after
+       the other would have appended in, so the output is the same.
+    """
+    if len(objects) == 1:
+        expand_class_object(ctx, objects[0])
+        return
+
+    slots = jobserver(ctx.args)
+    parts = [ctx.child() for _ in objects]
+    expansions = []
+    # the last one (and any that don't get a slot) on this thread
+    for (i, (obj, part)) in enumerate(zip(objects, parts)):
+        token = slots.try_acquire() if i < len(objects) - 1 else None
+        expansion = _ExpansionThread(slots, token, part, obj)
+        if token is None:
+            expansion.run()
+        else:
+            expansion.start()
+        expansions.append(expansion)
+    for expansion in expansions:
+        if expansion.token is not None:
+            expansion.join()
+    # the error expanding them one after the other would have stopped at
+    for expansion in expansions:
+        if expansion.error is not None:
+            raise expansion.error
+
+    for part in parts:
+        ctx.merge(part)
+
+
+class _ExpansionThread(threading.Thread):
+    """expand_class_object() in the job slot 'token', or when run() on the
+       calling thread, in the slot of that
+    """
 
-    run_gpp(pre_file, pass1_file, args, logger)
-    remove_blank_lines(pass1_file)
+    def __init__(self, slots, token, *expand_args):
+        threading.Thread.__init__(self, name='ktransw-class', daemon=True)
+        self.slots = slots
+        self.token = token
+        self.expand_args = expand_args
+        self.error = None
 
-    if len(classes) > 0:
-      #if classes is found create object files do 2nd pass
-      for obj in classes:
+    def run(self):
+        try:
+            expand_class_object(*self.expand_args)
+        except BaseException as e:
+            self.error = e
+        finally:
+            if self.token is not None:
+                self.slots.release(self.token)
+
+
+def expand_class_object(ctx, obj):
+    """create the object file and header for a single %class instantiation
+       and run it through make_classes.
+
+       Instantiations are keyed on the object name, the contents of the
+       class, header and template files and the macros. An expansion is
+       kept in the class cache of 'ctx' (by default '_class_cache', which
+       lives as long as this process) and, with a cache directory, in the
+       workspace wide store as well, so a class used by many programs is
+       only run through gpp once per build.
+    """
+    (folder, args, logger) = (ctx.folder, ctx.args, ctx.logger)
+    with trace('class ' + obj[1], 'classes', object=obj[1], files=obj[2:]) as span:
         #make object file and preprocess
         obj_file = os.path.join(folder, os.path.basename('obj-'+obj[1]+".kl"))
         obj_processed = os.path.join(folder, os.path.basename(obj[1]+".kl"))
-        #make header inclusion and preprocess
-        header_injections.append(os.path.join(folder, os.path.basename('pre-'+obj[1]+".klh")))
+        hdr_file = os.path.join(folder, os.path.basename('pre-'+obj[1]+".klh"))
+
+        key = class_object_key(obj, args)
+        cached = ctx.class_cache.get(key)
+        if cached is None or not cached.is_current():
+            cached = None
+            if ctx.build_cache:
+                entry = ctx.build_cache.lookup(key)
+                if entry:
+                    cached = _ClassExpansion.from_entry(entry)
+                    ctx.class_cache[key] = cached
+        if cached is not None:
+            logger.debug("Reusing expansion of class object '{0}'".format(obj[1]))
+            span.set(cached=True)
+            cached.replay(ctx)
+            return
 
-        #create object file
-        create_object(obj, obj_file)
+        #make header inclusion and preprocess
+        ctx.header_injections.append(hdr_file)
+        marks = (len(ctx.kl_files), len(ctx.header_injections) - 1,
+                 len(ctx.class_injections), len(ctx.selective_includes))
+
+        #create object file, with --pipe only if we're asked to keep it
+        source = None
+        if args.pipe:
+            source = object_source(obj)
+        if not args.pipe or args.keep_buildd:
+            create_object(obj, obj_file)
         #create header file for object
-        create_object_hdr(obj, header_injections[-1])
+        create_object_hdr(obj, hdr_file)
 
         # recursively loop through object files
-        make_classes(obj_file, obj_processed, folder, args, logger)
+        make_classes(ctx, obj_file, obj_processed, source)
+        expansion = _ClassExpansion.record(ctx, marks)
+        ctx.class_cache[key] = expansion
+        if ctx.build_cache:
+            expansion.save(ctx.build_cache, key, folder)
 
-    #insert header inclusions back into original karel file
-    insert_headers(pass1_file, header_injections, class_injections)
-    #evaluate injections
-    pass2_file = os.path.join(folder, 'pass2-' + os.path.basename(fil))
-    run_gpp(pass1_file, pass2_file, args, logger)
 
-    #remove leftover "`" characters from kransw_macros
-    # *** see docstring for details
-    remove_char(pass2_file, "`")
+def class_object_key(obj, args):
+    """cache key of a %class instantiation: object name, the contents of the
+       class, header and (optional) template file and the gpp setup
+    """
+    material = ['class', KTRANSW_VERSION, obj[1]]
+    for name in obj[2:]:
+        path = _resolve_include(name, args.include_dirs)
+        material.append([name, file_digest(path) if path else None])
+    material.extend([list(args.user_macros), list(args.include_dirs),
+        gpp_identity(args), os.getcwd()])
+    import hashlib
+    return hashlib.sha1(json.dumps(material).encode('utf-8')).hexdigest()
+
+
+class _ClassExpansion(object):
+    """everything expanding a class object left behind: the object source
+       and the header injected for it (plus those of any classes it
+       instantiates in turn), its entries in the module level lists and the
+       stat signatures of every file gpp read while producing them.
+    """
+    def __init__(self, files, kl_names, hdr_names, classes, selective, deps):
+        self.files = files
+        self.kl_names = kl_names
+        self.hdr_names = hdr_names
+        self.classes = classes
+        self.selective = selective
+        self.deps = deps
+
+    @classmethod
+    def record(cls, ctx, marks):
+        """what expanding a class object in 'ctx' added since 'marks' (the
+           lengths of the lists of 'ctx' before)
+        """
+        new_kl = ctx.kl_files[marks[0]:]
+        new_hdrs = ctx.header_injections[marks[1]:]
+        files = {}
+        for path in new_kl + new_hdrs:
+            with open(path, 'r') as f:
+                files[os.path.basename(path)] = f.read()
+
+        selective = ctx.selective_includes[marks[3]:]
+        deps = collect_dependencies(new_kl, selective, ctx.folder, ctx.args.include_dirs)
+
+        return cls(files, [os.path.basename(f) for f in new_kl],
+            [os.path.basename(f) for f in new_hdrs],
+            [list(c) for c in ctx.class_injections[marks[2]:]], selective,
+            dict((p, _stat_sig(p)) for p in deps))
+
+    @classmethod
+    def from_entry(cls, entry):
+        files = {}
+        for name in entry.meta['kl_files'] + entry.meta['headers']:
+            with open(os.path.join(entry.path, name), 'r') as f:
+                files[name] = f.read()
+        return cls(files, entry.meta['kl_files'], entry.meta['headers'],
+            entry.meta['classes'], entry.meta['selective'],
+            dict((p, _stat_sig(p)) for p in entry.deps))
+
+    def save(self, cache, key, folder):
+        cache.store(key, list(self.deps.keys()),
+            [os.path.join(folder, n) for n in self.kl_names + self.hdr_names],
+            {'kl_files': self.kl_names, 'headers': self.hdr_names,
+             'classes': self.classes, 'selective': self.selective})
+
+    def is_current(self):
+        return all(_stat_sig(path) == sig for path, sig in self.deps.items())
+
+    def replay(self, ctx):
+        folder = ctx.folder
+        for name, text in self.files.items():
+            _write_atomic(os.path.join(folder, name), text)
+        ctx.header_injections.extend([os.path.join(folder, n) for n in self.hdr_names])
+        ctx.class_injections.extend([list(c) for c in self.classes])
+        ctx.selective_includes.extend(self.selective)
+        ctx.kl_files.extend([os.path.join(folder, n) for n in self.kl_names])
+
+
+def collect_dependencies(outputs, selective, folder, include_dirs):
+    """every file outside of 'folder' that went into 'outputs': all files
+       gpp entered (according to their include markers) and the headers
+       used by '%from .. %import' ('selective')
+    """
+    deps = dict.fromkeys(selective)
+    for path in outputs:
+        for hdr in get_includes_from_file(path):
+            hdr_path = _resolve_include(hdr, include_dirs)
+            if hdr_path and not _is_in_dir(hdr_path, folder):
+                deps.setdefault(hdr_path)
+    return list(deps)
+
+
+def file_digest(path):
+    """sha1 of the contents of 'path' (None if it doesn't exist), remembered
+       for as long as its stat signature doesn't change
+    """
+    sig = _stat_sig(path)
+    if sig is None:
+        return None
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    _digest_cache[path] = (sig, h.hexdigest())
+    return h.hexdigest()
+
+
+def gpp_identity(args):
+    """something that changes whenever the preprocessor used does"""
+    from shutil import which
+    gpp_path = os.path.abspath(args.gpp_path) if args.gpp_path else which(GPP_BIN_NAME)
+    identity = [gpp_path, _stat_sig(gpp_path) if gpp_path else None]
+    if getattr(args, 'engine', 'gpp') == 'builtin':
+        import pygpp
+        identity.extend(['builtin', pygpp.ENGINE_VERSION])
+    return identity
+
+
+def parse_size(text):
+    """'500M' -> 524288000"""
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    m = re.match(r'^\s*(\d+)\s*([KMG]?)B?\s*$', text, re.IGNORECASE)
+    if not m:
+        raise ValueError(text)
+    return int(m.group(1)) * units[m.group(2).upper()]
+
+
+class BuildCache(object):
+    """content-addressed, on-disk cache for the output of make_classes.
+
+       Lookups take two steps. The input key hashes everything known before
+       gpp runs (source, macros, include dirs, gpp binary). It points to a
+       short list of candidates, each recording the content hash of every
+       file gpp entered while producing it. A candidate is a hit if all of
+       those files still hash the same, in which case its result (the final
+       preprocessed .kl files and the class object list) is used as is.
+
+       All writes go through a rename, so concurrent compiles sharing a
+       cache directory never see partial entries.
+    """
 
-    #do final gpp pass
-    run_gpp(pass2_file, output_file, args, logger)
-    remove_blank_lines(output_file)
+    MAX_CANDIDATES = 8
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def input_key(self, source, args):
+        import hashlib
+        h = hashlib.sha1()
+        material = [KTRANSW_VERSION, os.path.abspath(source), file_digest(source),
+            list(args.user_macros), list(args.include_dirs), gpp_identity(args),
+            os.getcwd()]
+        h.update(json.dumps(['program'] + material).encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key):
+        for candidate in self._read_json(self._index_path(key)) or []:
+            if all(file_digest(p) == d for (p, d) in candidate['deps'].items()):
+                entry = CacheEntry.load(self._result_path(candidate['result']),
+                    list(candidate['deps'].keys()))
+                if entry:
+                    self._count('hits')
+                    return entry
+        self._count('misses')
+        return None
+
+    def store(self, key, deps, files, meta):
+        import hashlib
+        digests = dict((p, file_digest(p)) for p in deps)
+        h = hashlib.sha1(key.encode('utf-8'))
+        h.update(json.dumps(sorted(digests.items())).encode('utf-8'))
+        result = h.hexdigest()
+
+        CacheEntry.save(self._result_path(result), files, meta)
+
+        index_path = self._index_path(key)
+        candidates = [c for c in self._read_json(index_path) or []
+            if c['result'] != result]
+        candidates.insert(0, {'deps': digests, 'result': result})
+        self._write_json(index_path, candidates[:self.MAX_CANDIDATES])
+
+    def stats(self):
+        entries = 0
+        size = 0
+        for (path, entry_size, _) in self._results():
+            entries += 1
+            size += entry_size
+        return {'hits': self._counter('hits'), 'misses': self._counter('misses'),
+            'entries': entries, 'size': size}
+
+    def evict(self, max_size):
+        """drop least recently used results until the cache fits in 'max_size'
+           bytes. Index entries pointing to evicted results are simply misses.
+        """
+        from shutil import rmtree
+        results = sorted(self._results(), key=lambda r: r[2])
+        total = sum(r[1] for r in results)
+        removed = 0
+        for (path, entry_size, _) in results:
+            if total <= max_size:
+                break
+            rmtree(path, ignore_errors=True)
+            total -= entry_size
+            removed += 1
+        return removed
+
+    def _results(self):
+        """(path, size, last use) of every stored result"""
+        results_dir = os.path.join(self.root, 'results')
+        if not os.path.isdir(results_dir):
+            return
+        for bucket in os.scandir(results_dir):
+            if not bucket.is_dir():
+                continue
+            for result in os.scandir(bucket.path):
+                try:
+                    files = list(os.scandir(result.path))
+                    last_use = os.stat(os.path.join(result.path, CacheEntry.META)).st_mtime
+                except OSError:
+                    continue
+                yield (result.path, sum(f.stat().st_size for f in files), last_use)
 
-    #append processed file to ktrans list
-    kl_files.append(output_file)
+    def load_symbols(self, digest):
+        """the stored HeaderSymbols of the header with sha1 'digest'"""
+        data = self._read_json(self._symbols_path(digest))
+        if not data or data.get('version') != HeaderSymbols.VERSION:
+            return None
+        return HeaderSymbols.from_json(data)
 
+    def store_symbols(self, digest, symbols):
+        self._write_json(self._symbols_path(digest), symbols.to_json())
 
+    def _index_path(self, key):
+        return os.path.join(self.root, 'index', key[:2], key + '.json')
 
-def search_for_classes(inpt, outpt):
-    # match %class name('class.klc','class.klh',<'class.klt'>)
-    pattern = r"(?:\%class\s*)(\w+)\s*\(\s*'(\w+.\w+)'(?:\s*,\s*'(\w+.\w+)')(?:\s*,\s*'(\w+.\w+)')*\s*\)"
-    objects =[]
-    with open(inpt, 'r+') as inf:
-      lines = inf.readlines()
-      k = 1
-      for i in range(len(lines)):
-        m = re.match(pattern, lines[i])
-        if m:
-          #make a list in the format (index, object_name, class_file, header_file, type_name, type_file)
-          obj = []
-          obj.append(k)
-          for j in range(1,m.lastindex+1):
-            obj.append(m.group(j))
-          objects.append(obj)
-          
-          #replace line with include marker for later insersion
-          lines[i] = "-- INCLUDE_MARKER {0}:{1}:1\n".format(k,m.group(1))
-          k += 1
-    
-    with open(outpt, 'w') as inf:
-        inf.seek(0)
-        inf.write(''.join(lines))
-        inf.truncate()
+    def _symbols_path(self, digest):
+        return os.path.join(self.root, 'symbols', digest[:2], digest + '.json')
+
+    def _result_path(self, result):
+        return os.path.join(self.root, 'results', result[:2], result)
+
+    def _count(self, counter):
+        db = self._stats_db()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            self._add(db, counter, 1)
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    @staticmethod
+    def _add(db, counter, n):
+        db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (counter,))
+        db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (n, counter))
+
+    def _counter(self, counter):
+        db = self._stats_db()
+        try:
+            row = db.execute('SELECT value FROM counters WHERE name = ?', (counter,)).fetchone()
+            return row[0] if row else 0
+        finally:
+            db.close()
+
+    def _stats_db(self):
+        """the hit / miss counters: one row each, however long the cache
+           lives
+        """
+        import sqlite3
+        os.makedirs(self.root, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.root, 'stats.db'), timeout=60,
+            isolation_level=None)
+        db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, '
+            'value INTEGER NOT NULL)')
+        # counted by earlier versions, one byte per event
+        legacy = os.path.join(self.root, 'stats')
+        if os.path.isdir(legacy):
+            db.execute('BEGIN IMMEDIATE')
+            for entry in os.scandir(legacy):
+                self._add(db, entry.name, entry.stat().st_size)
+                os.remove(entry.path)
+            db.execute('COMMIT')
+            try:
+                os.rmdir(legacy)
+            except OSError:
+                pass
+        return db
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+
+class CacheEntry(object):
+    """a stored result: a set of files plus whatever the producer needs to
+       know about them ('meta')
+    """
 
+    META = 'meta.json'
+
+    def __init__(self, path, meta, deps):
+        self.path = path
+        self.meta = meta
+        self.deps = deps
+
+    @classmethod
+    def load(cls, path, deps):
+        meta_path = os.path.join(path, cls.META)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            # mark as recently used for LRU eviction
+            os.utime(meta_path, None)
+        except (OSError, ValueError):
+            return None
+        return cls(path, meta, deps)
+
+    @classmethod
+    def save(cls, path, files, meta):
+        if os.path.isdir(path):
+            return
+        from shutil import copyfile
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp)
+        for f in files:
+            copyfile(f, os.path.join(tmp, os.path.basename(f)))
+        with open(os.path.join(tmp, cls.META), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # somebody else stored the same result first
+            from shutil import rmtree
+            rmtree(tmp, ignore_errors=True)
+
+    def restore(self, ctx):
+        """restore a make_classes result for a program into the build dir
+           of 'ctx'
+        """
+        from shutil import copyfile
+        folder = ctx.folder
+        names = self.meta['kl_files']
+        for name in names:
+            dest = os.path.join(folder, name)
+            tmp = _tmp_name(dest)
+            copyfile(os.path.join(self.path, name), tmp)
+            os.replace(tmp, dest)
+        ctx.kl_files.extend([os.path.join(folder, n) for n in names])
+        ctx.class_injections.extend([list(c) for c in self.meta['classes']])
+
+
+def _stat_sig(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _is_in_dir(path, folder):
+    folder = os.path.join(os.path.abspath(folder), '')
+    return os.path.abspath(path).startswith(folder)
+
+
+def _resolve_include(hdr, include_dirs):
+    """return the path of a header as gpp reported it in an include marker,
+       or None if it can't be found (anymore)
+    """
+    if os.path.isabs(hdr) or os.path.exists(hdr):
+        return hdr
+    try:
+        return os.path.join(find_hdr_in_incdirs(hdr, include_dirs), hdr)
+    except ValueError:
+        return None
+
+
+def _read_lines_cached(path):
+    """readlines() for headers, served from memory while the file is unchanged"""
+    sig = _stat_sig(path)
+    cached = _header_cache.get(path)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    _header_cache[path] = (sig, lines)
+    return lines
+
+
+# match %class name('class.klc','class.klh',<'class.klt'>)
+_CLASS_RE = re.compile(r"(?:\%class\s*)(\w+)\s*\(\s*'(\w+.\w+)'(?:\s*,\s*'(\w+.\w+)')(?:\s*,\s*'(\w+.\w+)')*\s*\)")
+# match %from header.klh %import func1, func2
+_FROM_RE = re.compile(r"(?:\%from\s*)([a-zA-Z_.0-9]*)(?:\s*\%import\s*)(\w+,?(\s*\w+,?)*)")
+# match the markers %class instantiations are replaced with
+_CLASS_MARKER_RE = re.compile(r"(?:--\s*INCLUDE_MARKER\s*(\d+)\:(\w+)\:1)")
+
+
+def rewrite_lines(lines, blank_lines=False, char=None, classes=None,
+                  include_dirs=None, used_headers=None, headers=None,
+                  cache_dir=None):
+    """apply the fixups make_classes needs after a gpp pass to 'lines', all
+       in a single pass, and return the result:
+
+         blank_lines   drop empty lines
+         char          remove this character (see remove_char)
+         classes       replace %class instantiations by include markers and
+                       append them to this list, in the format (index,
+                       object_name, class_file, header_file, type_name,
+                       type_file)
+         used_headers  replace '%from header.klh %import func1, func2' by
+                       the declarations of those functions, searching
+                       'include_dirs', and append the headers used. With a
+                       'cache_dir' their HeaderSymbols are stored there
+         headers       a HeaderIndex, to replace the markers of class
+                       objects by their header
+    """
+    with trace('fixups', 'fixups') as span:
+        if span.active:
+            span.set(fixups=_fixup_names(blank_lines, char, classes, used_headers, headers),
+                lines_in=len(lines))
+        out = []
+        k = 1
+        for line in lines:
+          if blank_lines and line.strip() == "":
+            continue
+          if char is not None and char in line:
+            line = line.replace(char, "")
+
+          # every directive we rewrite starts with one of these, which is a
+          # lot cheaper to test for than running the regexes on every line
+          if line.startswith('%'):
+            if classes is not None:
+              m = _CLASS_RE.match(line)
+              if m:
+                obj = [k]
+                for j in range(1,m.lastindex+1):
+                  obj.append(m.group(j))
+                classes.append(obj)
+
+                #replace line with include marker for later insersion
+                line = "-- INCLUDE_MARKER {0}:{1}:1\n".format(k,m.group(1))
+                k += 1
+            if used_headers is not None:
+              m = _FROM_RE.match(line)
+              if m:
+                line = selective_declarations(m.group(1), m.group(2), include_dirs,
+                  used_headers, cache_dir)
+          elif headers is not None and line.startswith('--'):
+            m = _CLASS_MARKER_RE.match(line)
+            if m:
+              line = headers.get(m.group(1), m.group(2), line)
+          out.append(line)
+        span.set(lines_out=len(out))
+        return out
+
+
+def _fixup_names(blank_lines, char, classes, used_headers, headers):
+    names = [('blank_lines', blank_lines), ('char', char is not None),
+        ('classes', classes is not None), ('selective_includes', used_headers is not None),
+        ('headers', headers is not None)]
+    return [name for (name, on) in names if on]
+
+
+class HeaderIndex(object):
+    """the headers to inject for the markers of class objects: objects are
+       looked up by index and name, and each header is read only once
+    """
+    def __init__(self, header_injections, objects):
+        self.objects = set((str(obj[0]), obj[1]) for obj in objects)
+        self.paths = {}
+        for hdr in header_injections:
+            self.paths.setdefault(os.path.basename(hdr), hdr)
+        self.contents = {}
+
+    def get(self, index, name, default):
+        """contents of the header of object 'name' created for marker
+           'index', or 'default' if no such object was instantiated
+        """
+        if (index, name) not in self.objects:
+            return default
+        text = self.contents.get(name)
+        if text is None:
+            #find associating header file
+            fle = self.paths.get('pre-' + name + '.klh')
+            if not fle:
+              raise Exception('header file {0} was not created'.format(name))
+            with open(fle,"r") as h:
+              text = h.read()
+            self.contents[name] = text
+        return text
+
+
+def _rewrite_file(inpt, outpt, **fixups):
+    """apply rewrite_lines() to the contents of 'inpt', writing them to 'outpt'"""
+    with open(inpt, 'r') as f:
+        lines = f.readlines()
+    lines = rewrite_lines(lines, **fixups)
+    with open(outpt, 'w') as f:
+        f.write(''.join(lines))
+
+
+def search_for_classes(inpt, outpt):
+    objects = []
+    _rewrite_file(inpt, outpt, classes=objects)
     return objects
 
+def object_source(obj):
+    #define a class_name for the .klc file to evaluate
+    lines = [r"%defeval class_name {0}".format(obj[1]) + '\n']
+    #define a type_name for the .klc file to evaluate if it exists
+    if len(obj) > 4:
+      lines.append(r"%include {0}".format(obj[4]) + '\n')
+    #call the class '.klc' file
+    lines.append(r"%include {0}".format(obj[2]) + '\n')
+    return lines
+
 def create_object(obj, fname):
-    with open(fname,"w+") as f:
-      #define a class_name for the .klc file to evaluate
-      f.write(r"%defeval class_name {0}".format(obj[1]) + '\n')
-      #define a type_name for the .klc file to evaluate if it exists
-      if len(obj) > 4:
-        f.write(r"%include {0}".format(obj[4]) + '\n')
-      #call the class '.klc' file
-      f.write(r"%include {0}".format(obj[2]) + '\n')
+    _write_atomic(fname, ''.join(object_source(obj)))
 
 def create_object_hdr(obj, fname):
-    with open(fname,"w+") as f:
-      f.write(r"%defeval class_name {0}".format(obj[1]) + '\n')
-      if len(obj) > 4:
-        f.write(r"%include {0}".format(obj[4]) + '\n')
-      #process header file
-      f.write(r"%include {0}".format(obj[3]) + '\n')
+    lines = [r"%defeval class_name {0}".format(obj[1]) + '\n']
+    if len(obj) > 4:
+      lines.append(r"%include {0}".format(obj[4]) + '\n')
+    #process header file
+    lines.append(r"%include {0}".format(obj[3]) + '\n')
+    _write_atomic(fname, ''.join(lines))
 
 def insert_headers(fname, header_injections, objects):
-    pattern = r"(?:--\s*INCLUDE_MARKER\s*(\d+)\:(\w+)\:1)".format('|'.join([obj[1] for obj in objects]))
-
-    with open(fname,"r+") as f:
-      lines = f.readlines()
-      for i in range(len(lines)):
-        m = re.match(pattern, lines[i])
-        if m:
-          for obj in objects:
-            if str(obj[0]) == m.group(1) and obj[1] == m.group(2):
-              #find associating header file
-              search = m.group(2) + '.klh'
-              fle = [hdr for hdr in header_injections if (search in os.path.basename(hdr))][0]
-              if not fle:
-                raise Exception('header file {0} was not created'.format(m.group(2)))
-              with open(fle,"r") as h:
-                inclusion = h.read()
-              #include header into main file
-              lines[i] = inclusion
-              break
-
-      #write back into file
-      f.seek(0)
-      f.write(''.join(lines))
-      f.truncate()
+    _rewrite_file(fname, fname, headers=HeaderIndex(header_injections, objects))
 
 
 def remove_char(fname, char):
@@ -543,148 +2412,505 @@ def remove_char(fname, char):
     
     """
 
-    with open(fname, 'r+') as f:
-      data = f.read()
-      data = data.replace(char, "")
-      #write back into file
-      f.seek(0)
-      f.write(data)
-      f.truncate()
+    _rewrite_file(fname, fname, char=char)
 
 def findWholeWord(w):
     """return if only full words are found, or a word with a preceeding '_'
     """
-    return re.compile(r'(?:\b|_)({0})(?:\b)'.format(w), flags=re.IGNORECASE).search
+    return findWholeWords([w])
 
-def isLineCont(prog, idx, out_string):
-    """function makes sure to absorb line continutations for parsing
-       out routine defintions in header files (i.e. look at def search_for_selective_include)
+def findWholeWords(words):
+    """findWholeWord() for any of 'words' at once: a single search, for a
+       single regex. Longer words go first, which saves backtracking when
+       one is a prefix of another.
+    """
+    words = sorted(set(words), key=lambda w: (-len(w), w))
+    if not words:
+      return lambda line: None
+    alternation = '|'.join(re.escape(w) for w in words)
+    return re.compile(r'(?:\b|_)(?:{0})\b'.format(alternation), flags=re.IGNORECASE).search
+
+#the lines of a header '%from .. %import' always copies
+NAMESPACE_DEFINES = ('%define prog_name', '%define prog_name_alias')
+_WORD_RE = re.compile(r'\w+')
+
+def _declaration(lines, j):
+    """line 'j' of a header, plus the lines it is continued on ('&')"""
+    text = lines[j]
+    while lines[j].rstrip().endswith('&') and j + 1 < len(lines):
+      j += 1
+      text += lines[j]
+    return text
+
+def selective_declarations(header, imports, include_dirs, used_headers, cache_dir=None):
+    """the text replacing '%from <header> %import <imports>': the namespace
+       and the declarations of the imported functions found in 'header'.
+       With a 'cache_dir' these are looked up in the header's HeaderSymbols,
+       otherwise the header is scanned.
+    """
+    #find file in include directories
+    head_file = ''
+    try:
+      head_file = os.path.join(find_hdr_in_incdirs(header, include_dirs), header)
+    except ValueError:
+      pass
+
+    if not head_file:
+      raise Exception('{0} was not found in any include directory.'.format(header))
+
+    #split specified functions into list (ignoring a trailing ',')
+    funcs = [f for f in imports.replace(" ", "").split(',') if f]
+
+    if cache_dir:
+      insert_string = header_symbols(head_file, cache_dir).declarations(funcs)
+    else:
+      insert_string = scan_declarations(_read_lines_cached(head_file), funcs)
+    used_headers.append(head_file)
+
+    return insert_string
+
+
+def scan_declarations(lines, funcs):
+    """go through the lines of a header and pick out the namespace and the
+       declarations of 'funcs'
+    """
+    #make sure only full words match
+    declares = findWholeWords(funcs)
+    #start insersion string
+    parts = ['%include namespace.m' + '\n']
+    for j in range(len(lines)):
+      #look for namespace delarations
+      if any(nspace in lines[j] for nspace in NAMESPACE_DEFINES):
+        parts.append(lines[j])
+      #look for function declarations
+      if declares(lines[j]):
+        parts.append(_declaration(lines, j))
+    return ''.join(parts)
+
+
+def header_symbols(path, cache_dir):
+    """the HeaderSymbols of the header at 'path': from memory, from the
+       cache or parsed (and stored), keyed on the contents of the header
+    """
+    digest = file_digest(path)
+    symbols = _symbol_cache.get(digest)
+    if symbols is None:
+      cache = BuildCache(cache_dir)
+      symbols = cache.load_symbols(digest)
+      if symbols is None:
+        with open(path, 'r') as f:
+          symbols = HeaderSymbols.parse(f.readlines())
+        cache.store_symbols(digest, symbols)
+      _symbol_cache[digest] = symbols
+    return symbols
+
+
+class HeaderSymbols(object):
+    """a header parsed for '%from .. %import': its namespace defines, and
+       for every symbol the lines (with their continuations) that
+       scan_declarations() would pick for it.
+
+       Like findWholeWord(), a symbol matches a word case-insensitively,
+       either whole or following an '_' in it: 'foo' matches 'foo' and
+       'bar__foo'. Every suffix of a word starting after an '_' is
+       therefore indexed as well.
     """
-    line = prog[idx].rstrip()
-    if line[-1] == '&':
-      out_string += prog[idx+1]
-      if idx+1 <= len(prog):
-        isLineCont(prog, idx+1, out_string)
-    
-    return out_string
-    
+
+    VERSION = 1
+
+    def __init__(self, namespace, decls, symbols):
+        # line number -> text of the namespace defines
+        self.namespace = namespace
+        # line number -> declaration starting on that line
+        self.decls = decls
+        # lower case symbol -> line numbers
+        self.symbols = symbols
+
+    @classmethod
+    def parse(cls, lines):
+        namespace = {}
+        decls = {}
+        symbols = {}
+        for (j, line) in enumerate(lines):
+          if any(nspace in line for nspace in NAMESPACE_DEFINES):
+            namespace[j] = line
+          words = set()
+          for word in _WORD_RE.findall(line.lower()):
+            words.add(word)
+            i = word.find('_')
+            while i >= 0:
+              if i + 1 < len(word):
+                words.add(word[i + 1:])
+              i = word.find('_', i + 1)
+          if words:
+            decls[j] = _declaration(lines, j)
+            for word in words:
+              symbols.setdefault(word, []).append(j)
+        return cls(namespace, decls, symbols)
+
+    def declarations(self, funcs):
+        """what scan_declarations() would return for 'funcs'"""
+        matched = set()
+        for func in funcs:
+          matched.update(self.symbols.get(func.lower(), ()))
+
+        insert_string = '%include namespace.m' + '\n'
+        for j in sorted(matched.union(self.namespace)):
+          if j in self.namespace:
+            insert_string += self.namespace[j]
+          if j in matched:
+            insert_string += self.decls[j]
+        return insert_string
+
+    def to_json(self):
+        return {'version': self.VERSION,
+            'namespace': sorted(self.namespace.items()),
+            'decls': sorted(self.decls.items()),
+            'symbols': self.symbols}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(dict((j, t) for (j, t) in data['namespace']),
+            dict((j, t) for (j, t) in data['decls']), data['symbols'])
 
 
 def search_for_selective_include(inpt, include_dirs):
     """search for selective includes '%from header.klh %import func1, func2'
        Then find an look through header file for selective header declartions
     """
-    # match %from header.klh %import func1, func2
-    pattern = r"(?:\%from\s*)([a-zA-Z_.0-9]*)(?:\s*\%import\s*)(\w+,?(\s*\w+,?)*)"
-    #selective include dictionary
-    sinc_dictionary = {}
-
-    with open(inpt,"r+") as f:
-      lines = f.readlines()
-      for i in range(len(lines)):
-        m = re.match(pattern, lines[i])
-        if m:
-          #find file in include directories
-          head_file = ''
-          for head_dir in include_dirs:
-            if os.path.exists(head_dir + '\\' + m.group(1)):
-              head_file = head_dir + '\\' + m.group(1)
-              break
-          
-          if head_file:
-            #start insersion string
-            insert_string = '%include namespace.m' + '\n'
-
-            #split specified functions into list
-            fs = m.group(2).replace(" ", "")
-            funcs = fs.split(',')
-
-            #go through header file and pick out sepecified
-            #function declarations
-            with open(head_file,'r') as f_head:
-              h_line = f_head.readlines()
-              for j in range(len(h_line)):
-                #look for namespace delarations
-                if any(nspace in h_line[j] for nspace in ['%define prog_name', '%define prog_name_alias']):
-                  insert_string += h_line[j]
-                #look for function declarations
-                #make sure only full words match
-                if any(findWholeWord(func)(h_line[j]) for func in funcs):
-                  insert_string += h_line[j]
-                  insert_string = isLineCont(h_line, j, insert_string)
-
-            
-            #replace line in input file with the insert_string
-            #holding the function declarations
-            lines[i] = insert_string
-          else:
-            raise Exception('{0} was not found in any include directory.'.format(m.group(1)))
-      
-      #write back into file
-      f.seek(0)
-      f.write(''.join(lines))
-      f.truncate()
-
-def write_manifest(manifest, files, parent):
-    file_list = dict()
-
-    #remove parent from files
-    children = [f for f in files if f not in parent]
-
-    #replace extensions with their conversions
-    for i in range(len(children)):
-      ext = os.path.splitext(children[i])[-1]
-      if ext in EXT_MAP.keys():
-        children[i] = os.path.splitext(children[i])[0] + EXT_MAP[ext]['conversion']
-
-    #replace parent extension with conversion
-    if os.path.splitext(parent)[-1] in EXT_MAP.keys():
-      parent = os.path.splitext(parent)[0] + EXT_MAP[os.path.splitext(parent)[-1]]['conversion']
-    
-    if os.path.exists(manifest):
-      file_list = None
-      with open(manifest, 'r') as man:
-        # ..todo:: issue with opening .man_log file concurrently numerous times through
-        #          ninja throwing "AttributeError: 'NoneType' object has no attribute 'keys'"
-        #          something is blocking while trying to open .man_log. The looping solution
-        #          below is an intermediary patch.
-        while file_list is None:
-          file_list = yaml.safe_load(man)
-          time.sleep(0.1)
-    
-        vals = {}
-        found = False
-        for key in file_list.keys():
-          if isinstance(file_list[key], dict) and (key in DATA_TYPES):
-            sub_dict = file_list[key]
-            if parent in sub_dict.keys():
-              #retrieve list
-              vals = set(sub_dict[parent])
-              vals.update(set(children))
-              file_list[key][parent] = list(vals)
-              found = True
-
-        #insert into dictionary if parent not in manifest
-        if found == False:
-          file_list['karel'] = {}
-          vals = set(children)
-          file_list['karel'][parent] = list(vals)
-
-      #save back to yaml file
-      with open(manifest, 'w') as man:
-        yaml.dump(file_list, man)
-        man.close()
-
-
-GPP_OP_ENTER='1'
-GPP_OP_EXIT='2'
+    #headers declarations were taken from
+    used_headers = []
+    _rewrite_file(inpt, inpt, include_dirs=include_dirs, used_headers=used_headers)
+    return used_headers
+
+def write_manifest(manifest, files, parent, export=True):
+    """record 'files' as the children of 'parent' in the manifest. Nothing
+       is recorded if there is no manifest (rossum creates it). With
+       'export' False the update stays in the ManifestStore journal until
+       the next export.
+    """
+    with trace('write_manifest', 'manifest', parent=parent, files=len(files), export=export):
+        #remove parent from files
+        children = [f for f in files if f not in parent]
+
+        #replace extensions with their conversions
+        for i in range(len(children)):
+          ext = os.path.splitext(children[i])[-1]
+          if ext in EXT_MAP.keys():
+            children[i] = os.path.splitext(children[i])[0] + EXT_MAP[ext]['conversion']
+
+        #replace parent extension with conversion
+        if os.path.splitext(parent)[-1] in EXT_MAP.keys():
+          parent = os.path.splitext(parent)[0] + EXT_MAP[os.path.splitext(parent)[-1]]['conversion']
+
+        if os.path.exists(manifest):
+          store = ManifestStore(manifest)
+          store.record(parent, children, DATA_TYPES)
+          if export:
+            store.export()
+
+
+class ManifestStore(object):
+    """updates of a YAML manifest ('.man_log'), journaled in an SQLite
+       database next to it.
+
+       Every update is a single transaction touching only the rows of one
+       parent, so concurrent compiles can't lose each other's updates and
+       journaling one doesn't get more expensive with the size of the
+       workspace. export() merges the journal into the manifest, keeping
+       the layout rossum expects, and atomically replaces it, under the
+       write lock of the journal. While the manifest is as the last export
+       wrote it, only the entries of the parents updated are parsed and
+       rendered again; otherwise the whole of it is.
+    """
+
+    SUFFIX = '.db'
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.path = manifest + self.SUFFIX
+
+    def _connect(self):
+        import sqlite3
+        # autocommit mode: transactions are started explicitly, so the
+        # write lock is taken before anything is read
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute('CREATE TABLE IF NOT EXISTS entries (sections TEXT NOT NULL, '
+            'parent TEXT NOT NULL, child TEXT NOT NULL, '
+            'PRIMARY KEY (sections, parent, child))')
+        # the digest of the manifest as export() last wrote it
+        db.execute('CREATE TABLE IF NOT EXISTS exported (digest TEXT NOT NULL)')
+        return db
+
+    def record(self, parent, children, sections):
+        """add 'children' to 'parent', which is looked up in 'sections' of
+           the manifest (and added to the first of them if it's in none)
+        """
+        key = ','.join(sections)
+        # the empty child makes sure the parent gets an entry, even
+        # without any children
+        rows = [(key, parent, child) for child in [''] + list(children)]
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?)', rows)
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def export(self):
+        """merge the journal into the manifest and clear it. Returns the
+           number of parents updated.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        db = self._connect()
+        try:
+            # holding the write lock while writing the manifest serializes
+            # exports, and makes concurrent updates wait for us
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT sections, parent, child FROM entries').fetchall()
+            if not rows:
+                db.execute('ROLLBACK')
+                return 0
+
+            updates = {}
+            for (key, parent, child) in rows:
+                children = updates.setdefault((key, parent), set())
+                if child:
+                    children.add(child)
+
+            import hashlib
+            import yaml
+            text = None
+            if os.path.exists(self.manifest):
+                with open(self.manifest, 'r') as man:
+                    text = man.read()
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest() if text else None
+            exported = db.execute('SELECT digest FROM exported').fetchone()
+
+            spliced = None
+            if digest is not None and exported and exported[0] == digest:
+                # still as we left it: only the entries updated need touching
+                spliced = self._splice(text, updates, yaml)
+            if spliced is None:
+                spliced = yaml.dump(self._merge(yaml.safe_load(text or '') or {}, updates))
+
+            #save back to yaml file, without readers ever seeing half of it
+            tmp = '{0}.{1}.tmp'.format(self.manifest, os.getpid())
+            with open(tmp, 'w') as man:
+                man.write(spliced)
+            os.replace(tmp, self.manifest)
+
+            db.execute('DELETE FROM exported')
+            db.execute('INSERT INTO exported VALUES (?)',
+                (hashlib.sha1(spliced.encode('utf-8')).hexdigest(),))
+            db.execute('DELETE FROM entries')
+            db.execute('COMMIT')
+            return len(updates)
+        finally:
+            # rolls back if we didn't get to commit
+            db.close()
+
+    @staticmethod
+    def _merge(file_list, updates):
+        """'file_list' (the parsed manifest) with 'updates' merged in"""
+        for ((key, parent), children) in updates.items():
+            sections = key.split(',')
+            found = False
+            for section in sections:
+                sub_dict = file_list.get(section)
+                if isinstance(sub_dict, dict) and parent in sub_dict:
+                    #merge with the list already there
+                    vals = set(sub_dict[parent] or [])
+                    vals.update(children)
+                    sub_dict[parent] = sorted(vals)
+                    found = True
+
+            #insert into dictionary if parent not in manifest
+            if not found:
+                if not isinstance(file_list.get(sections[0]), dict):
+                    file_list[sections[0]] = {}
+                file_list[sections[0]][parent] = sorted(children)
+        return file_list
+
+    @staticmethod
+    def _splice(text, updates, yaml):
+        """'text', a manifest as yaml.dump() lays it out, with 'updates'
+           merged in like _merge() does, but parsing and rendering only the
+           entries of the parents updated. None if 'text' isn't laid out
+           as expected.
+        """
+        lines = text.splitlines(True)
+
+        def render(section, parent, children):
+            # the lines of 'parent', and of its section header
+            rendered = yaml.dump({section: {parent: children}}).splitlines(True)
+            return (rendered[0], rendered[1:])
+
+        def plain(section, parent):
+            # keys too long for a 'key:' line of their own get laid out
+            # in ways not worth looking for
+            (header, entry) = render(section, parent, [])
+            return (not header.startswith('?') and header.endswith(':\n')
+                and len(entry) == 1 and entry[0].endswith(': []\n'))
+
+        def insert_at(start, end, indent, name):
+            # where yaml.dump() would put key 'name', keeping keys sorted
+            for i in range(start, end):
+                line = lines[i][len(indent):]
+                if line.startswith((' ', '- ')):
+                    continue
+                if line[0] in '?:':
+                    return None
+                if name < list(yaml.safe_load(line))[0]:
+                    return i
+            return end
+
+        def find_section(section):
+            header = render(section, '', [])[0][:-len(':\n')]
+            for (i, line) in enumerate(lines):
+                if line in (header + ':\n', header + ': {}\n'):
+                    end = i + 1
+                    while end < len(lines) and lines[end].startswith(' '):
+                        end += 1
+                    return (i, end)
+            return None
+
+        def find_entry(section, parent, block):
+            key = render(section, parent, [])[1][0][:-len(' []\n')]
+            for i in range(block[0] + 1, block[1]):
+                if lines[i] in (key + '\n', key + ' []\n'):
+                    end = i + 1
+                    while end < block[1] and lines[end].startswith(('  - ', '    ')):
+                        end += 1
+                    return (i, end)
+            return None
+
+        for ((key, parent), children) in updates.items():
+            sections = key.split(',')
+            if not all(plain(section, parent) for section in sections):
+                return None
+            found = False
+            for section in sections:
+                block = find_section(section)
+                entry = block and find_entry(section, parent, block)
+                if not entry:
+                    continue
+                current = yaml.safe_load(''.join(l[2:] for l in lines[entry[0]:entry[1]]))
+                if not isinstance(current, dict) or list(current) != [parent]:
+                    return None
+                vals = set(current[parent] or [])
+                vals.update(children)
+                lines[entry[0]:entry[1]] = render(section, parent, sorted(vals))[1]
+                found = True
+
+            if not found:
+                (header, entry) = render(sections[0], parent, sorted(children))
+                block = find_section(sections[0])
+                if block is not None:
+                    at = insert_at(block[0] + 1, block[1], '  ', parent)
+                    if at is None:
+                        return None
+                    lines[at:at] = entry
+                    lines[block[0]] = header
+                elif any(l.startswith(header[:-len('\n')]) for l in lines):
+                    # there, but not a mapping
+                    return None
+                else:
+                    at = insert_at(0, len(lines), '', sections[0])
+                    if at is None:
+                        return None
+                    lines[at:at] = [header] + entry
+        return ''.join(lines)
+
+
+GPP_OP_ENTER=b'1'
+GPP_OP_EXIT=b'2'
+_INCLUDE_MARKER_RE = re.compile(br'-- INCLUDE_MARKER (\d+):(\S+):(\d+|)')
+# markers start a line. Leading with a literal instead of '^' lets re skip
+# ahead with a fast search for it, which is several times quicker
+_NEXT_INCLUDE_MARKER_RE = re.compile(br'\n-- INCLUDE_MARKER (\d+):(\S+):(\d+|)')
 def scan_for_inc_stmts(text):
-    matches = re.findall(r'^-- INCLUDE_MARKER (\d+):(\S+):(\d+|)', text.decode('utf-8'), re.MULTILINE)
-    incs = []
-    for (line_nr, fpath, op) in matches:
-        if (op == GPP_OP_ENTER) and (fpath not in incs):
-            incs.append(fpath)
-    return incs
+    return IncludeTree.scan(text).includes
+
+
+def include_tree(fname):
+    """the IncludeTree of the gpp output in 'fname'. The file is mapped
+       into memory rather than read, as expanded programs get large.
+    """
+    import mmap
+    with open(fname, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            # can't map an empty file
+            return IncludeTree.scan(b'')
+        view = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return IncludeTree.scan(view)
+        finally:
+            view.close()
+
+
+class IncludeNode(object):
+    """a file gpp entered, and the files it entered in turn"""
+
+    def __init__(self, path):
+        self.path = path
+        self.children = []
+
+    def walk(self, depth=0):
+        """(node, depth) for this node and everything it included, in the
+           order gpp entered them
+        """
+        yield (self, depth)
+        for child in self.children:
+            for item in child.walk(depth + 1):
+                yield item
+
+    def __repr__(self):
+        return 'IncludeNode({0!r})'.format(self.path)
+
+
+class IncludeTree(object):
+    """what the include markers in gpp output say about the files that went
+       into it: 'includes' lists every file entered once, in the order they
+       were first entered, and 'root' (the file gpp was run on) has the
+       nodes nested the way the %includes were.
+    """
+
+    def __init__(self):
+        self.root = IncludeNode(None)
+        self.includes = []
+
+    @classmethod
+    def scan(cls, data):
+        """the tree of 'data', gpp output as bytes (or a buffer, like an
+           mmap). Only the paths in the markers are decoded; gpp output is
+           latin-1, like everywhere else in ktransw.
+        """
+        tree = cls()
+        stack = [tree.root]
+        # dicts keep their order: an ordered set
+        seen = {}
+        first = _INCLUDE_MARKER_RE.match(data)
+        markers = [first.groups()] if first else []
+        # drop the match, which holds on to 'data' (an mmap can't be closed then)
+        first = None
+        markers.extend(_NEXT_INCLUDE_MARKER_RE.findall(data))
+        for (_, fpath, op) in markers:
+            path = fpath.decode('latin-1')
+            if op == GPP_OP_ENTER:
+                node = IncludeNode(path)
+                stack[-1].children.append(node)
+                stack.append(node)
+                seen[path] = None
+            elif op == GPP_OP_EXIT:
+                if len(stack) > 1:
+                    stack.pop()
+            elif tree.root.path is None:
+                tree.root.path = path
+        tree.includes = list(seen)
+        return tree
 
 
 def is_system_header(header):
@@ -716,10 +2942,98 @@ def is_system_header(header):
 
 
 def find_hdr_in_incdirs(header, include_dirs):
-    for include_dir in include_dirs:
-        if os.path.exists(os.path.join(include_dir, header)):
-            return include_dir
-    raise ValueError()
+    return include_index(include_dirs).find(header)
+
+
+def include_index(include_dirs):
+    """the (warm) IncludeIndex for 'include_dirs'"""
+    key = tuple(include_dirs)
+    index = _include_indexes.get(key)
+    if index is None:
+        index = _include_indexes[key] = IncludeIndex(include_dirs)
+    return index
+
+
+class IncludeIndex(object):
+    """header name -> include dir map of a list of include dirs.
+
+       Every dir is listed once (with a single scandir) instead of probing
+       it for every header. Duplicate dirs are dropped, and so are dirs
+       that don't exist, which also makes 'dirs' the list to give gpp.
+       refresh() relists only the dirs whose mtime changed; it runs at the
+       start of every compile and whenever a lookup misses.
+    """
+    def __init__(self, include_dirs):
+        self.include_dirs = []
+        seen = set()
+        for d in include_dirs:
+            key = os.path.normcase(os.path.abspath(d))
+            if key not in seen:
+                seen.add(key)
+                self.include_dirs.append(d)
+        self.dirs = []
+        self._listings = {}
+        self._names = {}
+        self.refresh()
+
+    def refresh(self):
+        """relist the dirs that changed since the last time. Returns
+           whether anything did.
+        """
+        changed = False
+        dirs = []
+        listings = {}
+        for d in self.include_dirs:
+            try:
+                mtime = os.stat(d).st_mtime_ns
+                listing = self._listings.get(d)
+                if listing is None or listing[0] != mtime:
+                    listing = (mtime, [entry.name for entry in os.scandir(d)])
+                    self._listings[d] = listing
+                    changed = True
+            except OSError:
+                if self._listings.pop(d, None) is not None:
+                    changed = True
+                continue
+            dirs.append(d)
+            listings[d] = listing
+
+        if changed or dirs != self.dirs:
+            # first dir wins, like gpp's search order
+            names = {}
+            for d in reversed(dirs):
+                for name in listings[d][1]:
+                    names[os.path.normcase(name)] = d
+            # find() runs on other threads: it must never see a map that is
+            # only partly filled in
+            self._names = names
+            self.dirs = dirs
+        return changed
+
+    def find(self, header):
+        """the include dir 'header' is found in first. Raises ValueError if
+           it isn't in any of them.
+        """
+        if os.path.basename(header) == header:
+            key = os.path.normcase(header)
+            include_dir = self._names.get(key)
+            if include_dir is None and self.refresh():
+                include_dir = self._names.get(key)
+            if include_dir is not None:
+                return include_dir
+        # paths with a directory part, and files that appeared within the
+        # mtime resolution of their dir
+        for include_dir in self.dirs:
+            if os.path.exists(os.path.join(include_dir, header)):
+                return include_dir
+        raise ValueError()
+
+    def locate(self, header):
+        """find(), but returning None if 'header' isn't found"""
+        try:
+            return self.find(header)
+        except ValueError:
+            return None
 
 
 def setup_gpp_cline(gpp_exe, src_file, dest_file, include_dirs, macro_strs):
@@ -783,16 +3097,316 @@ def setup_gpp_cline(gpp_exe, src_file, dest_file, include_dirs, macro_strs):
 
     # make gpp output to temporary file immediately, so we can have
     # ktrans open that, instead of having to write to the intermediary file
-    # ourselves
-    gpp_cmdline.extend(['-o "{0}"'.format(dest_file)])
+    # ourselves. Without one gpp writes to stdout.
+    if dest_file:
+        gpp_cmdline.extend(['-o "{0}"'.format(dest_file)])
 
     # finally: the input to gpp is the KAREL file that we are supposed
-    # to be compiling
-    gpp_cmdline.extend(['"{0}"'.format(src_file)])
+    # to be compiling (or stdin, if there is none)
+    if src_file:
+        gpp_cmdline.extend(['"{0}"'.format(src_file)])
 
     return gpp_cmdline
 
 
+def start_trace(fname, process_name=None):
+    """start collecting the spans of this process for the Chrome trace-event
+       file 'fname' (see --trace). Does nothing for a 'fname' of None,
+       unless a 'process_name' is given to collect spans for somebody else.
+    """
+    global _tracer
+    if fname or process_name:
+        _tracer = Tracer(fname, process_name or 'ktransw')
+
+
+def finish_trace():
+    """stop tracing, write the trace file and return its events"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return []
+    tracer.close()
+    return tracer.events
+
+
+def trace(name, cat, **fields):
+    """'with trace(..) as span:' times the block as a span of the --trace
+       output, with 'fields' (and whatever span.set() adds) as its args.
+       Nothing is recorded, or computed, when not tracing: check
+       'span.active' before collecting fields that are costly to get.
+    """
+    if _tracer is None:
+        return _NO_SPAN
+    return _Span(_tracer, name, cat, fields)
+
+
+class Tracer(object):
+    """collects spans as Chrome trace events ('X' complete events, times
+       in microseconds), as loaded by chrome://tracing and ui.perfetto.dev.
+
+       Every span also records 'peak_memory': the most memory allocated by
+       Python (as seen by tracemalloc) at any time it was open.
+    """
+
+    def __init__(self, fname, process_name='ktransw'):
+        import tracemalloc
+        self.fname = fname
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0,
+            'args': {'name': process_name}}]
+        self._lock = threading.Lock()
+        self._open = []
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start()
+
+    def enter(self, span):
+        with self._lock:
+            self._fold_peak()
+            span.peak = 0
+            self._open.append(span)
+
+    def exit(self, span):
+        with self._lock:
+            self._fold_peak()
+            self._open.remove(span)
+
+    def _fold_peak(self):
+        """account the peak since the previous call to every open span"""
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        for span in self._open:
+            span.peak = max(span.peak, peak)
+
+    def close(self):
+        import tracemalloc
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        if self.fname:
+            tmp = '{0}.{1}.tmp'.format(self.fname, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            os.replace(tmp, self.fname)
+
+
+class _Span(object):
+    active = True
+
+    def __init__(self, tracer, name, cat, fields):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.tracer.enter(self)
+        # wall clock, so the spans of batch workers line up
+        self.ts = time.time() * 1e6
+        self.start = time.perf_counter()
+        self.tid = threading.get_ident()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        dur = (time.perf_counter() - self.start) * 1e6
+        self.tracer.exit(self)
+        args = dict(self.fields, peak_memory=self.peak)
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        self.tracer.events.append({'name': self.name, 'cat': self.cat, 'ph': 'X',
+            'ts': self.ts, 'dur': dur, 'pid': os.getpid(), 'tid': self.tid, 'args': args})
+        return False
+
+
+class _NoSpan(object):
+    active = False
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def serve(address, workers, logger):
+    """run a compile server for ktranswc clients.
+
+       Requests are handed to a pool of worker processes. Each worker keeps
+       its imports, argument parser and caches (include lookups, parsed
+       headers and class expansions) warm between requests, and requests
+       never share a worker at the same time: the working directory, the
+       environment and the module level lists are all per process.
+    """
+    import socketserver
+    import secrets
+    import multiprocessing
+
+    host, port = address.rsplit(':', 1)
+    token = secrets.token_hex(16)
+    pool = multiprocessing.Pool(workers or available_cpus(),
+        initializer=_init_server_worker)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+            except ValueError:
+                return
+            if request.get('token') != token:
+                self.send({'err': "ktransw: server rejected request: bad token\n"})
+                self.send({'exit': 1})
+                return
+            if request.get('shutdown'):
+                self.send({'exit': 0})
+                self.server.shutdown()
+                return
+
+            (chunks, ret) = pool.apply(_serve_request,
+                (request['argv'], request['cwd'], request['env']))
+            for (stream, data) in chunks:
+                self.send({stream: data})
+            self.send({'exit': ret})
+
+        def send(self, frame):
+            self.wfile.write((json.dumps(frame) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server((host, int(port)), RequestHandler)
+    address = '{0}:{1}'.format(*server.server_address[:2])
+
+    # the token lets anyone run programs as us (through --ktrans): only we
+    # may read it
+    state_dir = os.path.dirname(SERVER_STATE_FILE)
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    os.chmod(state_dir, 0o700)
+    tmp = _tmp_name(SERVER_STATE_FILE)
+    fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'address': address, 'token': token, 'pid': os.getpid()}, f)
+    os.replace(tmp, SERVER_STATE_FILE)
+
+    logger.info("ktransw server listening on {0}".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        try:
+            with open(SERVER_STATE_FILE, 'r') as f:
+                ours = json.load(f).get('pid') == os.getpid()
+            if ours:
+                os.remove(SERVER_STATE_FILE)
+        except (OSError, ValueError):
+            pass
+    logger.info("ktransw server stopped")
+    return 0
+
+
+def _init_server_worker():
+    # the log handler must follow sys.stderr around, as that is swapped
+    # for every request
+    logging.basicConfig(format=LOG_FMT, level=logging.INFO, stream=_StderrRelay())
+
+
+def _serve_request(argv, cwd, env):
+    """run a single ktransw invocation inside a server worker, returning
+       everything it wrote to stdout / stderr and its exit code
+    """
+    import traceback
+
+    chunks = []
+    saved_streams = (sys.stdout, sys.stderr)
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    sys.stdout = _Capture(chunks, 'out')
+    sys.stderr = _Capture(chunks, 'err')
+    try:
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(cwd)
+        try:
+            if '--server' in argv:
+                raise SystemExit("ktransw: cannot start a server from a server request")
+            main(argv)
+            ret = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                ret = e.code or 0
+            else:
+                sys.stderr.write("{0}\n".format(e.code))
+                ret = 1
+        except Exception:
+            traceback.print_exc()
+            ret = 1
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+    return (chunks, ret)
+
+
+class _Capture(object):
+    """stand-in for sys.stdout / sys.stderr that records what was written"""
+    def __init__(self, chunks, stream):
+        self._chunks = chunks
+        self._stream = stream
+
+    def write(self, data):
+        if data:
+            self._chunks.append((self._stream, data))
+
+    def flush(self):
+        pass
+
+
+class _StderrRelay(object):
+    def write(self, data):
+        sys.stderr.write(data)
+
+    def flush(self):
+        sys.stderr.flush()
+
+
+class BuildDirectory(object):
+    """a --build-dir directory of a target: created when it doesn't exist
+       yet and left in place for the next build
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self.name)
+
+    def __enter__(self):
+        os.makedirs(self.name, exist_ok=True)
+        return self.name
+
+    def __exit__(self, exc, value, tb):
+        pass
+
+
 class TemporaryDirectory(object):
     # http://stackoverflow.com/a/19299884
     def __init__(self, suffix="", prefix="tmp", dir=None, do_clean=True):
@@ -810,14 +3424,7 @@ class TemporaryDirectory(object):
 
     def cleanup(self, _warn=False):
         if self.name and not self._closed and self._do_clean:
-            try:
-                self._rmtree(self.name)
-            except (TypeError, AttributeError) as ex:
-                if "None" not in str(ex):
-                    raise
-                print("ERROR: {!r} while cleaning up {!r}".format(ex, self,),
-                      file=sys.stderr)
-                return
+            discard_dir(self.name)
             self._closed = True
             if _warn:
                 self._warn("Implicitly cleaning up {!r}".format(self),
@@ -829,33 +3436,124 @@ class TemporaryDirectory(object):
     def __del__(self):
         self.cleanup(_warn=True)
 
-    _listdir = staticmethod(os.listdir)
-    _path_join = staticmethod(os.path.join)
-    _isdir = staticmethod(os.path.isdir)
-    _islink = staticmethod(os.path.islink)
-    _remove = staticmethod(os.remove)
-    _rmdir = staticmethod(os.rmdir)
     import warnings as _warnings
     _warn = _warnings.warn
 
-    def _rmtree(self, path):
-        for name in self._listdir(path):
-            fullname = self._path_join(path, name)
-            try:
-                isdir = self._isdir(fullname) and not self._islink(fullname)
-            except OSError:
-                isdir = False
-            if isdir:
-                self._rmtree(fullname)
-            else:
-                try:
-                    self._remove(fullname)
-                except OSError:
-                    pass
+
+def discard_dir(path):
+    """delete the directory 'path' without waiting for it: it is renamed
+       out of the way and a background thread removes it. Whatever that
+       thread didn't get to when the process exits is left to a detached
+       process
+    """
+    trash = path + TRASH_SUFFIX
+    try:
+        os.rename(path, trash)
+    except OSError:
+        trash = path
+    _trash_queue().put(trash)
+
+
+# (pid, queue) of the thread deleting discarded dirs. A forked worker
+# starts its own
+_trash = (None, None)
+_trash_lock = threading.Lock()
+# the dir that thread is deleting
+_trash_busy = None
+
+def _trash_queue():
+    global _trash
+    with _trash_lock:
+        if _trash[0] != os.getpid():
+            import atexit
+            import queue
+            trash = queue.Queue()
+            threading.Thread(target=_delete_trash, args=(trash,),
+                name='ktransw-trash', daemon=True).start()
+            _trash = (os.getpid(), trash)
+            atexit.register(_hand_off_trash)
+        return _trash[1]
+
+
+def _delete_trash(trash):
+    global _trash_busy
+    from shutil import rmtree
+    swept = False
+    while True:
+        _trash_busy = trash.get()
+        rmtree(_trash_busy, ignore_errors=True)
+        _trash_busy = None
+        trash.task_done()
+        # our own first, as the process may be about to exit
+        if not swept and trash.empty():
+            _sweep_trash()
+            swept = True
+
+
+def _hand_off_trash():
+    """at exit: leave what the thread didn't get to yet to a process of its
+       own, rather than waiting for it. A frozen ktransw can't run '-c': it
+       leaves those to a later _sweep_trash()
+    """
+    (pid, trash) = _trash
+    if pid != os.getpid() or getattr(sys, 'frozen', False):
+        return
+    paths = [_trash_busy] if _trash_busy else []
+    while not trash.empty():
+        paths.append(trash.get_nowait())
+    if not paths:
+        return
+    import subprocess
+    if os.name == 'nt':
+        detach = {'creationflags': subprocess.DETACHED_PROCESS |
+            subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        detach = {'start_new_session': True}
+    try:
+        subprocess.Popen([sys.executable, '-c', 'import shutil, sys\n'
+            'for path in sys.argv[1:]:\n    shutil.rmtree(path, ignore_errors=True)\n']
+            + paths, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, close_fds=True, **detach)
+    except OSError:
+        pass
+
+
+def _sweep_trash():
+    """delete the discarded build dirs killed processes (or pool workers,
+       which exit without running atexit handlers) left in the temp dir.
+       Only one process sweeps at a time, and only once every
+       TRASH_SWEEP_INTERVAL seconds, so parallel compiles don't all list
+       the temp dir and race to delete the same dirs.
+    """
+    from shutil import rmtree
+    from tempfile import gettempdir
+    tmp = gettempdir()
+    stamp = os.path.join(tmp, TRASH_SWEEP_STAMP)
+    try:
+        if time.time() - os.path.getmtime(stamp) < TRASH_SWEEP_INTERVAL:
+            return
+    except OSError:
+        pass
+    lock = stamp + '.lock'
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        # another process is sweeping. A lock that old was left by one
+        # that died doing so: remove it, for the next one to try again
         try:
-            self._rmdir(path)
+            if time.time() - os.path.getmtime(lock) > TRASH_SWEEP_INTERVAL:
+                os.remove(lock)
         except OSError:
             pass
+        return
+    try:
+        with open(stamp, 'w'):
+            pass
+        for name in os.listdir(tmp):
+            if name.endswith('-buildd' + TRASH_SUFFIX):
+                rmtree(os.path.join(tmp, name), ignore_errors=True)
+    finally:
+        os.remove(lock)
 
 
 if __name__ == '__main__':
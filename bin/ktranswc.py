@@ -0,0 +1,73 @@
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Thin client for a 'ktransw --server' instance.
+
+Takes the same arguments as ktransw. The arguments, working directory and
+environment are forwarded to the server, and its stdout, stderr and exit
+code are relayed back. If no server is running, ktransw is run in-process.
+
+'ktranswc --shutdown' stops a running server.
+"""
+
+import os
+import sys
+import json
+import socket
+
+SERVER_STATE_FILE = os.path.join(os.path.expanduser('~'), '.ktransw', 'server.json')
+
+
+def main():
+    argv = sys.argv[1:]
+
+    try:
+        with open(SERVER_STATE_FILE, 'r') as f:
+            state = json.load(f)
+        host, port = state['address'].rsplit(':', 1)
+        conn = socket.create_connection((host, int(port)))
+    except (OSError, ValueError, KeyError):
+        if argv == ['--shutdown']:
+            sys.exit(0)
+        # no server (or a stale state file): do the work ourselves
+        import ktransw
+        ktransw.main(argv)
+        return
+
+    request = {'token': state['token']}
+    if argv == ['--shutdown']:
+        request['shutdown'] = True
+    else:
+        request.update({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)})
+
+    ret = 1
+    with conn:
+        conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in conn.makefile('rb'):
+            frame = json.loads(line.decode('utf-8'))
+            if 'out' in frame:
+                sys.stdout.write(frame['out'])
+            elif 'err' in frame:
+                sys.stderr.write(frame['err'])
+            elif 'exit' in frame:
+                ret = frame['exit']
+                break
+    sys.stdout.flush()
+    sys.exit(ret)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,838 @@
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process implementation of the subset of gpp that ktransw relies on.
+
+Only the configuration set up by ktransw.setup_gpp_cline() is supported:
+
+  - user macros in the '-U "" "" "(" "," ")" "(" ")" "#" ""' mode: any
+    identifier naming a macro is expanded, arguments between parentheses,
+    named and numbered ('#1') argument references
+  - meta macros in the '-M "\\n%\\w" "\\n" " " " " "\\n" "" ""' mode:
+    %define, %defeval, %undef, %ifdef, %ifndef, %ifeq, %ifneq, %else,
+    %endif, %include, %error, %warning and %mode push / pop / string /
+    nostring / comment / nocomment
+  - '--includemarker' lines when entering (op 1) and leaving (op 2) a file
+
+Anything else raises Unsupported, upon which callers are expected to fall
+back to the real gpp. String and comment modes follow gpp's flag letters:
+'c' and 'i' drop the text, 's' and 'q' copy it verbatim (delimiters
+included), upper case letters copy it without its delimiters. The three
+letters apply to plain text, meta macro arguments and user macro
+arguments respectively.
+
+Run as a script this module accepts the gpp command line ktransw builds.
+Its output is meant to match gpp's, but that is only checked where a gpp
+is available (see tests/corpus/update_goldens.py).
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+
+ENGINE_VERSION = '1'
+
+DEFAULT_MARKER = '-- INCLUDE_MARKER %:%:%'
+
+# the '-U' and '-M' specifications from ktransw.setup_gpp_cline(), as they
+# appear in argv
+USER_MODE = ('', '', '(', ',', ')', '(', ')', '#', '')
+META_MODE = ('\\n%\\w', '\\n', ' ', ' ', '\\n', '', '')
+
+META_MACROS = frozenset(['define', 'defeval', 'undef', 'ifdef', 'ifndef',
+    'ifeq', 'ifneq', 'else', 'endif', 'include', 'mode', 'error', 'warning'])
+# gpp builtins we don't implement
+UNSUPPORTED_MACROS = frozenset(['if', 'elif', 'exec', 'eval', 'line', 'file',
+    'date', 'sinclude'])
+
+# contexts strings and comments can appear in (index into their flags)
+CTX_TEXT = 0
+CTX_META = 1
+CTX_USER = 2
+
+_META_START = re.compile(r'%[ \t]*([A-Za-z_]\w*)')
+_IDENT = re.compile(r'[A-Za-z_]\w*')
+_SUBST = re.compile(r'#([1-9])|([A-Za-z_]\w*)')
+_MODE_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_MODE_ESCAPES = {'\\': '\\', '"': '"', 'n': '\n', 't': '\t'}
+
+#   path -> ((mtime, size), text)
+_source_cache = {}
+#   path -> ((mtime, size), sha1 of text)
+_digest_cache = {}
+
+
+class GppError(Exception):
+    def __init__(self, message, returncode=1):
+        super(GppError, self).__init__(message)
+        self.returncode = returncode
+
+
+class Unsupported(GppError):
+    """the input needs a gpp feature this engine does not implement"""
+
+
+class Macro(object):
+    __slots__ = ('params', 'body')
+
+    def __init__(self, params, body):
+        # None: defined without a parameter list
+        self.params = params
+        self.body = body
+
+    def __eq__(self, other):
+        return isinstance(other, Macro) and (self.params, self.body) == (other.params, other.body)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Spec(object):
+    """a string or comment specification ('%mode string ..')"""
+    __slots__ = ('kind', 'flags', 'start', 'end', 'quote')
+
+    def __init__(self, kind, flags, start, end, quote):
+        self.kind = kind
+        self.flags = flags
+        self.start = start
+        self.end = end
+        self.quote = quote
+
+    def __eq__(self, other):
+        return isinstance(other, Spec) and all(getattr(self, a) == getattr(other, a)
+            for a in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def read_source(path, cache=True):
+    """contents of 'path' with LF line endings, cached while unchanged
+       unless 'cache' is off
+    """
+    st = os.stat(path)
+    sig = (st.st_mtime_ns, st.st_size)
+    cached = _source_cache.get(path)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    with open(path, 'rb') as f:
+        # latin-1 maps bytes 1:1, so whatever we don't touch round-trips
+        text = f.read().decode('latin-1').replace('\r\n', '\n')
+    if cache:
+        _source_cache[path] = (sig, text)
+    return text
+
+
+def write_output(path, text):
+    with open(path, 'wb') as f:
+        f.write(text.encode('latin-1'))
+
+
+def source_digest(path):
+    """sha1 of what read_source() returns for 'path', cached while unchanged"""
+    import hashlib
+    text = read_source(path)
+    sig = _source_cache[path][0]
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    digest = hashlib.sha1(text.encode('latin-1')).hexdigest()
+    _digest_cache[path] = (sig, digest)
+    return digest
+
+
+class Engine(object):
+    """a single gpp run: macros defined while processing a file stay
+       defined for the rest of that run only
+    """
+
+    def __init__(self, include_dirs=(), defines=(), marker=DEFAULT_MARKER, locate=None,
+                 snapshots=()):
+        self.include_dirs = list(include_dirs)
+        # optional name -> include dir (None if not found) lookup to use
+        # instead of probing 'include_dirs'
+        self.locate = locate
+        self.macros = {}
+        self.specs = []
+        self.mode_stack = []
+        # files entered through %include, in order
+        self.included = []
+        # None: don't output include markers
+        self._marker_fmt = None
+        if marker is not None:
+            self._marker_fmt = marker.replace('{', '{{').replace('}', '}}').replace('%', '{}') + '\n'
+        self._scanners = {}
+        # absolute path -> MacroSnapshots of it, see _replay()
+        self.snapshots = {}
+        for snapshot in snapshots:
+            self.snapshots.setdefault(snapshot.files[0][0], []).append(snapshot)
+        for d in defines:
+            self.define_from_cmdline(d)
+
+    def define_from_cmdline(self, text):
+        """'name', 'name=body' or 'name(a,b)=body', as given to '-D'"""
+        (head, _, body) = text.partition('=')
+        (name, params, rest) = self._split_define(head)
+        if rest.strip():
+            raise GppError("invalid macro definition: -D{0}".format(text))
+        self.macros[name] = Macro(params, body)
+
+    def process_file(self, path):
+        # not cached: that's for headers. Files processed are mostly
+        # intermediates, which are only ever read once
+        return self.process_text(read_source(path, cache=False), path)
+
+    def process_text(self, text, filename):
+        out = []
+        self._marker(out, 1, filename, '')
+        self._process(text, filename, out)
+        return ''.join(out)
+
+    def snapshot(self, path):
+        """a MacroSnapshot of including 'path' with the macros defined so
+           far (normally only the '-D' ones)
+        """
+        if self.mode_stack:
+            raise GppError("can't take a snapshot inside a %mode push")
+        recording = _RecordingMacros(self.macros)
+        (self.macros, specs) = (recording, list(self.specs))
+        included = len(self.included)
+        out = []
+        try:
+            self._process(read_source(path), path, out)
+        finally:
+            self.macros = dict(recording)
+        if self.mode_stack:
+            raise GppError("{0}: leaves a %mode push behind".format(path))
+        files = [os.path.abspath(f) for f in [path] + self.included[included:]]
+        return MacroSnapshot(path, self._marker_fmt,
+            [[f, source_digest(f)] for f in files], recording.includes,
+            recording.reads, dict((name, self.macros.get(name)) for name in recording.written),
+            specs, list(self.specs), ''.join(out))
+
+    # -- files and meta macros ------------------------------------------
+
+    def _process(self, text, filename, out):
+        # stack of [taking this branch, a branch has been taken]
+        conds = []
+        pos = 0
+        n = len(text)
+        while pos < n:
+            # we are always at the start of a line here
+            if text.startswith('%', pos):
+                m = _META_START.match(text, pos)
+                if m and self._is_meta(m.group(1)):
+                    pos = self._directive(m, text, filename, out, conds)
+                    continue
+            if conds and not conds[-1][0]:
+                nl = text.find('\n', pos)
+                pos = n if nl < 0 else nl + 1
+                continue
+            pos = self._scan(text, pos, out, CTX_TEXT, frozenset(), True)
+        if conds:
+            raise GppError("{0}: unterminated %ifdef/%ifndef".format(filename))
+
+    def _is_meta(self, name):
+        if name in META_MACROS:
+            return True
+        if name in UNSUPPORTED_MACROS:
+            raise Unsupported("meta macro '%{0}' is not supported".format(name))
+        if name in self.macros:
+            raise Unsupported("calling user macro '{0}' as a meta macro is not supported".format(name))
+        return False
+
+    def _directive(self, m, text, filename, out, conds):
+        name = m.group(1)
+        (raw, end) = self._read_meta_args(text, m.end())
+        skipping = bool(conds) and not conds[-1][0]
+
+        if name in ('ifdef', 'ifndef', 'ifeq', 'ifneq'):
+            if skipping:
+                # only keep track of nesting
+                conds.append([False, True])
+            else:
+                taken = self._condition(name, raw)
+                conds.append([taken, taken])
+        elif name == 'else':
+            if not conds:
+                raise GppError("{0}: %else without %if".format(filename))
+            parent_active = len(conds) < 2 or conds[-2][0]
+            conds[-1][0] = parent_active and not conds[-1][1]
+            conds[-1][1] = True
+        elif name == 'endif':
+            if not conds:
+                raise GppError("{0}: %endif without %if".format(filename))
+            conds.pop()
+        elif skipping:
+            pass
+        elif name == 'include':
+            self._include(raw, text, end, filename, out)
+            return end
+        elif name in ('define', 'defeval'):
+            (mname, params, body) = self._split_define(raw.lstrip(' \t'))
+            body = self._strip_strings(body.lstrip(' \t'), CTX_META)
+            if name == 'defeval':
+                body = self._expand(body, CTX_META, frozenset())
+            self.macros[mname] = Macro(params, body)
+        elif name == 'undef':
+            self.macros.pop(raw.strip(), None)
+        elif name == 'mode':
+            self._mode(raw)
+        elif name == 'error':
+            raise GppError("{0}: {1}".format(filename, self._expand(raw.strip(), CTX_META, frozenset())))
+        elif name == 'warning':
+            sys.stderr.write("{0}: warning: {1}\n".format(filename,
+                self._expand(raw.strip(), CTX_META, frozenset())))
+
+        # directives are replaced by a blank line
+        if not skipping:
+            out.append('\n')
+        return end
+
+    def _read_meta_args(self, text, pos):
+        """raw argument text of a meta macro, up to the (unquoted) end of line"""
+        n = len(text)
+        start = pos
+        while pos < n:
+            c = text[pos]
+            if c == '\n':
+                return (text[start:pos], pos + 1)
+            spec = self._spec_at(text, pos)
+            if spec is not None:
+                pos = self._string_end(text, pos, spec)
+            else:
+                pos += 1
+        return (text[start:], n)
+
+    def _condition(self, name, raw):
+        if name in ('ifdef', 'ifndef'):
+            defined = raw.strip() in self.macros
+            return defined if name == 'ifdef' else not defined
+        parts = self._expand(raw.strip(), CTX_META, frozenset()).split(None, 1)
+        if len(parts) < 2:
+            parts.append('')
+        equal = parts[0].strip() == parts[1].strip()
+        return equal if name == 'ifeq' else not equal
+
+    def _include(self, raw, text, end, filename, out):
+        name = self._expand(raw.strip(), CTX_META, frozenset()).strip()
+        if len(name) > 1 and name[0] + name[-1] in ('""', '<>'):
+            name = name[1:-1]
+        path = self.find_include(name)
+        if path is None:
+            raise GppError("{0}: Requested include file not found: {1}".format(filename, name))
+        self.included.append(path)
+
+        if isinstance(self.macros, _RecordingMacros):
+            self.macros.includes.append([name, path])
+
+        if out and not out[-1].endswith('\n'):
+            out.append('\n')
+        self._marker(out, 1, path, '1')
+        if not self._replay(path, out):
+            self._process(read_source(path), path, out)
+        if out and not out[-1].endswith('\n'):
+            out.append('\n')
+        self._marker(out, text.count('\n', 0, end) + 1, filename, '2')
+
+    def find_include(self, name):
+        """the path '%include name' enters, or None"""
+        if os.path.isabs(name) or os.path.isfile(name):
+            return name if os.path.isfile(name) else None
+        if self.locate is not None:
+            include_dir = self.locate(name)
+            return None if include_dir is None else include_dir + os.sep + name
+        for include_dir in self.include_dirs:
+            path = include_dir + os.sep + name
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _replay(self, path, out):
+        """if a snapshot of 'path' applies, take its effects instead of
+           processing the file. Returns whether one did.
+        """
+        if not self.snapshots:
+            return False
+        for snapshot in self.snapshots.get(os.path.abspath(path), ()):
+            if snapshot.path == path and snapshot.applies(self):
+                for (name, macro) in snapshot.writes.items():
+                    if macro is None:
+                        self.macros.pop(name, None)
+                    else:
+                        self.macros[name] = macro
+                if snapshot.specs_out != self.specs:
+                    self.specs = list(snapshot.specs_out)
+                    self._scanners = {}
+                self.included.extend(p for (_, p) in snapshot.includes)
+                if isinstance(self.macros, _RecordingMacros):
+                    self.macros.includes.extend(snapshot.includes)
+                out.append(snapshot.output)
+                return True
+        return False
+
+    def _marker(self, out, lineno, filename, op):
+        if self._marker_fmt is None:
+            return
+        # gpp escapes backslashes in the file name
+        out.append(self._marker_fmt.format(lineno, filename.replace('\\', '\\\\'), op))
+
+    def _mode(self, raw):
+        tokens = []
+        for m in _MODE_TOKEN.finditer(raw):
+            if m.group(1) is not None:
+                tokens.append(_unescape(m.group(1)))
+            else:
+                tokens.append(m.group(2))
+        if not tokens:
+            raise GppError("%mode: missing argument")
+
+        cmd = tokens[0]
+        if cmd == 'push':
+            self.mode_stack.append(list(self.specs))
+        elif cmd == 'pop':
+            if not self.mode_stack:
+                raise GppError("%mode pop: mode stack is empty")
+            self.specs = self.mode_stack.pop()
+        elif cmd in ('string', 'comment'):
+            args = tokens[1:]
+            quoted = [m.group(1) is not None for m in _MODE_TOKEN.finditer(raw)][1:]
+            flags = 'sss' if cmd == 'string' else 'ccc'
+            if args and not quoted[0]:
+                flags = args.pop(0)
+            if len(flags) != 3 or any(f not in 'csqiCSQI' for f in flags):
+                raise Unsupported("%mode {0}: flags '{1}' are not supported".format(cmd, flags))
+            if len(args) < 2 or not args[0]:
+                raise GppError("%mode {0}: expected a start and an end sequence".format(cmd))
+            quote = args[2] if len(args) > 2 else ''
+            self.specs = [s for s in self.specs if s.start != args[0]]
+            self.specs.append(Spec(cmd, flags, args[0], args[1], quote))
+        elif cmd in ('nostring', 'nocomment'):
+            kind = cmd[2:]
+            starts = tokens[1:]
+            self.specs = [s for s in self.specs
+                if s.kind != kind or (starts and s.start not in starts)]
+        else:
+            raise Unsupported("'%mode {0}' is not supported".format(cmd))
+        self._scanners = {}
+
+    # -- user macros ---------------------------------------------------
+
+    def _scanner(self, stop_at_meta):
+        """regex finding the next thing _scan needs to look at"""
+        key = stop_at_meta
+        rx = self._scanners.get(key)
+        if rx is None:
+            parts = []
+            if stop_at_meta:
+                parts.append(r'(?P<nl>\n(?=%))')
+            parts.append(r'(?P<id>[A-Za-z_]\w*)|\d\w*')
+            if self.specs:
+                starts = sorted(set(s.start for s in self.specs), key=len, reverse=True)
+                parts.append('(?P<str>' + '|'.join(re.escape(s) for s in starts) + ')')
+            rx = re.compile('|'.join(parts))
+            self._scanners[key] = rx
+        return rx
+
+    def _scan(self, text, pos, out, ctx, disabled, stop_at_meta):
+        """expand macros in 'text' from 'pos' on. Stops after a newline that
+           is followed by a '%' if 'stop_at_meta', else at the end of 'text'.
+           Returns the position it stopped at.
+        """
+        rx = self._scanner(stop_at_meta)
+        macros = self.macros
+        last = pos
+        while True:
+            m = rx.search(text, pos)
+            if m is None:
+                out.append(text[last:])
+                return len(text)
+            kind = m.lastgroup
+            if kind == 'id':
+                name = m.group('id')
+                if name in macros and name not in disabled:
+                    call = self._call(name, text, m.end(), ctx, disabled)
+                    if call is not None:
+                        out.append(text[last:m.start()])
+                        out.append(call[0])
+                        pos = last = call[1]
+                        continue
+                pos = m.end()
+            elif kind == 'str':
+                spec = self._spec_at(text, m.start())
+                end = self._string_end(text, m.start(), spec)
+                out.append(text[last:m.start()])
+                out.append(self._string_text(text[m.start():end], spec, ctx))
+                pos = last = end
+            elif kind == 'nl':
+                out.append(text[last:m.end()])
+                return m.end()
+            else:
+                pos = m.end()
+
+    def _expand(self, text, ctx, disabled):
+        out = []
+        self._scan(text, 0, out, ctx, disabled, False)
+        return ''.join(out)
+
+    def _call(self, name, text, pos, ctx, disabled):
+        """expansion of a call to 'name' whose identifier ends at 'pos', as
+           (text, end of call), or None if this is not a call after all
+        """
+        macro = self.macros[name]
+        args = []
+        if text.startswith('(', pos):
+            (args, pos) = self._read_user_args(text, pos + 1)
+            args = [self._expand(a, CTX_USER, disabled) for a in args]
+        elif macro.params:
+            # needs arguments, so not a macro call
+            return None
+
+        body = macro.body
+        params = macro.params or []
+        if args or params:
+            def subst(m):
+                if m.group(1):
+                    idx = int(m.group(1)) - 1
+                    return args[idx] if idx < len(args) else ''
+                ident = m.group(2)
+                if ident in params:
+                    idx = params.index(ident)
+                    return args[idx] if idx < len(args) else ''
+                return ident
+            body = _SUBST.sub(subst, body)
+        return (self._expand(body, ctx, disabled | frozenset([name])), pos)
+
+    def _read_user_args(self, text, pos):
+        args = []
+        depth = 0
+        start = pos
+        n = len(text)
+        while pos < n:
+            c = text[pos]
+            spec = self._spec_at(text, pos) if self.specs else None
+            if spec is not None:
+                pos = self._string_end(text, pos, spec)
+                continue
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if depth == 0:
+                    args.append(text[start:pos].strip())
+                    return (args, pos + 1)
+                depth -= 1
+            elif c == ',' and depth == 0:
+                args.append(text[start:pos].strip())
+                start = pos + 1
+            pos += 1
+        raise GppError("unfinished macro call")
+
+    # -- strings and comments --------------------------------------------
+
+    def _spec_at(self, text, pos):
+        best = None
+        for spec in self.specs:
+            if text.startswith(spec.start, pos) and (best is None or len(spec.start) > len(best.start)):
+                best = spec
+        return best
+
+    def _string_end(self, text, pos, spec):
+        """position just after the string/comment starting at 'pos'"""
+        i = pos + len(spec.start)
+        n = len(text)
+        while i < n:
+            if spec.quote and text.startswith(spec.quote, i):
+                i += len(spec.quote) + 1
+                continue
+            if text.startswith(spec.end, i):
+                return i + len(spec.end)
+            i += 1
+        raise GppError("unterminated string or comment starting with '{0}'".format(spec.start))
+
+    def _string_text(self, s, spec, ctx):
+        flag = spec.flags[ctx]
+        if flag in 'ciCI':
+            return ''
+        if flag in 'sq':
+            return s
+        inner = s[len(spec.start):len(s) - len(spec.end)]
+        if spec.quote:
+            q = re.escape(spec.quote)
+            inner = re.sub(q + '(.)', r'\1', inner, flags=re.DOTALL)
+        return inner
+
+    def _strip_strings(self, text, ctx):
+        """apply string / comment flags to 'text' without expanding macros"""
+        if not self.specs:
+            return text
+        out = []
+        pos = last = 0
+        n = len(text)
+        while pos < n:
+            spec = self._spec_at(text, pos)
+            if spec is None:
+                pos += 1
+                continue
+            end = self._string_end(text, pos, spec)
+            out.append(text[last:pos])
+            out.append(self._string_text(text[pos:end], spec, ctx))
+            pos = last = end
+        out.append(text[last:])
+        return ''.join(out)
+
+    @staticmethod
+    def _split_define(text):
+        """'name(a, b) rest' -> ('name', ['a', 'b'], ' rest')"""
+        m = _IDENT.match(text)
+        if not m:
+            raise GppError("invalid macro name in '{0}'".format(text.strip()))
+        pos = m.end()
+        params = None
+        if text.startswith('(', pos):
+            close = text.find(')', pos)
+            if close < 0:
+                raise GppError("unterminated parameter list in '{0}'".format(text.strip()))
+            params = [p.strip() for p in text[pos + 1:close].split(',') if p.strip()]
+            pos = close + 1
+        return (m.group(0), params, text[pos:])
+
+
+class _RecordingMacros(dict):
+    """the macro table while Engine.snapshot() runs. Remembers the macros
+       (or their absence) the file looked at before changing them itself,
+       which are all it depends on, and which ones it changed.
+    """
+
+    def __init__(self, macros):
+        dict.__init__(self, macros)
+        # name -> Macro or None (not defined)
+        self.reads = {}
+        self.written = set()
+        # [name as given to %include, path it was found at]
+        self.includes = []
+
+    def _read(self, name):
+        if name not in self.written and name not in self.reads:
+            self.reads[name] = dict.get(self, name)
+
+    def __contains__(self, name):
+        self._read(name)
+        return dict.__contains__(self, name)
+
+    def __getitem__(self, name):
+        self._read(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        self._read(name)
+        return dict.get(self, name, default)
+
+    def __setitem__(self, name, macro):
+        self.written.add(name)
+        dict.__setitem__(self, name, macro)
+
+    def pop(self, name, *default):
+        self.written.add(name)
+        return dict.pop(self, name, *default)
+
+
+class MacroSnapshot(object):
+    """what including a file did, to take over instead of processing it
+       again: the macros it defined and undefined, the string and comment
+       modes it left, and its output.
+
+       It applies wherever the file and everything it included are still
+       the same (by content hash), its includes are found in the same
+       places, and every macro it looked at before defining it (or the
+       absence of one) is the same. Text it used was looked at as well,
+       so that covers everything processing it depends on. %warning
+       messages aren't repeated.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, marker, files, includes, reads, writes, specs_in,
+                 specs_out, output):
+        # as %include found it
+        self.path = path
+        self.marker = marker
+        # [absolute path, sha1], the file itself first
+        self.files = files
+        self.includes = includes
+        self.reads = reads
+        # name -> Macro, or None if it ended up undefined
+        self.writes = writes
+        self.specs_in = specs_in
+        self.specs_out = specs_out
+        self.output = output
+
+    def applies(self, engine):
+        if engine._marker_fmt != self.marker or engine.specs != self.specs_in:
+            return False
+        for (name, macro) in self.reads.items():
+            if engine.macros.get(name) != macro:
+                return False
+        if any(engine.find_include(name) != path for (name, path) in self.includes):
+            return False
+        try:
+            return all(source_digest(path) == digest for (path, digest) in self.files)
+        except OSError:
+            return False
+
+    def flatten(self):
+        """the macros the file (re)defined as '%define' lines, and those it
+           undefined as '%undef' lines, for the external gpp
+        """
+        lines = ['%mode push', '%mode nostring', '%mode nocomment']
+        for name in sorted(self.writes):
+            macro = self.writes[name]
+            if macro is None:
+                lines.append('%undef {0}'.format(name))
+                continue
+            if '\n' in macro.body:
+                raise GppError("{0}: macro '{1}' spans multiple lines".format(self.path, name))
+            params = '' if macro.params is None else '(' + ','.join(macro.params) + ')'
+            lines.append(('%define {0}{1} {2}' if macro.body else '%define {0}{1}')
+                .format(name, params, macro.body))
+        lines.append('%mode pop')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        def specs(specs):
+            return [[s.kind, s.flags, s.start, s.end, s.quote] for s in specs]
+
+        def macro(m):
+            return None if m is None else [m.params, m.body]
+
+        return {'version': self.VERSION, 'engine': ENGINE_VERSION, 'path': self.path,
+            'marker': self.marker, 'files': self.files, 'includes': self.includes,
+            'reads': dict((n, macro(m)) for (n, m) in self.reads.items()),
+            'writes': dict((n, macro(m)) for (n, m) in self.writes.items()),
+            'specs_in': specs(self.specs_in), 'specs_out': specs(self.specs_out),
+            'output': self.output}
+
+    @classmethod
+    def from_json(cls, data):
+        """None for snapshots of another format or engine"""
+        if data.get('version') != cls.VERSION or data.get('engine') != ENGINE_VERSION:
+            return None
+
+        def specs(specs):
+            return [Spec(*s) for s in specs]
+
+        def macro(m):
+            return None if m is None else Macro(m[0], m[1])
+
+        return cls(data['path'], data['marker'], data['files'], data['includes'],
+            dict((n, macro(m)) for (n, m) in data['reads'].items()),
+            dict((n, macro(m)) for (n, m) in data['writes'].items()),
+            specs(data['specs_in']), specs(data['specs_out']), data['output'])
+
+
+def _unescape(s):
+    out = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\' and i + 1 < len(s):
+            nxt = s[i + 1]
+            if nxt not in _MODE_ESCAPES:
+                raise Unsupported("special sequence '\\{0}' in %mode is not supported".format(nxt))
+            out.append(_MODE_ESCAPES[nxt])
+            i += 2
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def preprocess(src_file, dest_file, include_dirs, macro_strs, marker=DEFAULT_MARKER):
+    """the equivalent of running gpp with the command line built by
+       ktransw.setup_gpp_cline(). Returns the list of files entered.
+    """
+    engine = Engine(include_dirs, macro_strs, marker)
+    write_output(dest_file, engine.process_file(src_file))
+    return engine.included
+
+
+def parse_cmdline(argv):
+    """(input, output, include dirs, macros, marker) from a gpp command line.
+       Raises Unsupported for anything ktransw wouldn't have passed.
+    """
+    inpt = outpt = None
+    include_dirs = []
+    macros = []
+    marker = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '+z':
+            pass
+        elif arg == '--includemarker':
+            marker = argv[i + 1]
+            i += 1
+        elif arg == '-U':
+            if tuple(argv[i + 1:i + 10]) != USER_MODE:
+                raise Unsupported("unsupported user mode: {0}".format(argv[i + 1:i + 10]))
+            i += 9
+        elif arg == '-M':
+            if tuple(argv[i + 1:i + 8]) != META_MODE:
+                raise Unsupported("unsupported meta mode: {0}".format(argv[i + 1:i + 8]))
+            i += 7
+        elif arg.startswith('-I'):
+            if arg == '-I':
+                i += 1
+                arg = '-I' + argv[i]
+            include_dirs.append(arg[2:])
+        elif arg.startswith('-D'):
+            macros.append(arg[2:])
+        elif arg == '-o':
+            outpt = argv[i + 1]
+            i += 1
+        elif arg.startswith('-o'):
+            outpt = arg[2:]
+        elif arg.startswith(('-', '+')) and arg != '-':
+            raise Unsupported("unsupported option: {0}".format(arg))
+        else:
+            inpt = arg
+        i += 1
+    return (inpt, outpt, include_dirs, macros, marker)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        (inpt, outpt, include_dirs, macros, marker) = parse_cmdline(argv)
+        engine = Engine(include_dirs, macros, marker)
+        if inpt and inpt != '-':
+            text = engine.process_file(inpt)
+        else:
+            text = engine.process_text(sys.stdin.read().replace('\r\n', '\n'), 'stdin')
+        if outpt:
+            write_output(outpt, text)
+        else:
+            sys.stdout.write(text)
+    except (GppError, OSError) as e:
+        sys.stderr.write("pygpp: {0}\n".format(e))
+        return getattr(e, 'returncode', 1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
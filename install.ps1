@@ -4,6 +4,9 @@ function ktransw_install {
     #install python dependencies
     pip3 install -r "$PSScriptRoot\requirements.txt"
 
+    #precompile ktransw and kcdictw into zipapps, which start faster
+    python "$PSScriptRoot\make_zipapp.py"
+
     #add ktransw to path
     [Environment]::SetEnvironmentVariable("Path", $env:Path + ";" + "$PSScriptRoot\bin" + ";" + "$PSScriptRoot\deps\gpp", "User");
     Write-Output "Added to Path: $PSScriptRoot\bin"
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Build bin/ktransw.pyz and bin/kcdictw.pyz.
+
+Python never caches the bytecode of the script it is started with, so
+'python ktransw.py' compiles all of ktransw on every invocation. The
+zipapps hold a two line __main__ and the modules compiled for the Python
+running this script, which the .cmd wrappers start instead when present.
+Other Python versions fall back to the sources stored alongside.
+
+Rebuild them after updating ktransw (install.ps1 does).
+"""
+
+import argparse
+import os
+import py_compile
+import sys
+import tempfile
+import zipfile
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+
+# zipapp -> the modules it needs, the first being the one it runs
+TOOLS = {
+    'ktransw': ('ktransw', 'pygpp'),
+    'kcdictw': ('kcdictw', 'ktransw', 'pygpp'),
+}
+
+MAIN = """import {0}
+{0}.main()
+"""
+
+
+def compiled(path):
+    """the bytecode of 'path', for a .pyc that is never checked against
+       the source: the archive is rebuilt, not edited
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        cfile = os.path.join(tmp, 'module.pyc')
+        py_compile.compile(path, cfile=cfile, doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(cfile, 'rb') as f:
+            return f.read()
+
+
+def build(tool, out_dir=BIN_DIR):
+    target = os.path.join(out_dir, tool + '.pyz')
+    tmp = '{0}.{1}.tmp'.format(target, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write('#!/usr/bin/env python3\n'.encode('utf-8'))
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as z:
+            z.writestr('__main__.py', MAIN.format(tool))
+            for module in TOOLS[tool]:
+                source = os.path.join(BIN_DIR, module + '.py')
+                z.write(source, module + '.py')
+                z.writestr(module + '.pyc', compiled(source))
+    os.chmod(tmp, 0o755)
+    os.replace(tmp, target)
+    return target
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--out-dir', default=BIN_DIR,
+        help='where to write the zipapps (default: %(default)s)')
+    parser.add_argument('tools', nargs='*', metavar='TOOL',
+        help='the zipapps to build: {0} (default: all)'.format(', '.join(sorted(TOOLS))))
+    args = parser.parse_args(argv)
+    for tool in args.tools:
+        if tool not in TOOLS:
+            parser.error("unknown tool '{0}'".format(tool))
+    for tool in args.tools or sorted(TOOLS):
+        print(build(tool, args.out_dir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import sys
+
+import pytest
+
+
+# logs the source it was given, and writes it out as the .pc
+FAKE_KTRANS = '''#!{python}
+import os, sys
+with open({log!r}, 'a') as f:
+    f.write(sys.argv[1] + '\\n')
+name = os.path.splitext(os.path.basename(sys.argv[1]))[0]
+with open(name + '.pc', 'w') as f:
+    f.write(open(sys.argv[1]).read())
+'''
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """a program including a header and instantiating a class, with its
+       headers in include/ and a fake ktrans, as the working directory.
+       Tests add or overwrite files as they need.
+    """
+    monkeypatch.delenv('MAKEFLAGS', raising=False)
+    inc = tmp_path / 'include'
+    inc.mkdir()
+    (inc / 'namespace.m').write_text('%define namespace_m\n')
+    (inc / 'errors.klh').write_text('ROUTINE raise FROM errors\n')
+    (inc / 'stack.klc').write_text('PROGRAM class_name\nBEGIN\nEND class_name\n')
+    (inc / 'stack.klh').write_text('ROUTINE push FROM class_name\n')
+    (tmp_path / 'prog.kl').write_text(
+        "PROGRAM prog\n%include errors.klh\n%class stk('stack.klc','stack.klh')\n"
+        'BEGIN\nEND prog\n')
+
+    ktrans = tmp_path / 'ktrans'
+    ktrans.write_text(FAKE_KTRANS.format(python=sys.executable,
+        log=str(tmp_path / 'ktrans.log')))
+    ktrans.chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016, G.A. vd. Hoorn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Regenerate the expected.out of every case in corpus/gpp with the real gpp.
+
+Runs gpp (from the PATH, or --gpp; on Windows the gpp.exe shipped in
+deps/gpp by default) with the command line ktransw builds on the main.kl of
+each case. With --check nothing is written: the script
+fails if any golden differs from what gpp produces.
+"""
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+from ktransw import setup_gpp_cline
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gpp')
+VENDORED_GPP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+    'deps', 'gpp', 'gpp.exe')
+
+
+def find_gpp():
+    if shutil.which('gpp'):
+        return shutil.which('gpp')
+    if os.name == 'nt' and os.path.exists(VENDORED_GPP):
+        return os.path.abspath(VENDORED_GPP)
+    return None
+
+
+def case_defines(case_dir):
+    path = os.path.join(case_dir, 'args')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [l.strip()[2:] for l in f if l.strip()]
+
+
+def gpp_cmdline(gpp, out, defines):
+    """the command line ktransw runs gpp with, for the main.kl of a case"""
+    cmdline = ' '.join(setup_gpp_cline('"{0}"'.format(gpp), 'main.kl', out, ['inc'], defines))
+    if os.name != 'nt':
+        # no CreateProcess to split the command line for us
+        cmdline = shlex.split(cmdline)
+    return cmdline
+
+
+def run_gpp(gpp, case_dir):
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'out.pp')
+        subprocess.check_call(gpp_cmdline(gpp, out, case_defines(case_dir)), cwd=case_dir)
+        with open(out, 'rb') as f:
+            return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--gpp', default=find_gpp())
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+    if not args.gpp:
+        sys.exit("gpp not found, use --gpp")
+
+    stale = []
+    for case in sorted(os.listdir(CORPUS)):
+        case_dir = os.path.join(CORPUS, case)
+        golden = os.path.join(case_dir, 'expected.out')
+        output = run_gpp(args.gpp, case_dir)
+        with open(golden, 'rb') as f:
+            if f.read() == output:
+                continue
+        stale.append(case)
+        if not args.check:
+            with open(golden, 'wb') as f:
+                f.write(output)
+    for case in stale:
+        print("{0}: {1}".format(case, 'differs from gpp' if args.check else 'updated'))
+    if args.check and stale:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+import ktransw
+from ktransw import compile_karel
+
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+
+
+def api_compile(root, **kwargs):
+    kwargs.setdefault('ktrans', str(root / 'ktrans'))
+    return compile_karel(str(root / 'prog.kl'), include_dirs=[str(root / 'include')],
+        engine='builtin', **kwargs)
+
+
+def test_compile_into_output_dir(workspace, capsys):
+    out = workspace / 'out'
+    out.mkdir()
+    result = api_compile(workspace, output_dir=str(out))
+    assert result.ok
+    assert sorted(os.path.basename(f) for f in result.files) == ['prog.pc', 'stk.pc']
+    assert all(os.path.exists(f) for f in result.files)
+    assert not (workspace / 'prog.pc').exists()
+    assert str(workspace / 'include' / 'errors.klh') in result.dependencies
+    assert [obj[1] for obj in result.classes] == ['stk']
+    assert set(result.timings) == set(['preprocess', 'ktrans', 'total'])
+    assert capsys.readouterr() == ('', '')
+
+
+def test_errors_are_returned(workspace, capsys):
+    (workspace / 'prog.kl').write_text('PROGRAM prog\n%include missing.klh\nBEGIN\nEND prog\n')
+    result = api_compile(workspace)
+    assert not result.ok
+    assert 'missing.klh' in ''.join(result.diagnostics)
+    assert capsys.readouterr() == ('', '')
+
+
+def test_tools_that_cannot_run_are_returned(workspace, capsys):
+    result = compile_karel(str(workspace / 'prog.kl'), include_dirs=[str(workspace / 'include')],
+        gpp=str(workspace / 'no-gpp'), ktrans=str(workspace / 'ktrans'))
+    assert result.returncode == 1
+    assert 'no-gpp' in ''.join(result.diagnostics)
+
+    result = api_compile(workspace, ktrans=str(workspace / 'no-ktrans'))
+    assert result.returncode == 1
+    assert 'no-ktrans' in ''.join(result.diagnostics)
+    assert capsys.readouterr() == ('', '')
+
+
+def test_environment_is_ignored(workspace, monkeypatch):
+    monkeypatch.setenv('KTRANSW_BUILD_DIR', str(workspace / 'build'))
+    monkeypatch.setenv('KTRANSW_DEFER_MANIFEST', '1')
+    # the command line defaults are read when the parser is built
+    monkeypatch.setattr(ktransw, '_parser', None)
+    (workspace / '.man_log').write_text('')
+    assert api_compile(workspace, manifest=str(workspace / '.man_log')).ok
+    assert not (workspace / 'build').exists()
+    assert 'prog' in (workspace / '.man_log').read_text()
+
+
+def test_compiles_in_threads_are_isolated(workspace):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(i):
+        (workspace / 'p{0}.kl'.format(i)).write_text(
+            "PROGRAM p{0}\n%class obj{0}('stack.klc','stack.klh')\nBEGIN\nEND p{0}\n".format(i))
+        out = workspace / 'out{0}'.format(i)
+        out.mkdir()
+        return compile_karel(str(workspace / 'p{0}.kl'.format(i)),
+            include_dirs=[str(workspace / 'include')], ktrans=str(workspace / 'ktrans'),
+            engine='builtin', output_dir=str(out))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(run, range(8)))
+    for (i, result) in enumerate(results):
+        assert result.ok
+        assert [obj[1] for obj in result.classes] == ['obj{0}'.format(i)]
+        assert sorted(os.path.basename(f) for f in result.files) == \
+            ['obj{0}.pc'.format(i), 'p{0}.pc'.format(i)]
+
+
+def test_memory_stays_flat(workspace):
+    import gc
+    import tracemalloc
+
+    out = workspace / 'out'
+    out.mkdir()
+
+    def compile_many(n):
+        for _ in range(n):
+            assert api_compile(workspace, preprocess_only=True, output_dir=str(out)).ok
+        ktransw._trash_queue().join()
+        gc.collect()
+
+    compile_many(50)
+    tracemalloc.start()
+    try:
+        compile_many(100)
+        before = tracemalloc.get_traced_memory()[0]
+        compile_many(1000)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert after - before < 256 * 1024, (before, after)
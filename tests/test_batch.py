@@ -0,0 +1,55 @@
+import json
+import os
+
+import pytest
+
+from ktransw import expand_response_files, main
+
+
+def test_expand_response_files(tmp_path):
+    rsp = tmp_path / 'sources.rsp'
+    rsp.write_text('a.kl\n\n  b.kl  \n/config robot.ini\n')
+    assert expand_response_files(['-q', '@' + str(rsp), 'c.kl']) == \
+        ['-q', 'a.kl', 'b.kl', '/config robot.ini', 'c.kl']
+    # not a file: passed on untouched
+    assert expand_response_files(['@nope']) == ['@nope']
+
+
+def test_batch_needs_per_source_depfile(tmp_path, capsys):
+    with pytest.raises(SystemExit) as e:
+        main(['-M', '-MF', 'deps.d', str(tmp_path / 'a.kl'), str(tmp_path / 'b.kl')])
+    assert e.value.code == 65
+    assert "-MF must contain '{name}'" in capsys.readouterr().err
+
+
+def test_batch_reports_status_per_source(tmp_path, capsys):
+    for name in ('a.kl', 'b.kl'):
+        (tmp_path / name).write_text('PROGRAM x\nBEGIN\nEND x\n')
+    report = tmp_path / 'report.json'
+    missing_gpp = str(tmp_path / 'no-such-gpp')
+
+    with pytest.raises(SystemExit) as e:
+        main(['-j', '2', '--gpp', missing_gpp, '--batch-report', str(report),
+              str(tmp_path / 'a.kl'), str(tmp_path / 'b.kl')])
+    assert e.value.code != 0
+
+    statuses = json.loads(report.read_text())
+    assert sorted(os.path.basename(k) for k in statuses) == ['a.kl', 'b.kl']
+    assert all(ret != 0 for ret in statuses.values())
+    err = capsys.readouterr().err
+    assert 'a.kl: failed' in err and 'b.kl: failed' in err
+
+
+def test_batch_relays_worker_logs_per_source(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('a', 'b'):
+        (tmp_path / (name + '.kl')).write_text('PROGRAM {0}\nBEGIN\nEND {0}\n'.format(name))
+    with pytest.raises(SystemExit) as e:
+        main(['-v', '--engine=builtin', '-E', '-j', '2',
+              str(tmp_path / 'a.kl'), str(tmp_path / 'b.kl')])
+    assert e.value.code == 0
+
+    lines = [l for l in capsys.readouterr().err.splitlines() if 'Starting pre-processing' in l]
+    # the log of a source is relayed as a whole, after the one before it
+    sources = [('a' if 'a.kl' in l else 'b') for l in lines]
+    assert sources == sorted(sources) and len(set(sources)) == 2
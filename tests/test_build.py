@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+from ktransw import BuildHistory, SourceStats, build_report, discover_sources, main
+
+
+def build(root, *args):
+    with pytest.raises(SystemExit) as e:
+        main(['build', '--engine=builtin', '--ktrans', str(root / 'ktrans'),
+              '-I', str(root / 'include')] + list(args))
+    return e.value.code
+
+
+def add_programs(root):
+    src = root / 'src'
+    (src / '.hidden').mkdir(parents=True)
+    (src / 'a.kl').write_text('PROGRAM a\nBEGIN\nEND a\n')
+    (src / 'b.kl').write_text("-- b\nprogram b\n%class sb('stack.klc','stack.klh')\nBEGIN\nEND b\n")
+    (src / 'helpers.kl').write_text('ROUTINE helper FROM a\n')
+    (src / '.hidden' / 'c.kl').write_text('PROGRAM c\nBEGIN\nEND c\n')
+    (root / 'include' / 'lib.kl').write_text('PROGRAM lib\nBEGIN\nEND lib\n')
+    return src
+
+
+def test_discover_sources(workspace):
+    src = add_programs(workspace)
+    found = discover_sources([str(workspace)], [str(workspace / 'include')])
+    assert found == [str(workspace / 'prog.kl'), str(src / 'a.kl'), str(src / 'b.kl')]
+    assert discover_sources([str(src / 'helpers.kl')]) == [str(src / 'helpers.kl')]
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+def test_build_records_history(workspace, capsys):
+    add_programs(workspace)
+    assert build(workspace, '-j', '2') == 0
+    for name in ('prog', 'a', 'b', 'stk', 'sb'):
+        assert (workspace / (name + '.pc')).exists()
+
+    with open(str(workspace / '.ktransw_history.json')) as f:
+        programs = json.load(f)['programs']
+    assert sorted(os.path.basename(p) for p in programs) == ['a.kl', 'b.kl', 'prog.kl']
+    prog = programs[str(workspace / 'prog.kl')]
+    assert prog['duration'] > 0
+    assert prog['classes'] == [['stk', 'stack.klc']]
+    assert str(workspace / 'include' / 'errors.klh') in prog['includes']
+
+    # the report follows what ktrans printed
+    out = capsys.readouterr().out.splitlines()[-3:]
+    assert out[0].startswith('ktransw: built 3 programs in ')
+    assert out[1].startswith('ktransw: parallel efficiency ')
+    assert out[2].startswith('ktransw: critical path ')
+
+
+def test_longest_first(workspace, capsys):
+    src = add_programs(workspace)
+    history = BuildHistory(str(workspace / '.ktransw_history.json'))
+    for (path, duration, includes) in ((src / 'a.kl', 5.0, 0), (workspace / 'prog.kl', 1.0, 20)):
+        stats = SourceStats(0, 1)
+        stats.duration = duration
+        stats.includes = ['h{0}.klh'.format(i) for i in range(includes)]
+        history.record(str(path), stats)
+    history.save()
+
+    assert build(workspace, '-d') == 0
+    order = [line.split()[-1] for line in capsys.readouterr().out.splitlines()]
+    # b wasn't built before: it's estimated from the size of its graph
+    assert order == [os.path.join('src', 'a.kl'), os.path.join('src', 'b.kl'), 'prog.kl']
+
+
+def test_report():
+    stats = {}
+    for (name, start, duration, worker) in (('a.kl', 0, 1, 1), ('b.kl', 1, 3, 1),
+                                            ('c.kl', 0, 2, 2)):
+        stats[name] = SourceStats(100 + start, worker)
+        stats[name].duration = duration
+    stats['b.kl'].classes = [['x', 'x.klc']]
+    lines = build_report(stats, 100, 4, 2).splitlines()
+    assert lines == ['ktransw: built 3 programs in 4.00 s on 2 workers',
+        'ktransw: parallel efficiency 75% (6.00 s compiling)',
+        'ktransw: critical path 4.00 s: a.kl (1.00 s) -> b.kl (3.00 s, 1 class objects)']
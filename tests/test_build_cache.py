@@ -0,0 +1,152 @@
+import argparse
+import os
+import time
+
+import ktransw
+from ktransw import BuildCache, CompilationContext, parse_size
+
+
+def make_args(**kwargs):
+    args = argparse.Namespace(user_macros=[], include_dirs=[], gpp_path=None,
+        cache_dir=None)
+    for (k, v) in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def write(path, text):
+    with open(str(path), 'w') as f:
+        f.write(text)
+    # make sure the stat signature changes, even on coarse timestamps
+    t = time.time() + len(text)
+    os.utime(str(path), (t, t))
+
+
+def test_store_and_lookup(tmp_path):
+    src = tmp_path / 'prog.kl'
+    hdr = tmp_path / 'prog.klh'
+    write(src, 'PROGRAM prog\n')
+    write(hdr, 'ROUTINE foo\n')
+    out = tmp_path / 'build' / 'prog.kl'
+    out.parent.mkdir()
+    write(out, 'preprocessed\n')
+
+    cache = BuildCache(str(tmp_path / 'cache'))
+    args = make_args()
+    key = cache.input_key(str(src), args)
+    assert cache.lookup(key) is None
+
+    cache.store(key, [str(hdr)], [str(out)],
+        {'kl_files': ['prog.kl'], 'classes': [[1, 'obj', 'a.klc', 'a.klh']]})
+    entry = cache.lookup(key)
+    assert entry is not None
+    assert entry.deps == [str(hdr)]
+    assert entry.meta['kl_files'] == ['prog.kl']
+    assert entry.meta['classes'] == [[1, 'obj', 'a.klc', 'a.klh']]
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_counters_stay_small(tmp_path):
+    cache = BuildCache(str(tmp_path / 'cache'))
+    # counted by an earlier version, one byte per event
+    (tmp_path / 'cache' / 'stats').mkdir(parents=True)
+    (tmp_path / 'cache' / 'stats' / 'hits').write_bytes(b'...')
+    for _ in range(200):
+        cache.lookup('m' * 40)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (3, 200)
+    assert not (tmp_path / 'cache' / 'stats').exists()
+    size = os.path.getsize(str(tmp_path / 'cache' / 'stats.db'))
+    for _ in range(200):
+        cache.lookup('m' * 40)
+    assert os.path.getsize(str(tmp_path / 'cache' / 'stats.db')) == size
+
+
+def test_restore(tmp_path):
+    out = tmp_path / 'prog.kl'
+    write(out, 'preprocessed\n')
+    cache = BuildCache(str(tmp_path / 'cache'))
+    cache.store('k' * 40, [], [str(out)], {'kl_files': ['prog.kl'], 'classes': []})
+
+    folder = tmp_path / 'other'
+    folder.mkdir()
+    ctx = CompilationContext(make_args(), None, str(folder))
+    cache.lookup('k' * 40).restore(ctx)
+    assert ctx.kl_files == [str(folder / 'prog.kl')]
+    assert (folder / 'prog.kl').read_text() == 'preprocessed\n'
+
+
+def test_dependency_change_is_a_miss(tmp_path):
+    hdr = tmp_path / 'prog.klh'
+    write(hdr, 'ROUTINE foo\n')
+    out = tmp_path / 'prog.kl'
+    write(out, 'preprocessed\n')
+    cache = BuildCache(str(tmp_path / 'cache'))
+    cache.store('k' * 40, [str(hdr)], [str(out)], {})
+    assert cache.lookup('k' * 40) is not None
+
+    write(hdr, 'ROUTINE bar\n')
+    assert cache.lookup('k' * 40) is None
+
+
+def test_input_key_depends_on_macros(tmp_path):
+    src = tmp_path / 'prog.kl'
+    write(src, 'PROGRAM prog\n')
+    cache = BuildCache(str(tmp_path / 'cache'))
+    assert (cache.input_key(str(src), make_args()) !=
+        cache.input_key(str(src), make_args(user_macros=['DEBUG'])))
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = BuildCache(str(tmp_path / 'cache'))
+    for i in range(3):
+        out = tmp_path / 'prog{0}.kl'.format(i)
+        write(out, 'x' * 1000)
+        cache.store(str(i) * 40, [], [str(out)], {})
+        meta = os.path.join(cache._result_path(cache._read_json(cache._index_path(str(i) * 40))[0]['result']), 'meta.json')
+        os.utime(meta, (1000 + i, 1000 + i))
+
+    assert cache.stats()['entries'] == 3
+    assert cache.evict(2500) == 1
+    assert cache.lookup('0' * 40) is None
+    assert cache.lookup('2' * 40) is not None
+
+
+def test_parse_size():
+    assert parse_size('1024') == 1024
+    assert parse_size('2K') == 2048
+    assert parse_size('500M') == 500 * 1024 * 1024
+    assert parse_size('1gb') == 1024 ** 3
+
+
+def test_class_expansion_roundtrip(tmp_path):
+    klc = tmp_path / 'stack.klc'
+    write(klc, 'ROUTINE push\n')
+    build = tmp_path / 'build'
+    build.mkdir()
+    write(build / 'pre-stk.klh', '%defeval class_name stk\n%include stack.klh\n')
+    write(build / 'stk.kl', 'PROGRAM stk\n')
+
+    ctx = CompilationContext(make_args(), None, str(build))
+    ctx.header_injections.append(str(build / 'pre-stk.klh'))
+    ctx.kl_files.append(str(build / 'stk.kl'))
+    ctx.selective_includes.append(str(klc))
+    expansion = ktransw._ClassExpansion.record(ctx, (0, 0, 0, 0))
+
+    cache = BuildCache(str(tmp_path / 'cache'))
+    expansion.save(cache, 'c' * 40, str(build))
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    restored = ktransw._ClassExpansion.from_entry(cache.lookup('c' * 40))
+    assert restored.is_current()
+    ctx = CompilationContext(make_args(), None, str(other))
+    restored.replay(ctx)
+    assert ctx.kl_files == [str(other / 'stk.kl')]
+    assert ctx.header_injections == [str(other / 'pre-stk.klh')]
+    assert (other / 'pre-stk.klh').read_text() == '%defeval class_name stk\n%include stack.klh\n'
+
+    write(klc, 'ROUTINE pop\n')
+    assert not restored.is_current()
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ktransw
+from ktransw import build_parser, discard_dir, main, target_build_dir
+
+
+def compile(root, *args):
+    with pytest.raises(SystemExit) as e:
+        main(['-q', '--engine=builtin', '--ktrans', str(root / 'ktrans'),
+              '-I', str(root / 'include')] + list(args) + [str(root / 'prog.kl')])
+    return e.value.code
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+def test_build_dir_is_reused(workspace):
+    build = workspace / 'build'
+    assert compile(workspace, '--build-dir', str(build)) == 0
+    (target,) = list(build.iterdir())
+    assert target.name.startswith('prog-')
+    names = sorted(os.listdir(str(target)))
+    assert 'prog.kl' in names and 'stk.kl' in names
+    assert [n for n in names if n.endswith('.tmp')] == []
+
+    inode = os.stat(str(target)).st_ino
+    (workspace / 'prog.kl').write_text('PROGRAM prog\nBEGIN\nEND prog\n')
+    assert compile(workspace, '--build-dir', str(build)) == 0
+    assert [p.name for p in build.iterdir()] == [target.name]
+    assert os.stat(str(target)).st_ino == inode
+    assert (target / 'prog.kl').read_text().endswith('PROGRAM prog\nBEGIN\nEND prog\n')
+
+
+def test_targets_get_their_own_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parse = build_parser().parse_args
+    debug = target_build_dir('prog.kl', parse(['--build-dir', 'b', 'prog.kl', 'debug/prog.pc']))
+    release = target_build_dir('prog.kl', parse(['--build-dir', 'b', 'prog.kl', 'release/prog.pc']))
+    assert os.path.dirname(debug) == os.path.dirname(release) == str(tmp_path / 'b')
+    assert debug != release
+    assert debug == target_build_dir('prog.kl', parse(['--build-dir', 'b', 'prog.kl', 'debug/prog.pc']))
+    assert target_build_dir('prog.kl', parse(['prog.kl'])) is None
+
+
+def test_ram_build_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('KTRANSW_RAM_DIR', str(tmp_path))
+    args = build_parser().parse_args(['--ram-build-dir', 'prog.kl'])
+    path = target_build_dir('prog.kl', args)
+    assert os.path.dirname(path) == str(tmp_path / ktransw.RAM_BUILD_DIR)
+
+    # an explicit --build-dir wins
+    args = build_parser().parse_args(['--ram-build-dir', '--build-dir', 'b', 'prog.kl'])
+    assert not target_build_dir('prog.kl', args).startswith(str(tmp_path))
+
+
+def test_discarded_dirs_are_deleted_in_the_background(tmp_path):
+    old = tmp_path / 'ktransw-x-buildd'
+    (old / 'sub').mkdir(parents=True)
+    (old / 'sub' / 'pass1-prog.kl').write_text('x')
+    discard_dir(str(old))
+    assert not old.exists()
+    ktransw._trash_queue().join()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_leftovers_are_swept_once_in_a_while(tmp_path, monkeypatch):
+    import tempfile
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    left = tmp_path / 'ktransw-x-buildd.trash'
+    left.mkdir()
+    ktransw._sweep_trash()
+    assert not left.exists()
+    assert (tmp_path / ktransw.TRASH_SWEEP_STAMP).exists()
+
+    # not again within the interval
+    left.mkdir()
+    ktransw._sweep_trash()
+    assert left.exists()
+
+
+def test_discarded_dirs_are_deleted_after_exit(tmp_path):
+    import time
+    old = tmp_path / 'ktransw-x-buildd'
+    (old / 'sub').mkdir(parents=True)
+    # exits right away, without waiting for the delete
+    subprocess.check_call([sys.executable, '-c', 'import sys, ktransw\n'
+        'ktransw.discard_dir(sys.argv[1])\n', str(old)],
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(ktransw.__file__)))
+    deadline = time.time() + 30
+    while os.listdir(str(tmp_path)) and time.time() < deadline:
+        time.sleep(0.05)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+
+import pytest
+
+import ktransw
+from ktransw import CompilationContext, KtranswError, build_parser, make_classes
+
+
+@pytest.fixture
+def workspace(workspace):
+    inc = workspace / 'include'
+    (inc / 'stack.klc').write_text(
+        'PROGRAM class_name\nROUTINE push(v : INTEGER)\nBEGIN\nEND push\n'
+        'BEGIN\nEND class_name\n')
+    (inc / 'stack.klh').write_text('ROUTINE push(v : INTEGER) FROM class_name\n')
+    # a class instantiating classes of its own
+    (inc / 'queue.klc').write_text(
+        "PROGRAM class_name\n%class qa('stack.klc','stack.klh')\n"
+        "%class qb('stack.klc','stack.klh')\nBEGIN\nEND class_name\n")
+    (inc / 'queue.klh').write_text('ROUTINE enqueue(v : INTEGER) FROM class_name\n')
+    lines = ['PROGRAM prog\n']
+    for i in range(6):
+        lines.append("%class stk{0}('stack.klc','stack.klh')\n".format(i))
+    lines.append("%class que('queue.klc','queue.klh')\n")
+    lines.append('BEGIN\nEND prog\n')
+    (workspace / 'prog.kl').write_text(''.join(lines))
+    return workspace
+
+
+def compile_in(root, name, jobs):
+    folder = root / name
+    folder.mkdir()
+    args = build_parser().parse_args(['--engine=builtin', '-j', str(jobs),
+        '-I', str(root / 'include'), str(root / 'prog.kl')])
+    ktransw._jobserver = None
+    # expand the class objects again, rather than replaying them
+    ctx = CompilationContext(args, logging.getLogger('test'), str(folder), class_cache={})
+    try:
+        make_classes(ctx, str(root / 'prog.kl'), str(folder / 'prog.kl'))
+        files = [(os.path.basename(f), open(f).read().replace(str(folder), '@'))
+            for f in ctx.kl_files]
+        headers = [os.path.basename(f) for f in ctx.header_injections]
+        return files, headers, list(ctx.class_injections)
+    finally:
+        ktransw._jobserver = None
+
+
+def test_parallel_expansion_matches_serial(workspace, monkeypatch):
+    threads = set()
+    expand = ktransw.expand_class_object
+
+    def recording(*args):
+        threads.add(threading.get_ident())
+        return expand(*args)
+    monkeypatch.setattr(ktransw, 'expand_class_object', recording)
+
+    serial = compile_in(workspace, 'serial', 1)
+    assert len(threads) == 1
+    parallel = compile_in(workspace, 'parallel', 4)
+    assert len(threads) > 2
+
+    assert parallel == serial
+    assert [name for (name, _) in serial[0]] == ['stk0.kl', 'stk1.kl', 'stk2.kl',
+        'stk3.kl', 'stk4.kl', 'stk5.kl', 'qa.kl', 'qb.kl', 'que.kl', 'prog.kl']
+    assert serial[1][-3:] == ['pre-que.klh', 'pre-qa.klh', 'pre-qb.klh']
+
+
+def test_first_failing_sibling_is_reported(workspace):
+    src = workspace / 'prog.kl'
+    src.write_text("PROGRAM prog\n%class a('stack.klc','stack.klh')\n"
+        "%class b('missing1.klc','stack.klh')\n%class c('stack.klc','stack.klh')\n"
+        "%class d('missing2.klc','stack.klh')\nBEGIN\nEND prog\n")
+    with pytest.raises(KtranswError) as e:
+        compile_in(workspace, 'build', 4)
+    assert 'missing1.klc' in str(e.value)
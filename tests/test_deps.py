@@ -0,0 +1,85 @@
+import logging
+import os
+
+import pytest
+
+from ktransw import (CompilationContext, build_parser, get_includes_from_file, main,
+    make_classes, scan_dependencies)
+
+
+def write_workspace(root):
+    inc = root / 'include'
+    (inc / 'errors.klh').write_text(
+        '%ifndef errors_h\n%define errors_h\n%include strings.klh\n'
+        'ROUTINE raise(msg : STRING) FROM errors\n%endif\n')
+    (inc / 'strings.klh').write_text('ROUTINE concat(a : STRING) FROM strings\n')
+    (inc / 'debug.klh').write_text('ROUTINE trace FROM debug\n')
+    (inc / 'release.klh').write_text('ROUTINE nothing FROM release\n')
+    (inc / 'stack.klc').write_text('PROGRAM class_name\nBEGIN\nEND class_name\n')
+    (inc / 'stack.klh').write_text('%include errors.klh\nROUTINE push FROM class_name\n')
+    (inc / 'int.klt').write_text('%define stack_type INTEGER\n')
+    (inc / 'math.klh').write_text('%define prog_name math\nROUTINE math__add FROM math\n')
+    src = root / 'prog.kl'
+    src.write_text(
+        'PROGRAM prog\n%include errors.klh\n%include errors.klh\n'
+        '%ifdef DEBUG\n%include debug.klh\n%else\n%include release.klh\n%endif\n'
+        "%class stk('stack.klc','stack.klh','int.klt')\n"
+        '%from math.klh %import add\nBEGIN\nEND prog\n')
+    return src, inc
+
+
+def names(found):
+    return [os.path.basename(name) for (name, _) in found]
+
+
+def test_scan_follows_directives(workspace):
+    src, inc = write_workspace(workspace)
+    args = build_parser().parse_args(['-I', str(inc), str(src)])
+    found = scan_dependencies(str(src), args)
+    assert names(found) == ['errors.klh', 'strings.klh', 'release.klh', 'stack.klc',
+        'stack.klh', 'int.klt', 'math.klh', 'namespace.m']
+    assert all(path == str(inc / name) for (name, path) in found)
+
+    args = build_parser().parse_args(['-DDEBUG', '-I', str(inc), str(src)])
+    assert 'debug.klh' in names(scan_dependencies(str(src), args))
+    assert 'release.klh' not in names(scan_dependencies(str(src), args))
+
+
+def test_scan_covers_the_include_markers(workspace):
+    src, inc = write_workspace(workspace)
+    args = build_parser().parse_args(['--engine=builtin', '-I', str(inc), str(src)])
+    build = workspace / 'build'
+    build.mkdir()
+    ctx = CompilationContext(args, logging.getLogger('test'), str(build))
+    make_classes(ctx, str(src), str(build / 'prog.kl'))
+
+    markers = set(os.path.basename(h) for h in get_includes_from_file(str(build / 'prog.kl')))
+    assert markers <= set(names(scan_dependencies(str(src), args)))
+
+
+def test_deps_only_writes_rule(workspace):
+    src, inc = write_workspace(workspace)
+    with pytest.raises(SystemExit) as e:
+        main(['--deps-only', '-MF', 'deps.d', '-I', str(inc), str(src), str(src)])
+    assert e.value.code == 65
+
+    (workspace / 'deps').mkdir()
+    with pytest.raises(SystemExit) as e:
+        main(['--deps-only', '-MF', 'deps/{name}.d', '-I', str(inc), str(src)])
+    assert e.value.code == 0
+    rule = (workspace / 'deps' / 'prog.d').read_text()
+    assert rule.startswith('prog.pc: ' + str(inc / 'errors.klh') + ' ')
+
+
+def test_deps_only_missing_header(tmp_path, capsys):
+    src = tmp_path / 'prog.kl'
+    src.write_text('PROGRAM prog\n%include nope.klh\nBEGIN\nEND prog\n')
+    with pytest.raises(SystemExit) as e:
+        main(['--deps-only', str(src)])
+    assert e.value.code == 65
+    assert 'nope.klh: No such file or directory' in capsys.readouterr().err
+
+    with pytest.raises(SystemExit) as e:
+        main(['--deps-only', '-MG', str(src)])
+    assert e.value.code == 0
+    assert capsys.readouterr().out == 'prog.pc: nope.klh\n'
@@ -0,0 +1,102 @@
+import os
+import sys
+
+import pytest
+
+import ktransw
+from ktransw import IncludeIndex
+
+
+def make_dirs(root, *names):
+    dirs = []
+    for name in names:
+        d = root / name
+        d.mkdir()
+        dirs.append(str(d))
+    return dirs
+
+
+def test_dirs_are_deduplicated_and_pruned(tmp_path):
+    (a, b) = make_dirs(tmp_path, 'a', 'b')
+    index = IncludeIndex([a, str(tmp_path / 'missing'), b, a + os.sep, b])
+    assert index.dirs == [a, b]
+
+
+def test_first_dir_wins(tmp_path):
+    (a, b) = make_dirs(tmp_path, 'a', 'b')
+    for d in (a, b):
+        open(os.path.join(d, 'both.klh'), 'w').close()
+    open(os.path.join(b, 'only_b.klh'), 'w').close()
+    os.makedirs(os.path.join(b, 'sub'))
+    open(os.path.join(b, 'sub', 'nested.klh'), 'w').close()
+
+    index = IncludeIndex([a, b])
+    assert index.find('both.klh') == a
+    assert index.find('only_b.klh') == b
+    assert index.find(os.path.join('sub', 'nested.klh')) == b
+    with pytest.raises(ValueError):
+        index.find('nope.klh')
+    assert index.locate('nope.klh') is None
+
+
+def test_each_dir_is_listed_once(tmp_path, monkeypatch):
+    dirs = make_dirs(tmp_path, 'a', 'b', 'c')
+    for (i, d) in enumerate(dirs):
+        open(os.path.join(d, 'h{0}.klh'.format(i)), 'w').close()
+
+    listed = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda d: listed.append(d) or real_scandir(d))
+    index = IncludeIndex(dirs)
+    for _ in range(10):
+        for i in range(3):
+            assert index.find('h{0}.klh'.format(i)) == dirs[i]
+    assert sorted(listed) == sorted(dirs)
+
+
+def test_changed_dirs_are_relisted(tmp_path):
+    (a, b) = make_dirs(tmp_path, 'a', 'b')
+    index = IncludeIndex([a, b])
+    assert index.locate('new.klh') is None
+
+    open(os.path.join(b, 'new.klh'), 'w').close()
+    # make sure the mtime changes, even on coarse timestamps
+    os.utime(b, ns=(0, os.stat(b).st_mtime_ns + 10 ** 9))
+    assert index.find('new.klh') == b
+
+
+def test_find_hdr_in_incdirs_shares_the_index(tmp_path):
+    (a,) = make_dirs(tmp_path, 'a')
+    open(os.path.join(a, 'x.klh'), 'w').close()
+    assert ktransw.find_hdr_in_incdirs('x.klh', [a]) == a
+    assert ktransw.include_index([a]) is ktransw.include_index([a])
+
+
+def test_lookups_never_see_a_partial_map(tmp_path):
+    import threading
+    (a, b) = make_dirs(tmp_path, 'a', 'b')
+    open(os.path.join(a, 'x.klh'), 'w').close()
+    for i in range(2000):
+        open(os.path.join(b, 'h{0}.klh'.format(i)), 'w').close()
+    open(os.path.join(b, 'x.klh'), 'w').close()
+    index = IncludeIndex([a, b])
+
+    done = threading.Event()
+    def relist():
+        for _ in range(200):
+            index._listings.clear()
+            index.refresh()
+        done.set()
+    # switch threads often, for find() to get to run in the middle of a refresh
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        thread = threading.Thread(target=relist)
+        thread.start()
+        found = set()
+        while not done.is_set():
+            found.add(index.find('x.klh'))
+        thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert found == set([a])
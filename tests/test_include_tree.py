@@ -0,0 +1,54 @@
+import pytest
+
+from ktransw import IncludeTree, get_includes_from_file, include_tree, scan_for_inc_stmts
+
+
+OUTPUT = b'''-- INCLUDE_MARKER 1:/src/prog.kl:
+PROGRAM prog
+-- INCLUDE_MARKER 1:/inc/errors.klh:1
+-- INCLUDE_MARKER 1:/inc/namespace.m:1
+-- INCLUDE_MARKER 2:/inc/errors.klh:2
+ROUTINE raise FROM errors
+-- INCLUDE_MARKER 3:/src/prog.kl:2
+-- INCLUDE_MARKER 1:/inc/strings.klh:1
+-- INCLUDE_MARKER 1:/inc/namespace.m:1
+-- INCLUDE_MARKER 2:/inc/strings.klh:2
+-- INCLUDE_MARKER 4:/src/prog.kl:2
+-- caf\xe9, not utf-8
+BEGIN
+END prog
+'''
+
+
+def test_includes_are_listed_once_in_order():
+    assert scan_for_inc_stmts(OUTPUT) == ['/inc/errors.klh', '/inc/namespace.m', '/inc/strings.klh']
+
+
+def test_nesting():
+    tree = IncludeTree.scan(OUTPUT)
+    assert tree.root.path == '/src/prog.kl'
+    assert [(n.path, depth) for (n, depth) in tree.root.walk()] == [
+        ('/src/prog.kl', 0),
+        ('/inc/errors.klh', 1), ('/inc/namespace.m', 2),
+        ('/inc/strings.klh', 1), ('/inc/namespace.m', 2)]
+
+
+@pytest.mark.parametrize('data', [b'', OUTPUT])
+def test_file_is_mapped(tmp_path, data):
+    path = tmp_path / 'prog.kl'
+    path.write_bytes(data)
+    assert get_includes_from_file(str(path)) == scan_for_inc_stmts(data)
+    # nothing keeps the file mapped
+    path.unlink()
+
+
+def test_large_output(tmp_path):
+    path = tmp_path / 'big.kl'
+    with open(str(path), 'wb') as f:
+        for i in range(2000):
+            f.write('-- INCLUDE_MARKER 1:/inc/h{0}.klh:1\n'.format(i % 500).encode())
+            f.write(b'  i = i + 1\n' * 20)
+            f.write('-- INCLUDE_MARKER 9:/src/big.kl:2\n'.encode())
+    tree = include_tree(str(path))
+    assert tree.includes == ['/inc/h{0}.klh'.format(i) for i in range(500)]
+    assert len(tree.root.children) == 2000
@@ -0,0 +1,100 @@
+import os
+import threading
+
+import pytest
+
+import ktransw
+from ktransw import Jobserver, main
+
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='needs mkfifo')
+
+
+@pytest.fixture
+def fake_jobserver(tmp_path, monkeypatch):
+    """a make -j3 jobserver: two tokens in a fifo, plus our implicit slot"""
+    fifo = str(tmp_path / 'jobserver')
+    os.mkfifo(fifo)
+    fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+    os.write(fd, b'++')
+    monkeypatch.setenv('MAKEFLAGS', ' -j3 --jobserver-auth=fifo:' + fifo)
+    monkeypatch.setattr(ktransw, '_jobserver', None)
+    yield fd
+    os.close(fd)
+
+
+def build_args():
+    return ktransw.build_parser().parse_args([])
+
+
+def tokens_left(fd):
+    try:
+        return os.read(fd, 16)
+    except BlockingIOError:
+        return b''
+
+
+def test_fallback_without_jobserver():
+    slots = Jobserver.from_makeflags('-j3', 2)
+    assert repr(slots) == 'Jobserver(jobs=2)'
+    tokens = [slots.acquire(), slots.acquire()]
+    assert tokens[0] is None
+    assert slots._take(0) is None
+    for token in tokens:
+        slots.release(token)
+
+
+def test_closed_pipe_fds_are_ignored():
+    (r, w) = (os.open(os.devnull, os.O_RDONLY), os.open(os.devnull, os.O_WRONLY))
+    try:
+        slots = Jobserver.from_makeflags('--jobserver-auth={0},{1}'.format(r, w), 4)
+        assert repr(slots) == 'Jobserver(jobs=4)'
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_tokens_come_from_the_fifo(fake_jobserver):
+    slots = ktransw.jobserver(build_args())
+    assert slots.auth.startswith('fifo:')
+    held = [slots.acquire() for _ in range(3)]
+    assert held == [None, b'+', b'+']
+
+    # all slots are taken: the next job has to wait for one to come back
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(slots.acquire()))
+    waiter.start()
+    waiter.join(0.3)
+    assert waiter.is_alive()
+    slots.release(held.pop())
+    waiter.join(5)
+    assert got == [b'+']
+
+    for token in held + got:
+        slots.release(token)
+    assert tokens_left(fake_jobserver) == b'++'
+
+
+def test_implicit_slot_is_reused(fake_jobserver):
+    slots = ktransw.jobserver(build_args())
+    # tokens held by other processes
+    assert tokens_left(fake_jobserver) == b'++'
+    token = slots.acquire()
+    assert token is None
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(slots.acquire()))
+    waiter.start()
+    slots.release(token)
+    waiter.join(5)
+    assert got == [None]
+
+
+def test_batch_returns_its_tokens(fake_jobserver, tmp_path):
+    sources = []
+    for name in ('a.kl', 'b.kl', 'c.kl', 'd.kl'):
+        (tmp_path / name).write_text('PROGRAM x\nBEGIN\nEND x\n')
+        sources.append(str(tmp_path / name))
+    with pytest.raises(SystemExit) as e:
+        main(['--gpp', str(tmp_path / 'no-such-gpp')] + sources)
+    assert e.value.code != 0
+    assert tokens_left(fake_jobserver) == b'++'
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+import yaml
+
+import kcdictw
+
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake tools are scripts')
+
+
+# copies its input to '-o FILE'
+FAKE_GPP = '''#!{python}
+import sys
+args = sys.argv[1:]
+out = args[args.index('-o') + 1]
+open(out, 'w').write(open(args[-1]).read())
+'''
+
+# writes <name>.tx, <name>.vr and <name>.kl into its working dir
+FAKE_KCDICT = '''#!{python}
+import os, sys
+name = os.path.splitext(os.path.basename(sys.argv[1]))[0]
+for ext in ('.tx', '.vr', '.kl'):
+    open(name + ext, 'w').write(name + ext)
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    for (name, text) in (('gpp', FAKE_GPP), ('kcdict', FAKE_KCDICT)):
+        tool = tmp_path / name
+        tool.write_text(text.format(python=sys.executable))
+        tool.chmod(0o755)
+    pkg = tmp_path / 'pkg'
+    (pkg / 'include').mkdir(parents=True)
+    (pkg / 'dict').mkdir()
+    build = tmp_path / 'build'
+    build.mkdir()
+    monkeypatch.chdir(build)
+    return tmp_path
+
+
+def run(project, *files):
+    argv = ['--gpp', str(project / 'gpp'), '--kcdict', str(project / 'kcdict'),
+        '-I', str(project / 'pkg' / 'include')]
+    with pytest.raises(SystemExit) as e:
+        kcdictw.main(argv + [str(project / 'pkg' / 'dict' / f) for f in files])
+    return e.value.code
+
+
+def test_many_inputs_one_manifest_export(project, monkeypatch):
+    names = ['d{0}'.format(i) for i in range(5)]
+    for name in names:
+        (project / 'pkg' / 'dict' / (name + '.utx')).write_text('$ {0}\n'.format(name))
+
+    exports = []
+    real_export = kcdictw.ManifestStore.export
+    monkeypatch.setattr(kcdictw.ManifestStore, 'export',
+        lambda self: exports.append(1) or real_export(self))
+    assert run(project, *[n + '.utx' for n in names]) == 0
+    assert exports == [1]
+
+    build = project / 'build'
+    for name in names:
+        assert (build / (name + '.tx')).read_text() == name + '.tx'
+        assert (build / (name + '.vr')).exists()
+        assert (project / 'pkg' / 'include' / (name + '.kl')).exists()
+    with open(str(build / '.man_log')) as f:
+        forms = yaml.safe_load(f)['forms']
+    assert forms == dict((n + '.tx', [n + '.vr']) for n in names)
+
+
+def test_output_name_needs_single_input(project, capsys):
+    for name in ('a.utx', 'b.ftx'):
+        (project / 'pkg' / 'dict' / name).write_text('$ x\n')
+    assert run(project, 'a.utx', 'b.ftx', 'out.tx') == 65
+    assert "can't name the .tx file" in capsys.readouterr().err
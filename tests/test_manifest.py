@@ -0,0 +1,106 @@
+import multiprocessing
+
+import yaml
+
+from ktransw import DATA_TYPES, ManifestStore, write_manifest
+
+
+def record_many(manifest, worker):
+    for i in range(20):
+        write_manifest(manifest, ['prog{0}_{1}.kl'.format(worker, i), 'obj{0}.kl'.format(i)],
+            'prog{0}_{1}.kl'.format(worker, i), export=(i % 5 == 0))
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    manifest = str(tmp_path / '.man_log')
+    with open(manifest, 'w') as f:
+        yaml.dump({'karel': {}}, f)
+
+    procs = [multiprocessing.Process(target=record_many, args=(manifest, w)) for w in range(8)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    ManifestStore(manifest).export()
+
+    with open(manifest) as f:
+        karel = yaml.safe_load(f)['karel']
+    assert len(karel) == 8 * 20
+    assert karel['prog3_7.pc'] == ['obj7.pc']
+
+
+def test_export_keeps_rossum_layout(tmp_path):
+    manifest = str(tmp_path / '.man_log')
+    with open(manifest, 'w') as f:
+        yaml.dump({'src': {'main.pc': ['old.pc']}, 'forms': {'msgs.tx': []}}, f)
+
+    store = ManifestStore(manifest)
+    store.record('main.pc', ['new.pc'], DATA_TYPES)
+    store.record('lonely.pc', [], DATA_TYPES)
+    assert store.export() == 2
+    # the journal is emptied
+    assert store.export() == 0
+
+    with open(manifest) as f:
+        file_list = yaml.safe_load(f)
+    assert file_list == {
+        'src': {'main.pc': ['new.pc', 'old.pc']},
+        'karel': {'lonely.pc': []},
+        'forms': {'msgs.tx': []}}
+
+
+def test_nothing_recorded_without_manifest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_manifest('.man_log', ['a.kl', 'b.kl'], 'a.kl')
+    assert not (tmp_path / '.man_log').exists()
+    assert not (tmp_path / '.man_log.db').exists()
+
+
+def test_export_splices_entries_updated(tmp_path, monkeypatch):
+    manifest = str(tmp_path / '.man_log')
+    file_list = {'karel': {'prog{0}.pc'.format(i): ['obj.pc'] for i in range(50)},
+        'forms': {'msgs.tx': []}}
+    with open(manifest, 'w') as f:
+        yaml.dump(file_list, f)
+
+    store = ManifestStore(manifest)
+    # the first export doesn't know the manifest yet, and parses all of it
+    store.record('prog3.pc', ['more.pc'], DATA_TYPES)
+    store.export()
+    file_list['karel']['prog3.pc'] = ['more.pc', 'obj.pc']
+
+    # later ones patch the entries updated into the text
+    def merge(file_list, updates):
+        raise AssertionError('merged the whole manifest')
+    monkeypatch.setattr(ManifestStore, '_merge', staticmethod(merge))
+    store.record('prog7.pc', ['x: y.pc'], DATA_TYPES)
+    store.record('new.pc', [], DATA_TYPES)
+    store.record('msgs.tx', ['msgs.vr'], ['forms'])
+    assert store.export() == 3
+    file_list['karel']['prog7.pc'] = ['obj.pc', 'x: y.pc']
+    file_list['karel']['new.pc'] = []
+    file_list['forms']['msgs.tx'] = ['msgs.vr']
+
+    with open(manifest) as f:
+        # just what dumping it whole would have written
+        assert f.read() == yaml.dump(file_list)
+
+
+def test_export_merges_edited_manifest_whole(tmp_path):
+    manifest = str(tmp_path / '.man_log')
+    with open(manifest, 'w') as f:
+        yaml.dump({'karel': {'main.pc': []}}, f)
+    store = ManifestStore(manifest)
+    store.record('main.pc', ['a.pc'], DATA_TYPES)
+    store.export()
+
+    # edited behind our back, in a layout of its own
+    with open(manifest, 'w') as f:
+        f.write('karel:\n    main.pc: [a.pc, b.pc]\n    other.pc: []\n')
+    store.record('main.pc', ['c.pc'], DATA_TYPES)
+    store.export()
+
+    with open(manifest) as f:
+        assert yaml.safe_load(f) == {
+            'karel': {'main.pc': ['a.pc', 'b.pc', 'c.pc'], 'other.pc': []}}
@@ -0,0 +1,60 @@
+import logging
+import os
+
+import pytest
+
+from ktransw import CompilationContext, build_parser, make_classes
+
+
+def write_workspace(root):
+    inc = root / 'include'
+    (inc / 'stack.klc').write_text(
+        'PROGRAM class_name\nROUTINE push(v : INTEGER)\nBEGIN\nEND push\n'
+        'BEGIN\nEND class_name\n')
+    (inc / 'stack.klh').write_text('ROUTINE push(v : INTEGER) FROM class_name\n')
+    (inc / 'math.klh').write_text(
+        '%define prog_name math\nROUTINE math__add(a : INTEGER) : INTEGER FROM math\n'
+        'ROUTINE math__sub(a : INTEGER) : INTEGER FROM math\n')
+    src = root / 'prog.kl'
+    src.write_text(
+        "PROGRAM prog\n%class stk('stack.klc','stack.klh')\n"
+        "%from math.klh %import add\n\nBEGIN\n  push(1)\nEND prog\n")
+    return src, inc
+
+
+def compile_in(folder, src, inc, *flags):
+    args = build_parser().parse_args(['--engine=builtin', '-I', str(inc)]
+        + list(flags) + [str(src)])
+    folder.mkdir()
+    # expand the class object again, rather than replaying it
+    ctx = CompilationContext(args, logging.getLogger('test'), str(folder), class_cache={})
+    make_classes(ctx, str(src), str(folder / 'prog.kl'))
+    return dict((os.path.basename(f), open(f).read()) for f in ctx.kl_files)
+
+
+def test_pipe_matches_temp_files(workspace):
+    src, inc = write_workspace(workspace)
+    files = compile_in(workspace / 'files', src, inc)
+    piped = compile_in(workspace / 'piped', src, inc, '--pipe')
+
+    assert sorted(piped) == ['prog.kl', 'stk.kl']
+    # the builtin engine names piped text after the file it replaces
+    for name in piped:
+        assert piped[name] == files[name].replace(str(workspace / 'files'), str(workspace / 'piped'))
+    assert 'math__add' in piped['prog.kl'] and 'math__sub' not in piped['prog.kl']
+
+
+@pytest.mark.parametrize('keep', [False, True])
+def test_pipe_materialises_intermediates_only_when_kept(workspace, keep):
+    src, inc = write_workspace(workspace)
+    flags = ['--pipe'] + (['-k'] if keep else [])
+    compile_in(workspace / 'build', src, inc, *flags)
+
+    intermediates = [n for n in os.listdir(str(workspace / 'build'))
+        if n.startswith(('pre-', 'pass1-', 'pass2-', 'obj-')) and n.endswith('.kl')]
+    if keep:
+        assert sorted(intermediates) == ['obj-stk.kl', 'pass1-obj-stk.kl',
+            'pass1-prog.kl', 'pass2-obj-stk.kl', 'pass2-prog.kl', 'pre-obj-stk.kl',
+            'pre-prog.kl']
+    else:
+        assert intermediates == []
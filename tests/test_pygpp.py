@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import pygpp
+from ktransw import KtranswError, build_parser, main, run_gpp, setup_gpp_cline
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'corpus'))
+from update_goldens import find_gpp, gpp_cmdline
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'gpp')
+CASES = sorted(os.listdir(CORPUS))
+
+
+def case_defines(case):
+    path = os.path.join(CORPUS, case, 'args')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [l.strip()[2:] for l in f if l.strip()]
+
+
+def expected(case):
+    with open(os.path.join(CORPUS, case, 'expected.out'), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_builtin_matches_golden(case, tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(CORPUS, case))
+    out = tmp_path / 'out.pp'
+    pygpp.preprocess('main.kl', str(out), ['inc'], case_defines(case))
+    assert out.read_bytes() == expected(case)
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_cli_matches_golden(case, tmp_path, monkeypatch):
+    # the gpp command line ktransw builds, as the shell would split it
+    monkeypatch.chdir(os.path.join(CORPUS, case))
+    out = tmp_path / 'out.pp'
+    argv = setup_gpp_cline('gpp', 'main.kl', str(out), ['inc'], case_defines(case))
+    assert pygpp.main(shlex.split(' '.join(argv))[1:]) == 0
+    assert out.read_bytes() == expected(case)
+
+
+# the goldens are only known to be what gpp produces where this runs: set
+# KTRANSW_REQUIRE_GPP to fail, rather than skip, without a gpp
+@pytest.mark.skipif(not find_gpp() and not os.environ.get('KTRANSW_REQUIRE_GPP'),
+    reason='no gpp to compare with')
+@pytest.mark.parametrize('case', CASES)
+def test_gpp_matches_golden(case, tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(CORPUS, case))
+    out = tmp_path / 'out.pp'
+    subprocess.check_call(gpp_cmdline(find_gpp() or 'gpp', str(out), case_defines(case)))
+    assert out.read_bytes() == expected(case)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake gpp is a script')
+def test_unsupported_falls_back_to_gpp(tmp_path):
+    src = tmp_path / 'main.kl'
+    src.write_text('%if 1\nPROGRAM x\n%endif\n')
+    # a 'gpp' that copies its input, so we can tell it ran
+    fake_gpp = tmp_path / 'gpp'
+    fake_gpp.write_text('#!{0}\nimport shutil, sys\n'
+        'shutil.copy(sys.argv[-1], sys.argv[sys.argv.index("-o") + 1])\n'
+        .format(sys.executable))
+    fake_gpp.chmod(0o755)
+    out = tmp_path / 'out.pp'
+
+    args = build_parser().parse_args(['--engine=builtin', '--gpp', str(fake_gpp), str(src)])
+    run_gpp(str(src), str(out), args, logging.getLogger('test'))
+    assert out.read_text() == src.read_text()
+
+
+def test_errors_terminate_translation(tmp_path):
+    src = tmp_path / 'main.kl'
+    src.write_text('%include missing.klh\n')
+    args = build_parser().parse_args(['--engine=builtin', str(src)])
+    with pytest.raises(KtranswError) as e:
+        run_gpp(str(src), str(tmp_path / 'out.pp'), args, logging.getLogger('test'))
+    assert e.value.returncode != 0
+    assert 'Translation terminated' in str(e.value)
+
+
+def replays(monkeypatch):
+    """the paths snapshots are taken over for, as they are"""
+    applied = []
+    real_applies = pygpp.MacroSnapshot.applies
+
+    def applies(self, engine):
+        ok = real_applies(self, engine)
+        if ok:
+            applied.append(os.path.basename(self.path))
+        return ok
+    monkeypatch.setattr(pygpp.MacroSnapshot, 'applies', applies)
+    return applied
+
+
+@pytest.mark.parametrize('case,defines,applied', [
+    ('basic', [], ['hdr.klh']),
+    # stack.klh expands class_name and stack_type, which main.kl defines
+    ('template', [], ['stack.klt']),
+    ('template', ['stack_type=INTEGER', 'class_name=istack'], ['stack.klt', 'stack.klh']),
+])
+def test_snapshots_give_identical_output(case, defines, applied, monkeypatch):
+    monkeypatch.chdir(os.path.join(CORPUS, case))
+    snapshots = []
+    for name in sorted(os.listdir('inc')):
+        engine = pygpp.Engine(['inc'], defines)
+        snapshot = engine.snapshot(engine.find_include(name))
+        snapshots.append(pygpp.MacroSnapshot.from_json(json.loads(json.dumps(snapshot.to_json()))))
+
+    taken = replays(monkeypatch)
+    output = pygpp.Engine(['inc'], snapshots=snapshots).process_file('main.kl')
+    assert output.encode('latin-1') == expected(case)
+    assert sorted(taken) == sorted(applied)
+
+
+def test_changed_header_is_processed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'lib.m').write_text('%define limit 1\n')
+    (tmp_path / 'main.kl').write_text('%include lib.m\nx = limit\n')
+    snapshot = pygpp.Engine().snapshot('lib.m')
+
+    (tmp_path / 'lib.m').write_text('%define limit 2\n')
+    taken = replays(monkeypatch)
+    assert 'x = 2' in pygpp.Engine(snapshots=[snapshot]).process_file('main.kl')
+    assert taken == []
+
+
+def test_flattened_defines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'lib.m').write_text('%ifndef lib_m\n%define lib_m\n%define twice(x) x x\n'
+        '%define gone 1\n%undef gone\n%endif\n')
+    flat = pygpp.Engine().snapshot('lib.m').flatten()
+    (tmp_path / 'flat.m').write_text(flat)
+    (tmp_path / 'main.kl').write_text('%include flat.m\ntwice(a) gone\n')
+    assert pygpp.Engine().process_file('main.kl').endswith('a a gone\n')
+
+
+def test_precompile_cli(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(CORPUS, 'basic'))
+    pch = str(tmp_path / 'hdr.kpm')
+    with pytest.raises(SystemExit) as e:
+        main(['--precompile', 'hdr.klh', '-o', pch, '-I', 'inc'])
+    assert e.value.code == 0
+
+    taken = replays(monkeypatch)
+    out = tmp_path / 'out.pp'
+    args = build_parser().parse_args(['--engine=builtin', '--pch', pch, '-I', 'inc', 'main.kl'])
+    run_gpp('main.kl', str(out), args, logging.getLogger('test'))
+    assert out.read_bytes() == expected('basic')
+    assert taken == ['hdr.klh']
+
+
+def test_output_needs_precompile(capsys):
+    with pytest.raises(SystemExit) as e:
+        main(['-o', 'prog.pc', 'prog.kl'])
+    assert e.value.code == 2
+    assert '--precompile' in capsys.readouterr().err
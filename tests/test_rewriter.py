@@ -0,0 +1,48 @@
+import pytest
+
+from ktransw import HeaderIndex, rewrite_lines
+
+
+def test_blank_lines_are_dropped_before_removing_char():
+    lines = ['a\n', '\n', '  \n', '`\n', 'b`c\n']
+    assert rewrite_lines(lines, blank_lines=True, char='`') == ['a\n', '\n', 'bc\n']
+    assert rewrite_lines(lines) == lines
+
+
+def test_classes_are_replaced_by_markers():
+    classes = []
+    lines = rewrite_lines(["%class stk('stack.klc','stack.klh')\n", 'x\n',
+        "%class q('queue.klc','queue.klh','int.klt')\n"], classes=classes)
+    assert lines == ['-- INCLUDE_MARKER 1:stk:1\n', 'x\n', '-- INCLUDE_MARKER 2:q:1\n']
+    assert classes == [[1, 'stk', 'stack.klc', 'stack.klh'],
+        [2, 'q', 'queue.klc', 'queue.klh', 'int.klt']]
+
+
+def test_selective_includes(tmp_path):
+    (tmp_path / 'math.klh').write_text(
+        '%define prog_name math\n'
+        'ROUTINE math__add(a : INTEGER; &\n  b : INTEGER) : INTEGER FROM math\n'
+        'ROUTINE math__sub(a : INTEGER) : INTEGER FROM math\n')
+    used = []
+    lines = rewrite_lines(['%from math.klh %import add\n'],
+        include_dirs=[str(tmp_path)], used_headers=used)
+    assert lines == ['%include namespace.m\n%define prog_name math\n'
+        'ROUTINE math__add(a : INTEGER; &\n  b : INTEGER) : INTEGER FROM math\n']
+    assert used == [str(tmp_path / 'math.klh')]
+
+    with pytest.raises(Exception):
+        rewrite_lines(['%from nope.klh %import add\n'], include_dirs=[str(tmp_path)],
+            used_headers=used)
+
+
+def test_headers_are_injected_for_known_objects_only(tmp_path):
+    hdr = tmp_path / 'pre-stk.klh'
+    hdr.write_text('ROUTINE push FROM stk\n')
+    index = HeaderIndex([str(hdr)], [[1, 'stk', 'stack.klc', 'stack.klh']])
+    lines = ['-- INCLUDE_MARKER 1:stk:1\n', '-- INCLUDE_MARKER 2:stk:1\n',
+        '-- INCLUDE_MARKER 1:foo.klh:1\n']
+    assert rewrite_lines(lines, headers=index) == ['ROUTINE push FROM stk\n'] + lines[1:]
+
+    # read once
+    hdr.unlink()
+    assert rewrite_lines(lines[:1], headers=index) == ['ROUTINE push FROM stk\n']
@@ -0,0 +1,153 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from ktransw import _serve_request
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+
+def test_request_output_and_exit_code(tmp_path):
+    chunks, ret = _serve_request(['-d', 'foo.kl'], str(tmp_path), dict(os.environ))
+    assert ret == 0
+    assert chunks == []
+
+    chunks, ret = _serve_request(['--bogus'], str(tmp_path), dict(os.environ))
+    assert ret == 2
+    assert all(stream == 'err' for (stream, _) in chunks)
+    assert 'unrecognized arguments: --bogus' in ''.join(data for (_, data) in chunks)
+
+
+def test_request_does_not_leak_cwd_or_env(tmp_path):
+    cwd = os.getcwd()
+    env = dict(os.environ)
+    env['KTRANSW_TEST_VAR'] = '1'
+
+    _serve_request(['-d', 'foo.kl'], str(tmp_path), env)
+    assert os.getcwd() == cwd
+    assert 'KTRANSW_TEST_VAR' not in os.environ
+
+
+def test_server_flag_is_refused_in_request(tmp_path):
+    chunks, ret = _serve_request(['--server'], str(tmp_path), dict(os.environ))
+    assert ret == 1
+    assert 'cannot start a server' in ''.join(data for (_, data) in chunks)
+
+
+def test_multiple_sources_in_server_worker(tmp_path):
+    import multiprocessing
+    from ktransw import _init_server_worker
+
+    for name in ('a', 'b'):
+        (tmp_path / (name + '.kl')).write_text('PROGRAM {0}\nBEGIN\nEND {0}\n'.format(name))
+    # server workers are daemons, which may not start a process pool
+    pool = multiprocessing.Pool(1, initializer=_init_server_worker)
+    try:
+        chunks, ret = pool.apply(_serve_request, (['--engine=builtin', '-E', '-j', '2',
+            'a.kl', 'b.kl'], str(tmp_path), dict(os.environ)))
+    finally:
+        pool.terminate()
+    assert ret == 0, chunks
+    for name in ('a', 'b'):
+        assert 'END {0}'.format(name) in (tmp_path / (name + '.kl')).read_text()
+
+
+def start_server(home):
+    """start a 'ktransw --server' with its state file in 'home', returning
+       the environment for its clients, its state and its process
+    """
+    env = dict(os.environ, HOME=str(home), PYTHONPATH=BIN_DIR, PYTHONIOENCODING='utf-8')
+    proc = subprocess.Popen([sys.executable, os.path.join(BIN_DIR, 'ktransw.py'),
+        '--server', '--workers', '1'], env=env, stderr=subprocess.DEVNULL)
+    state_file = home / '.ktransw' / 'server.json'
+    deadline = time.time() + 30
+    while True:
+        state = json.loads(state_file.read_text()) if state_file.exists() else {}
+        if state.get('pid') == proc.pid:
+            return env, state, proc
+        assert proc.poll() is None and time.time() < deadline, 'server did not start'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """a live 'ktransw --server', with its state file in a HOME of its own"""
+    (env, state, proc) = start_server(tmp_path)
+    yield env, state, proc
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+
+def client(env, *argv):
+    return subprocess.run([sys.executable, os.path.join(BIN_DIR, 'ktranswc.py')] + list(argv),
+        env=env, cwd=env['HOME'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+def test_client_talks_to_server(server, tmp_path):
+    env, state, proc = server
+    ktrans = tmp_path / 'ktrans'
+    # ktrans prints cp1252, not UTF-8
+    ktrans.write_text('#!{0}\nimport sys\nsys.stdout.buffer.write(b"caf\\xe9\\n")\n'
+        'sys.stderr.write("usage\\n")\nsys.exit(3)\n'.format(sys.executable))
+    ktrans.chmod(0o755)
+
+    run = client(env, '--ktrans', str(ktrans), '/?')
+    assert run.returncode == 3
+    assert run.stdout.decode('utf-8').endswith('café\n')
+    assert run.stderr == b'usage\n'
+
+    run = client(env, '--bogus')
+    assert run.returncode == 2
+    assert b'unrecognized arguments: --bogus' in run.stderr
+
+    # the request comes from another process: it must know the token
+    (host, port) = state['address'].rsplit(':', 1)
+    with socket.create_connection((host, int(port))) as conn:
+        conn.sendall(json.dumps({'token': 'nope', 'argv': ['-d', 'a.kl'], 'cwd': str(tmp_path),
+            'env': {}}).encode('utf-8') + b'\n')
+        frames = [json.loads(line) for line in conn.makefile('rb')]
+    assert frames == [{'err': 'ktransw: server rejected request: bad token\n'}, {'exit': 1}]
+
+    assert client(env, '--shutdown').returncode == 0
+    assert proc.wait(timeout=30) == 0
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='no POSIX permissions')
+def test_token_is_private(tmp_path):
+    # left by an earlier server, readable by everyone
+    state_dir = tmp_path / '.ktransw'
+    state_dir.mkdir()
+    (state_dir / 'server.json').write_text('{}')
+    os.chmod(str(state_dir), 0o755)
+    os.chmod(str(state_dir / 'server.json'), 0o644)
+
+    (env, _, proc) = start_server(tmp_path)
+    try:
+        assert os.stat(str(state_dir)).st_mode & 0o777 == 0o700
+        assert os.stat(str(state_dir / 'server.json')).st_mode & 0o777 == 0o600
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+def test_ktrans_passthrough_outside_server(tmp_path, capfd):
+    from ktransw import main
+    ktrans = tmp_path / 'ktrans'
+    ktrans.write_text('#!{0}\nimport sys\nsys.stdout.buffer.write(b"caf\\xe9\\n")\n'
+        'sys.stderr.write("usage\\n")\n'.format(sys.executable))
+    ktrans.chmod(0o755)
+    with pytest.raises(SystemExit) as e:
+        main(['--ktrans', str(ktrans), '/?'])
+    assert e.value.code == 0
+    # ktrans writes to our stdout and stderr itself
+    out, err = capfd.readouterr()
+    assert out.endswith('\n') and 'caf' in out
+    assert err == 'usage\n'
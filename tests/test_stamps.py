@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from ktransw import main
+
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+
+
+def compile(root):
+    with pytest.raises(SystemExit) as e:
+        main(['-q', '--engine=builtin', '--ktrans', str(root / 'ktrans'),
+              '-I', str(root / 'include'), str(root / 'prog.kl')])
+    assert e.value.code == 0
+    log = root / 'ktrans.log'
+    runs = sorted(os.path.basename(l) for l in log.read_text().split()) if log.exists() else []
+    if log.exists():
+        log.unlink()
+    return runs
+
+
+def test_unchanged_output_skips_ktrans(workspace):
+    assert compile(workspace) == ['prog.kl', 'stk.kl']
+    mtimes = [os.stat(str(workspace / n)).st_mtime_ns for n in ('prog.pc', 'stk.pc')]
+
+    # edits that don't survive preprocessing
+    (workspace / 'include' / 'errors.klh').write_text(
+        '%define UNUSED 1\n\nROUTINE raise FROM errors\n\n')
+    assert compile(workspace) == []
+    assert [os.stat(str(workspace / n)).st_mtime_ns for n in ('prog.pc', 'stk.pc')] == mtimes
+
+
+def test_changes_are_translated(workspace):
+    assert compile(workspace) == ['prog.kl', 'stk.kl']
+
+    (workspace / 'include' / 'errors.klh').write_text('ROUTINE raise(msg : STRING) FROM errors\n')
+    assert compile(workspace) == ['prog.kl']
+
+    (workspace / 'stk.pc').unlink()
+    assert compile(workspace) == ['stk.kl']
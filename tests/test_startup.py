@@ -0,0 +1,49 @@
+import os
+import re
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BIN_DIR = os.path.join(ROOT, 'bin')
+
+# milliseconds importing ktransw (and everything it imports) may take when
+# started from the zipapp. Compiling ktransw.py alone, which the zipapp
+# avoids, takes about that long. Raise it for slow machines.
+STARTUP_BUDGET_MS = float(os.environ.get('KTRANSW_STARTUP_BUDGET_MS', 60))
+
+# only needed once there is something to preprocess or translate
+LAZY_MODULES = ('yaml', 'subprocess', 'hashlib', 'sqlite3', 'tempfile', 'pygpp')
+
+
+def python(*args, **kwargs):
+    env = dict(os.environ, PYTHONPATH=BIN_DIR)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run([sys.executable] + list(args), env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, **kwargs)
+
+
+def import_time_ms(stderr, module):
+    """the cumulative import time of 'module' in '-X importtime' output"""
+    m = re.search(r'^import time:\s*\d+ \|\s*(\d+) \| {0}$'.format(module), stderr, re.M)
+    return int(m.group(1)) / 1000.0
+
+
+def test_dry_run_imports_little():
+    out = python('-c', 'import sys, ktransw\n'
+        'ktransw.build_parser().parse_args(["-d", "prog.kl"])\n'
+        'print(" ".join(sorted(sys.modules)))').stdout.split()
+    assert [m for m in LAZY_MODULES if m in out] == []
+
+
+def test_zipapp_startup_budget(tmp_path):
+    python(os.path.join(ROOT, 'make_zipapp.py'), '-o', str(tmp_path), 'ktransw')
+    pyz = str(tmp_path / 'ktransw.pyz')
+    src = tmp_path / 'prog.kl'
+    src.write_text('PROGRAM prog\nBEGIN\nEND prog\n')
+
+    times = []
+    for _ in range(3):
+        run = python('-X', 'importtime', pyz, '-d', str(src), cwd=str(tmp_path))
+        times.append(import_time_ms(run.stderr, 'ktransw'))
+    assert min(times) < STARTUP_BUDGET_MS, times
@@ -0,0 +1,84 @@
+import json
+import os
+import re
+
+import pytest
+
+import ktransw
+from ktransw import (HeaderSymbols, findWholeWord, findWholeWords, header_symbols,
+    scan_declarations, selective_declarations)
+
+
+HEADER = [
+    '%define prog_name vec\n',
+    '%define prog_name_alias v\n',
+    'ROUTINE vec__add(a : INTEGER; &\n',
+    '  b : INTEGER; &\n',
+    '  c : INTEGER) : INTEGER FROM vec\n',
+    'ROUTINE vec__sub(a : INTEGER) : INTEGER FROM vec\n',
+    'ROUTINE vec__add_all FROM vec\n',
+    'ROUTINE Normalize FROM vec\n',
+    '-- add is only mentioned here\n',
+    '\n',
+]
+
+
+@pytest.mark.parametrize('funcs', [
+    ['add'], ['sub', 'add'], ['ADD_ALL'], ['normalize'], ['all'], ['ub'], ['nope'], [],
+    ['vec__sub'], ['prog_name'],
+])
+def test_index_matches_scan(funcs):
+    assert HeaderSymbols.parse(HEADER).declarations(funcs) == scan_declarations(HEADER, funcs)
+
+
+def legacy_search(w):
+    # findWholeWord() of ktransw 0.2.3, one regex per word
+    return re.compile(r'(?:\b|_)({0})(?:\b)'.format(w), flags=re.IGNORECASE).search
+
+
+@pytest.mark.parametrize('words', [
+    ['add'], ['add', 'add_all'], ['ADD_ALL', 'add'], ['all', 'ub'], ['vec'], [],
+    ['sub', 'normalize', 'nope'],
+])
+def test_one_search_for_all_words(words):
+    search = findWholeWords(words)
+    for line in HEADER:
+        assert bool(search(line)) == any(legacy_search(w)(line) for w in words), line
+        for w in words:
+            assert bool(findWholeWord(w)(line)) == bool(legacy_search(w)(line)), line
+
+
+def test_continuations_are_followed():
+    decls = HeaderSymbols.parse(HEADER).declarations(['add'])
+    assert 'ROUTINE vec__add(a : INTEGER; &\n  b : INTEGER; &\n  c : INTEGER) : INTEGER FROM vec\n' in decls
+
+
+def test_json_roundtrip():
+    symbols = HeaderSymbols.parse(HEADER)
+    restored = HeaderSymbols.from_json(json.loads(json.dumps(symbols.to_json())))
+    for funcs in (['add'], ['sub', 'normalize'], ['nope']):
+        assert restored.declarations(funcs) == symbols.declarations(funcs)
+
+
+def test_index_is_stored_by_header_hash(tmp_path, monkeypatch):
+    inc = tmp_path / 'include'
+    inc.mkdir()
+    (inc / 'vec.klh').write_text(''.join(HEADER))
+    cache = tmp_path / 'cache'
+    ktransw._symbol_cache.clear()
+
+    used = []
+    text = selective_declarations('vec.klh', 'add, sub,', [str(inc)], used, str(cache))
+    assert text == scan_declarations(HEADER, ['add', 'sub'])
+    assert used == [str(inc / 'vec.klh')]
+    stored = [f for (_, _, files) in os.walk(str(cache / 'symbols')) for f in files]
+    assert stored == [ktransw.file_digest(str(inc / 'vec.klh')) + '.json']
+
+    # a fresh process loads it instead of parsing the header
+    ktransw._symbol_cache.clear()
+    parsed = []
+    real_parse = HeaderSymbols.parse
+    monkeypatch.setattr(HeaderSymbols, 'parse',
+        classmethod(lambda cls, lines: parsed.append(1) or real_parse(lines)))
+    header_symbols(str(inc / 'vec.klh'), str(cache))
+    assert parsed == []
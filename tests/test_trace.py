@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+import ktransw
+from ktransw import main, trace
+
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake ktrans is a script')
+
+
+def spans(events):
+    return dict((e['name'], e) for e in events if e['ph'] == 'X')
+
+
+def within(inner, outer):
+    return outer['ts'] <= inner['ts'] and \
+        inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur'] + 1
+
+
+def test_trace_covers_the_phases(workspace):
+    out = workspace / 'trace.json'
+    with pytest.raises(SystemExit) as e:
+        main(['-q', '--engine=builtin', '--trace', str(out), '--ktrans', str(workspace / 'ktrans'),
+              '-I', str(workspace / 'include'), str(workspace / 'prog.kl')])
+    assert e.value.code == 0
+
+    events = json.loads(out.read_text())['traceEvents']
+    found = spans(events)
+    for name in ('gpp pre', 'gpp pass1', 'gpp pass2', 'gpp final', 'fixups',
+                 'make_classes prog.kl', 'class stk', 'make_classes obj-stk.kl',
+                 'ktrans prog.kl', 'ktrans stk.kl', 'write_manifest'):
+        assert name in found, name
+    assert all(isinstance(e['args']['peak_memory'], int) for e in found.values())
+
+    # the object is expanded while its program is
+    assert within(found['class stk'], found['make_classes prog.kl'])
+    assert within(found['make_classes obj-stk.kl'], found['class stk'])
+
+    final = [e for e in events if e['name'] == 'gpp final']
+    assert sorted(os.path.basename(e['args']['file']) for e in final) == \
+        ['pass2-obj-stk.kl', 'pass2-prog.kl']
+    assert all(e['args']['bytes_out'] > 0 for e in final)
+    assert found['ktrans prog.kl']['args']['returncode'] == 0
+
+
+def test_no_spans_without_trace():
+    assert ktransw._tracer is None
+    with trace('gpp pre', 'gpp') as span:
+        assert not span.active